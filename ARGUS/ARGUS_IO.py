@@ -5,19 +5,24 @@ import numpy as np
 import ffmpeg
 import av
 
+from ARGUS_Profiler import ARGUS_profiled
+
 def ARGUS_shape_video(filename):
     p = ffmpeg.probe(filename, select_streams='v');
     width = p['streams'][0]['width']
     height = p['streams'][0]['height']
     return height, width
 
-def ARGUS_load_video(filename, frame_limit=None):
+@ARGUS_profiled
+def ARGUS_load_video(filename, frame_limit=None, thread_count=None):
     vid = None
     container = None
     try:
         container = av.open(filename)
         stream = container.streams.video[0]
         stream.thread_type = 'AUTO'
+        if thread_count != None:
+            stream.thread_count = thread_count
         
         min_frame = 0
         num_frames = stream.frames
@@ -0,0 +1,301 @@
+import os
+import sys
+import json
+import functools
+import threading
+
+from time import perf_counter, thread_time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_active_profiler = None
+_null_span = nullcontext()
+
+def ARGUS_profile(name):
+    """ Span of the active profiler (a no-op when none is active) """
+    profiler = _active_profiler
+    if profiler == None:
+        return _null_span
+    return profiler.time(name)
+
+def ARGUS_profiled(func):
+    """ Decorator recording each call of func as a span of the active profiler """
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = _active_profiler
+        if profiler == None:
+            return func(*args, **kwargs)
+        with profiler.time(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+def _memory_usage():
+    """ (rss, peak rss) of this process in bytes, None if unavailable """
+    rss = None
+    peak = None
+    if psutil != None:
+        info = psutil.Process().memory_info()
+        rss = info.rss
+        peak = getattr(info, "peak_wset", None)
+    if peak == None and resource != None:
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform != "darwin":
+            peak *= 1024
+    return rss, peak
+
+class ARGUS_profiler():
+    """ Hierarchical profiler: nested spans with wall time, CPU time and memory.
+
+    Spans nest per thread.  Each records wall and thread-CPU time and, if
+    memory=True, the change in process RSS and peak RSS (psutil is used
+    for RSS when installed).  If torch_profile=True, a torch profiler runs
+    while the profiler is active and every span is also marked in it, so
+    torch operator time can be attributed to spans.
+
+    The profiler has the time()/time_add() interface of Installer Stats,
+    so it can be passed as stats to ARGUS_app_ai.predict.  While active
+    (start() or a with block) it also receives the spans of functions
+    decorated with ARGUS_profiled and of ARGUS_profile blocks.  When not
+    enabled, time() returns a shared no-op context.
+
+    Usage:
+        profiler = ARGUS_profiler()
+        with profiler:
+            app_ai.predict(filename, source, stats=profiler)
+        profiler.print_summary()
+        profiler.export_chrome_trace("trace.json")
+    """
+
+    def __init__(self, enabled=True, memory=True, torch_profile=False):
+        self.enabled = enabled
+        self.memory = memory
+        self.torch_profile = torch_profile
+
+        self.spans = []
+        self.torch_profiler = None
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = perf_counter()
+        self._previous = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        """ Make this the active profiler """
+        global _active_profiler
+        if not self.enabled:
+            return
+        self._previous = _active_profiler
+        _active_profiler = self
+        if self.torch_profile:
+            import torch
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(activities=activities)
+            self.torch_profiler.start()
+
+    def stop(self):
+        global _active_profiler
+        if not self.enabled:
+            return
+        if self.torch_profiler != None:
+            self.torch_profiler.stop()
+        _active_profiler = self._previous
+        self._previous = None
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack == None:
+            stack = []
+            self._local.stack = stack
+        return stack
+
+    def time(self, name):
+        if not self.enabled:
+            return _null_span
+        return self._span(name)
+
+    @contextmanager
+    def _span(self, name):
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        path = name if parent == None else parent["path"] + "/" + name
+        span = dict(
+            name=name,
+            path=path,
+            depth=len(stack),
+            thread=threading.current_thread().name,
+            tid=threading.get_ident(),
+        )
+        stack.append(span)
+
+        record = None
+        if self.torch_profiler != None:
+            import torch
+            record = torch.profiler.record_function(name)
+            record.__enter__()
+        if self.memory:
+            rss_start, peak_start = _memory_usage()
+        cpu_start = thread_time()
+        start = perf_counter()
+        try:
+            yield span
+        finally:
+            end = perf_counter()
+            span["start"] = start - self._start
+            span["end"] = end - self._start
+            span["elapsed"] = end - start
+            span["cpu"] = thread_time() - cpu_start
+            if self.memory:
+                rss_end, peak_end = _memory_usage()
+                span["rss"] = rss_end
+                span["rss_delta"] = (None if rss_end == None
+                                     else rss_end - rss_start)
+                span["peak"] = peak_end
+                span["peak_delta"] = (None if peak_end == None
+                                      else peak_end - peak_start)
+            if record != None:
+                record.__exit__(None, None, None)
+            stack.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def time_add(self, name, elapsed):
+        """ Record a span that was measured elsewhere, ending now """
+        if not self.enabled:
+            return
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        end = perf_counter() - self._start
+        with self._lock:
+            self.spans.append(dict(
+                name=name,
+                path=name if parent == None else parent["path"] + "/" + name,
+                depth=len(stack),
+                thread=threading.current_thread().name,
+                tid=threading.get_ident(),
+                start=end - elapsed,
+                end=end,
+                elapsed=elapsed,
+                cpu=None,
+            ))
+
+    @property
+    def timers(self):
+        """ Timers by span name (last span of each), in the layout of Installer Stats """
+        timers = dict()
+        for span in self.spans:
+            timers[span["name"]] = dict(
+                start=span["start"],
+                end=span["end"],
+                elapsed=span["elapsed"])
+        return timers
+
+    def todict(self):
+        return dict(timers=self.timers, spans=self.spans)
+
+    def summary(self):
+        """ Per-span-path totals: count, wall, cpu, max rss and peak increase """
+        summary = dict()
+        for span in sorted(self.spans, key=lambda x: x["start"]):
+            entry = summary.setdefault(span["path"], dict(
+                name=span["name"],
+                depth=span["depth"],
+                count=0,
+                elapsed=0,
+                cpu=0,
+                threads=set(),
+                rss_delta=None,
+                peak_delta=None,
+            ))
+            entry["count"] += 1
+            entry["elapsed"] += span["elapsed"]
+            if span["cpu"] != None:
+                entry["cpu"] += span["cpu"]
+            entry["threads"].add(span["thread"])
+            for key in ["rss_delta", "peak_delta"]:
+                if span.get(key) != None:
+                    entry[key] = max(span[key],
+                                     entry[key] if entry[key] != None else span[key])
+        return summary
+
+    def print_summary(self):
+        def mb(value):
+            return "" if value == None else f"{value/2**20:.1f}"
+
+        print(f"{'Span':<60} {'Count':>6} {'Wall(s)':>9} {'CPU(s)':>9}"
+              f" {'Thr':>4} {'RSS+MB':>8} {'Peak+MB':>8}")
+        for path, entry in self.summary().items():
+            label = "  " * entry["depth"] + entry["name"]
+            print(f"{label[:60]:<60} {entry['count']:>6} {entry['elapsed']:>9.3f}"
+                  f" {entry['cpu']:>9.3f} {len(entry['threads']):>4}"
+                  f" {mb(entry['rss_delta']):>8} {mb(entry['peak_delta']):>8}")
+        if self.torch_profiler != None:
+            print(self.torch_profiler.key_averages().table(
+                sort_by="self_cpu_time_total", row_limit=20))
+
+    def export_json(self, filename):
+        summary = self.summary()
+        for entry in summary.values():
+            entry["threads"] = sorted(entry["threads"])
+        with open(filename, "w") as fp:
+            json.dump(dict(spans=self.spans, summary=summary), fp, indent=1)
+
+    def export_chrome_trace(self, filename):
+        """ Write spans in the Chrome trace format (chrome://tracing, Perfetto).
+
+        If torch_profile was enabled, the torch trace is written next to it
+        with a .torch.json suffix.
+        """
+        pid = os.getpid()
+        events = []
+        thread_names = dict()
+        for span in self.spans:
+            thread_names[span["tid"]] = span["thread"]
+        for tid, thread_name in thread_names.items():
+            events.append(dict(
+                name="thread_name",
+                ph="M",
+                pid=pid,
+                tid=tid,
+                args=dict(name=thread_name),
+            ))
+        for span in self.spans:
+            args = dict()
+            for key in ["cpu", "rss_delta", "peak_delta"]:
+                if span.get(key) != None:
+                    args[key] = span[key]
+            events.append(dict(
+                name=span["name"],
+                ph="X",
+                ts=span["start"] * 1e6,
+                dur=span["elapsed"] * 1e6,
+                pid=pid,
+                tid=span["tid"],
+                args=args,
+            ))
+        with open(filename, "w") as fp:
+            json.dump(dict(traceEvents=events, displayTimeUnit="ms"), fp)
+        if self.torch_profiler != None:
+            self.torch_profiler.export_chrome_trace(
+                os.path.splitext(filename)[0] + ".torch.json")
@@ -332,6 +332,8 @@ class ARGUS_RandSpatialCropSlicesd(RandomizableTransform, MapTransform, Invertib
         include_kurtosis: bool = False,
         include_gradient: bool = False,
         cache_gradient: bool = False,
+        num_samples: int = 1,
+        balance_classes: bool = False,
         allow_missing_keys: bool = False,
     ) -> None:
         """
@@ -351,6 +353,12 @@ class ARGUS_RandSpatialCropSlicesd(RandomizableTransform, MapTransform, Invertib
             include_skewness: If enabled, the skewness across the slices is concatenated with the Mean/Std statistics.
             include_kurtosis: If enabled, the kurtosis across the slices is concatenated with the Mean/Std statistics.
             include_gradient: If enabled, the gradient in each dimension is concatenated with the Mean/Std statistics.
+            num_samples: number of windows cropped from each input.  If more than one, a list of
+                dictionaries is returned (as RandCropByPosNegLabeld does), which Compose and
+                list_data_collate handle, so the cost of loading a video is shared by several samples.
+            balance_classes: using the last key's data (a label volume), first pick a class
+                uniformly from those present in the video, then a window whose cropped label
+                slices contain it.
             allow_missing_keys: don't raise exception if key is missing.
         """
         #super().__init__(keys, allow_missing_keys)
@@ -369,6 +377,8 @@ class ARGUS_RandSpatialCropSlicesd(RandomizableTransform, MapTransform, Invertib
         self.include_kurtosis = include_kurtosis
         self.include_gradient = include_gradient
         self.cache_gradient = cache_gradient
+        self.num_samples = num_samples
+        self.balance_classes = balance_classes
         self._roi_start: Optional[Sequence[int]] = None
         self._roi_center_slice: int = 99999
         self._roi_end: Optional[Sequence[int]] = None
@@ -397,9 +407,63 @@ class ARGUS_RandSpatialCropSlicesd(RandomizableTransform, MapTransform, Invertib
         else:
             self._roi_center_slice = self.center_slice
 
-    def __call__(self, data: Mapping[Hashable, NdarrayOrTensor]) -> Dict[Hashable, NdarrayOrTensor]:
-        ## passing last key's data to randomize, for require_labeled
-        self.randomize(data=data[self.keys[-1]])
+    def class_centers(self, data: NdarrayOrTensor) -> Dict[int, np.ndarray]:
+        """
+        For each class present in the label volume data, the centers whose
+        cropped label slices (num_slices of the last key) contain it.
+        """
+        label = np.rint(np.moveaxis(np.asarray(data), self.axis, 0))
+        label = label.reshape(label.shape[0], -1).astype(np.int32)
+        buffer = 0
+        if self.boundary*2 == max(self.num_slices):
+            buffer = 1
+        centers = np.arange(self.boundary, label.shape[0]-self.boundary+buffer)
+        if self.require_labeled:
+            centers = centers[(label[centers] != 0).any(axis=1)]
+        label_slices = self.num_slices[-1]
+        class_centers = dict()
+        for c in range(max(0, int(label.max()))+1):
+            frames = (label == c).any(axis=1)
+            # a window's label slices start at center-boundary (see __call__)
+            starts = np.maximum(0, centers - self.boundary)
+            present = np.zeros(len(centers), dtype=bool)
+            for i in range(label_slices):
+                present |= frames[np.minimum(starts+i, label.shape[0]-1)]
+            if present.any():
+                class_centers[c] = centers[present]
+        return class_centers
+
+    def __call__(self, data: Mapping[Hashable, NdarrayOrTensor]) -> Union[Dict[Hashable, NdarrayOrTensor], List[Dict[Hashable, NdarrayOrTensor]]]:
+        if self.num_samples == 1 and not self.balance_classes:
+            ## passing last key's data to randomize, for require_labeled
+            self.randomize(data=data[self.keys[-1]])
+            return self.crop(data)
+
+        class_centers = None
+        if self.balance_classes and self.center_slice == 99999:
+            class_centers = self.class_centers(data[self.keys[-1]])
+        samples = []
+        for i in range(self.num_samples):
+            if class_centers:
+                super().randomize(None)
+                classes = sorted(class_centers.keys())
+                centers = class_centers[classes[self.R.randint(len(classes))]]
+                self._roi_center_slice = int(centers[self.R.randint(len(centers))])
+            else:
+                self.randomize(data=data[self.keys[-1]])
+            d = dict(data)
+            # each sample gets its own record of applied transforms
+            for key in self.key_iterator(d):
+                trace_key = self.trace_key(key)
+                if trace_key in d:
+                    d[trace_key] = list(d[trace_key])
+            samples.append(self.crop(d))
+        if self.num_samples == 1:
+            return samples[0]
+        return samples
+
+    def crop(self, data: Mapping[Hashable, NdarrayOrTensor]) -> Dict[Hashable, NdarrayOrTensor]:
+        """ Crop all keys around the current center slice """
         d = dict(data)
 
         for key, num_slices, reduce_to_statistics in self.key_iterator(d, self.num_slices, self.reduce_to_statistics):
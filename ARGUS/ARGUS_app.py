@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
 import sys
 
 import itk
@@ -9,18 +10,25 @@ itk.force_load()
 import monai
 
 from ARGUS_app_ai import ARGUS_app_ai
+from ARGUS_Profiler import ARGUS_profiler
 
 def print_usage():
-    print("Usage: ARGUS_app [ultrasound_source] [task] <filename>")
+    print("Usage: ARGUS_app [ultrasound_source] [task] [profile] [threads=N] <filename>")
     print("   ultrasound_source:")
     print("     ", ARGUS_app_ai.sources)
     print("   task:")
     print("     ", ARGUS_app_ai.tasks)
+    print("   profile:")
+    print("      Print a per-stage profile and write <filename>_profile.json (Chrome trace)")
+    print("   threads=N:")
+    print("      Use N threads (default: ARGUS_threads.cfg, or all cores)")
 
 if __name__ == "__main__":
     task = None
     source = None
     device_num = None
+    profile = False
+    num_threads = None
     if len(sys.argv) > 1:
         for arg in sys.argv[1:-1]:
             if arg in ARGUS_app_ai.tasks:
@@ -29,6 +37,10 @@ if __name__ == "__main__":
                 source = arg
             elif len(arg) == 1 and arg.isdigit():
                 device_num = int(arg)
+            elif arg == "profile":
+                profile = True
+            elif arg.startswith("threads=") and arg[8:].isdigit():
+                num_threads = int(arg[8:])
             else:
                 print(f"ERROR: Option {arg} undefined.")
                 print("")
@@ -52,10 +64,18 @@ if source == None:
 
 app_ai = ARGUS_app_ai()
 
-result = app_ai.predict(filename,
-                        task=task,
-                        device_num=device_num,
-                        source=source)
+profiler = ARGUS_profiler(enabled=profile)
+with profiler:
+    result = app_ai.predict(filename,
+                            task=task,
+                            device_num=device_num,
+                            source=source,
+                            stats=profiler if profile else None,
+                            num_threads=num_threads)
+
+if profile:
+    profiler.print_summary()
+    profiler.export_chrome_trace(os.path.splitext(filename)[0]+"_profile.json")
 
 if result != None:
     if result["decision"] == 0:
@@ -1,9 +1,14 @@
+import os
 import gc
 
-from traceback import print_exc
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 from ARGUS_Timing import *
 from ARGUS_IO import *
+from ARGUS_preprocess_cache import ARGUS_preprocess_cache
+from ARGUS_pipeline import ARGUS_pipeline, ARGUS_stage, ARGUS_pipeline_abort
+from ARGUS_thread_budget import ARGUS_thread_budget
 from ARGUS_app_taskid import ARGUS_app_taskid
 from ARGUS_app_ptx import ARGUS_app_ptx
 from ARGUS_app_pnb import ARGUS_app_pnb
@@ -13,151 +18,262 @@ from ARGUS_app_ett import ARGUS_app_ett
 class ARGUS_app_ai:
     tasks = [ "PTX", "PNB", "ONSD", "ETT" ]
     sources = [ "Sonosite", "Butterfly", "Clarius" ]
+    task_apps = dict(
+        PTX = ARGUS_app_ptx,
+        PNB = ARGUS_app_pnb,
+        ONSD = ARGUS_app_onsd,
+        ETT = ARGUS_app_ett,
+    )
         
-    def __init__(self, argus_dir="."):
+    def __init__(self, argus_dir=".", load_models=True, thread_budget=None):
         self.argus_dir = argus_dir
+
+        # Division of the cores among ITK, torch and the video decoder,
+        # from ARGUS_threads.cfg unless given.  Set once for the process.
+        if thread_budget == None:
+            thread_budget = ARGUS_thread_budget.from_config(
+                os.path.join(argus_dir, "ARGUS_threads.cfg"))
+        self.thread_budget = thread_budget
+        self.thread_budget.apply()
+
+        # False leaves the networks randomly initialized (benchmarking).
+        self.load_models = load_models
+
+        # Task whose AR preprocessing is started while task id runs.
+        # Updated to the most recently identified task.
+        self.speculative_task = "PTX"
         
+    @staticmethod
+    def task_steps(task, app):
+        """ Steps of a task's pipeline, as callables of its app.  None = nothing to do. """
+        if task == "PTX":
+            return dict(
+                preprocessor=app.ptx_ar.preprocess_ptx,
+                preprocess=app.ar_preprocess,
+                ar_inference=app.ar_inference,
+                roi_preprocess=app.roi_generate_roi,
+                roi_inference=app.roi_inference,
+                decision=app.decision)
+        elif task == "PNB":
+            return dict(
+                preprocessor=app.pnb_ar.preprocess_pnb,
+                preprocess=app.ar_preprocess,
+                ar_inference=app.ar_inference,
+                roi_preprocess=None,
+                roi_inference=app.roi_inference,
+                decision=app.decision)
+        elif task == "ONSD":
+            return dict(
+                preprocessor=app.onsd_ar.preprocess_onsd,
+                preprocess=app.ar_preprocess,
+                ar_inference=app.ar_inference,
+                roi_preprocess=None,
+                roi_inference=app.roi_inference,
+                decision=app.decision)
+        elif task == "ETT":
+            return dict(
+                preprocessor=app.ett_roi.preprocess_ett,
+                preprocess=app.roi_preprocess,
+                ar_inference=None,
+                roi_preprocess=None,
+                roi_inference=app.roi_inference,
+                decision=app.decision)
+        return None
+
     def predict(self,
                 filename,
                 source,
                 debug=False,
                 stats=None,
                 task=None,
-                device_num=None):
+                device_num=None,
+                num_threads=None,
+                thread_budget=None):
+        """ Run the pipeline on one video.
+
+        thread_budget (default: the app's) divides the cores among the
+        stages; num_threads overrides its total.
+        """
         time_this = ARGUS_time_this
         if stats:
             time_this = stats.time
+
+        def record_time(name, elapsed):
+            if stats:
+                stats.time_add(name, elapsed)
+            else:
+                print('   Time for', name, 'is', elapsed)
+
+        if task != None and task not in self.tasks:
+            print(f"ERROR: task {task} not defined.")
+            return None
     
-        task_confidence = [0,0,0,0]
-        
-        decision = 0
-        decision_confidence = [0, 0]
-        
-        taskid = ARGUS_app_taskid(self.argus_dir, device_num, source)
-        ptx = ARGUS_app_ptx(self.argus_dir, device_num, source)
-        pnb = ARGUS_app_pnb(self.argus_dir, device_num, source)
-        onsd = ARGUS_app_onsd(self.argus_dir, device_num, source)
-        ett = ARGUS_app_ett(self.argus_dir, device_num, source)
-        
+        taskid = ARGUS_app_taskid(self.argus_dir, device_num, source, self.load_models)
+        task_steps = dict()
+        for task_name, task_app in self.task_apps.items():
+            task_steps[task_name] = self.task_steps(
+                task_name,
+                task_app(self.argus_dir, device_num, source, self.load_models))
+
+        preprocess_cache = ARGUS_preprocess_cache(time_this)
+
+        context = dict(
+            task=task,
+            task_confidence=[0, 0, 0, 0],
+            decision=0,
+            decision_confidence=[0, 0],
+        )
+
+        def steps(ctx):
+            return task_steps[ctx["task"]]
+
+        def decode(ctx):
+            ctx["video"] = ARGUS_load_video(
+                filename,
+                frame_limit=275,
+                thread_count=budget.decode_threads)
+            ctx["video_time"] = (
+                ctx["video"].GetLargestPossibleRegion().GetSize()[2] *
+                ctx["video"].GetSpacing()[2]
+            )
+
+        def calibrate(ctx):
+            if ctx["task"] == None:
+                preprocessor = taskid.taskid.preprocess_taskid
+            else:
+                preprocessor = steps(ctx)["preprocessor"]
+            preprocess_cache.calibrate(preprocessor, ctx["video"])
+
+        def taskid_preprocess(ctx):
+            taskid.preprocess(ctx["video"], preprocess_cache)
+
+        def taskid_inference(ctx):
+            taskid.inference()
+            task_num, ctx["task_confidence"] = taskid.decision()
+            if task_num == None:
+                raise ARGUS_pipeline_abort("Could not identify task.")
+            ctx["task"] = self.tasks[task_num]
+            self.speculative_task = ctx["task"]
+
+        def speculative_preprocess(ctx):
+            preprocess_cache.process(
+                task_steps[self.speculative_task]["preprocessor"],
+                ctx["video"])
+
+        def task_preprocess(ctx):
+            print(f"   Task: {ctx['task']}")
+            steps(ctx)["preprocess"](ctx["video"], preprocess_cache)
+            del ctx["video"]
+            preprocess_cache.clear()
+            gc.collect()
+
+        def ar_inference(ctx):
+            steps(ctx)["ar_inference"]()
+
+        def roi_preprocess(ctx):
+            steps(ctx)["roi_preprocess"]()
+
+        def roi_inference(ctx):
+            steps(ctx)["roi_inference"]()
+
+        def decision(ctx):
+            ctx["decision"], ctx["decision_confidence"] = steps(ctx)["decision"]()
+
+        identify_task_request = task == None
+
+        def identify_task(ctx):
+            return identify_task_request
+
+        def has_step(step):
+            return lambda ctx: steps(ctx)[step] != None
+
+        if thread_budget == None:
+            thread_budget = self.thread_budget
+        budget = thread_budget.with_num_threads(num_threads)
+
+        pipeline = ARGUS_pipeline(
+            [
+                ARGUS_stage("decode", decode,
+                    threads=budget.threads("decode"),
+                    timer="Read Video: Read from disk",
+                    group="Read Video",
+                    error=f"Could not load video {filename}"),
+                ARGUS_stage("calibrate", calibrate,
+                    depends=["decode"],
+                    timer="Read Video: Calibrate",
+                    group="Read Video",
+                    error="Could not calibrate video."),
+                ARGUS_stage("taskid_preprocess", taskid_preprocess,
+                    depends=["calibrate"],
+                    threads=budget.threads("taskid_preprocess"),
+                    timer="Read Video: Task Id Preprocess",
+                    group="Read Video",
+                    condition=identify_task,
+                    error="Could not preprocess for task identification."),
+                ARGUS_stage("speculative_preprocess", speculative_preprocess,
+                    depends=["calibrate"],
+                    threads=budget.threads("speculative_preprocess"),
+                    timer="Preprocess Video: Speculative Preprocess",
+                    group="Preprocess Video",
+                    condition=identify_task,
+                    error="Could not preprocess for anatomic reconstruction."),
+                ARGUS_stage("taskid", taskid_inference,
+                    depends=["taskid_preprocess"],
+                    threads=budget.threads("taskid"),
+                    timer="Read Video: Task Id",
+                    group="Read Video",
+                    condition=identify_task,
+                    error="Could not identify task."),
+                ARGUS_stage("preprocess", task_preprocess,
+                    depends=["taskid", "speculative_preprocess"],
+                    timer="Preprocess for AR",
+                    group="Preprocess Video",
+                    error="Could not preprocess for anatomic reconstruction."),
+                ARGUS_stage("ar_inference", ar_inference,
+                    depends=["preprocess"],
+                    timer="Preprocess AR Inference",
+                    group="Preprocess Video",
+                    condition=has_step("ar_inference"),
+                    error="Could not run anatomic reconstruction inference."),
+                ARGUS_stage("roi_preprocess", roi_preprocess,
+                    depends=["ar_inference"],
+                    timer="Preprocess for ROI",
+                    group="Preprocess Video",
+                    condition=has_step("roi_preprocess"),
+                    error="Could not preprocess for decision inference."),
+                ARGUS_stage("roi_inference", roi_inference,
+                    depends=["roi_preprocess"],
+                    timer="Process Video: ROI Inference",
+                    group="Process Video",
+                    error="Could not run decision inference."),
+                ARGUS_stage("decision", decision,
+                    depends=["roi_inference"],
+                    timer="Process Video: Decision",
+                    group="Process Video",
+                    error="Could not deliver decision."),
+            ],
+            num_threads=budget.total_threads(),
+            time_this=time_this,
+            set_pipeline_threads=budget.set_pipeline_threads,
+        )
+
         print("File:", filename)
         with time_this("all"):
-            with time_this("Read Video"):
-                with time_this("Read Video: Read from disk"):
-                    try:
-                        us_video_img = ARGUS_load_video(filename, frame_limit=275)
-                    except:
-                        print(f"ERROR: Could not load video {filename}")
-                        print_exc(limit=0)
-                        return None
-                    video_time = (
-                        us_video_img.GetLargestPossibleRegion().GetSize()[2] *
-                        us_video_img.GetSpacing()[2]
-                    )
-                if task == None:
-                    with time_this("Read Video: Task Id"):
-                        #try:
-                        taskid.preprocess(us_video_img)
-                        taskid.inference()
-                        taskid,task_confidence = taskid.decision()
-                        if taskid != None:
-                            task = self.tasks[taskid]
-                        else:
-                            print(f"ERROR: Could not identify task.")
-                            return None
-                        #except:
-                            #print(f"ERROR: task identification failed.")
-                            #print_exc(limit=0)
-                            #return None
-                else:
-                    if task in self.tasks:
-                        taskid = self.tasks.index(task)
-                    else:
-                        print(f"ERROR: task {task} not defined.")
-                        return None
-
-            with time_this("Preprocess Video"):
-                with time_this("Preprocess for AR"):
-                    #try:
-                    if task == "PTX":
-                        print("   Task: PTX")
-                        ptx.ar_preprocess(us_video_img)
-                    elif task == "PNB": 
-                        print("   Task: PNB")
-                        pnb.ar_preprocess(us_video_img)
-                    elif task == "ONSD":
-                        print("   Task: ONSD")
-                        onsd.ar_preprocess(us_video_img)
-                    elif task == "ETT":
-                        print("   Task: ETT")
-                        ett.roi_preprocess(us_video_img)
-                    #except:
-                        #print(f"ERROR: Could not preprocess for anatomic reconstruction.")
-                        #print_exc()#limit=0)
-                        #return None
-    
-                del us_video_img
-                gc.collect()
-            
-                with time_this("Preprocess AR Inference"):
-                    try:
-                        if task == "PTX":
-                            ptx.ar_inference()
-                        elif task == "PNB":
-                            pnb.ar_inference()
-                        elif task == "ONSD":
-                            onsd.ar_inference()
-                        #elif task == "ETT":
-                            # Nothing to do
-                    except:
-                        print(f"ERROR: Could not run anatomic reconstruction inference.")
-                        print_exc(limit=0)
-                        return None
-
-                with time_this("Preprocess for ROI"):
-                    try:
-                        if task == "PTX":
-                            ptx.roi_generate_roi()
-                        #elif task == "PNB":
-                            # Nothing to do
-                        #elif task == "ONSD":
-                            # Nothing to do
-                        #elif task == "ETT":
-                            # Nothing to do
-                    except:
-                        print(f"ERROR: Could not preprocess for decision inference.")
-                        print_exc(limit=0)
-                        return None
-
-            with time_this("Process Video"):
-                with time_this("Process Video: ROI Inference"):
-                    try:
-                        if task == "PTX":
-                            ptx.roi_inference()
-                        elif task == "PNB":
-                            pnb.roi_inference()
-                        elif task == "ONSD":
-                            onsd.roi_inference()
-                        elif task == "ETT":
-                            ett.roi_inference()
-                    except:
-                        print(f"ERROR: Could not run decision inference.")
-                        print_exc(limit=0)
-                        return None
-
-                with time_this("Process Video: Decision"):
-                    try:
-                        if task == "PTX":
-                            decision,decision_confidence = ptx.decision()
-                        elif task == "PNB":
-                            decision,decision_confidence = pnb.decision()
-                        elif task == "ONSD":
-                            decision,decision_confidence = onsd.decision()
-                        elif task == "ETT":
-                             decision,decision_confidence = ett.decision()
-                    except:
-                        print(f"ERROR: Could not deliver decision.")
-                        print_exc(limit=0)
-                        return None
+            success = pipeline.run(context)
+
+        if not success:
+            return None
+
+        for group, elapsed in pipeline.group_elapsed().items():
+            record_time(group, elapsed)
+        record_time("Preprocess Cache: Time Saved", preprocess_cache.time_saved)
+        if debug:
+            pipeline.print_timeline()
+
+        task = context["task"]
+        task_confidence = context["task_confidence"]
+        decision = context["decision"]
+        decision_confidence = context["decision_confidence"]
 
         print(f"   Prediction: {decision}")
         print(f"      Confidence Measure 0: {decision_confidence[0]}")
@@ -174,5 +290,195 @@ class ARGUS_app_ai:
             task_confidence_ETT = task_confidence[3],
             decision_confidence_0 = decision_confidence[0],
             decision_confidence_1 = decision_confidence[1],
-            video_length = video_time,
+            video_length = context["video_time"],
+            timeline = pipeline.timeline,
         )
+
+    def predict_many(self,
+                     files,
+                     source,
+                     task=None,
+                     device_num=None,
+                     num_workers=None,
+                     batch_size=8,
+                     debug=False):
+        """ Predict many videos, yielding (filename, result) as each completes.
+
+        Videos are decoded and source preprocessed by num_workers threads.
+        Completed videos are collected into batches of up to batch_size,
+        grouped by task, and the networks of each task are run once per
+        batch (see the apps' batch_process).  result is None if a video
+        failed.  Otherwise it has the same keys as predict(), with
+        timeline replaced by stats=dict(timers=...) holding the 'Read
+        Video', 'Preprocess Video', 'Process Video' and 'all' timers of
+        that video.  The time of a batched step is divided equally among
+        the videos in the batch.
+        """
+        if task != None and task not in self.tasks:
+            print(f"ERROR: task {task} not defined.")
+            return
+
+        if num_workers == None:
+            num_workers = max(1, os.cpu_count() // 2)
+
+        taskid = ARGUS_app_taskid(self.argus_dir, device_num, source, self.load_models)
+        apps = dict()
+        task_steps = dict()
+        for task_name, task_app in self.task_apps.items():
+            apps[task_name] = task_app(self.argus_dir, device_num, source, self.load_models)
+            task_steps[task_name] = self.task_steps(task_name, apps[task_name])
+
+        global_start = perf_counter()
+
+        def record_time(clip, name, elapsed):
+            timers = clip["timers"]
+            end = perf_counter() - global_start
+            if name in timers:
+                elapsed += timers[name]["elapsed"]
+            timers[name] = dict(start=end - elapsed, end=end, elapsed=elapsed)
+
+        def no_timer(name):
+            return ARGUS_time_this(name, use_timer=False)
+
+        def load(filename):
+            clip = dict(
+                filename=filename,
+                start=perf_counter(),
+                timers=dict(),
+                task=task,
+                task_confidence=[0, 0, 0, 0],
+                preprocess_cache=ARGUS_preprocess_cache(no_timer),
+            )
+            try:
+                start = perf_counter()
+                clip["video"] = ARGUS_load_video(
+                    filename,
+                    frame_limit=275,
+                    thread_count=self.thread_budget.decode_threads)
+                clip["video_time"] = (
+                    clip["video"].GetLargestPossibleRegion().GetSize()[2] *
+                    clip["video"].GetSpacing()[2]
+                )
+                record_time(clip, "Read Video", perf_counter() - start)
+
+                start = perf_counter()
+                if task == None:
+                    preprocessors = [
+                        taskid.taskid.preprocess_taskid,
+                        task_steps[self.speculative_task]["preprocessor"]]
+                else:
+                    preprocessors = [task_steps[task]["preprocessor"]]
+                for preprocessor in preprocessors:
+                    clip["preprocess_cache"].process(preprocessor, clip["video"])
+                record_time(clip, "Preprocess Video", perf_counter() - start)
+            except Exception as e:
+                print(f"ERROR: Could not load and preprocess video {filename}: {e}")
+                clip["error"] = True
+            return clip
+
+        def source_preprocess(clips, preprocessor, timer):
+            vid_imgs = []
+            for clip in clips:
+                start = perf_counter()
+                vid_imgs.append(clip["preprocess_cache"].process(preprocessor, clip["video"]))
+                record_time(clip, timer, perf_counter() - start)
+            return vid_imgs
+
+        def batch_process(clips, app, vid_imgs, timer):
+            start = perf_counter()
+            results = app.batch_process(vid_imgs, batch_size)
+            elapsed = (perf_counter() - start) / len(clips)
+            for clip in clips:
+                record_time(clip, timer, elapsed)
+            return results
+
+        def predict_batch(clips):
+            unknown = [clip for clip in clips if clip["task"] == None]
+            if len(unknown) > 0:
+                vid_imgs = source_preprocess(
+                    unknown, taskid.taskid.preprocess_taskid, "Read Video")
+                results = batch_process(unknown, taskid, vid_imgs, "Read Video")
+                for clip, (task_num, task_confidence) in zip(unknown, results):
+                    clip["task"] = self.tasks[task_num]
+                    clip["task_confidence"] = task_confidence
+                    self.speculative_task = clip["task"]
+
+            for task_name in self.tasks:
+                task_clips = [clip for clip in clips if clip["task"] == task_name]
+                if len(task_clips) == 0:
+                    continue
+                vid_imgs = source_preprocess(
+                    task_clips,
+                    task_steps[task_name]["preprocessor"],
+                    "Preprocess Video")
+                for clip in task_clips:
+                    del clip["video"]
+                    clip["preprocess_cache"].clear()
+                results = batch_process(
+                    task_clips, apps[task_name], vid_imgs, "Process Video")
+                for clip, (decision, decision_confidence) in zip(task_clips, results):
+                    clip["decision"] = decision
+                    clip["decision_confidence"] = decision_confidence
+                del vid_imgs
+            gc.collect()
+
+        def clip_result(clip):
+            record_time(clip, "all", perf_counter() - clip["start"])
+            task_confidence = clip["task_confidence"]
+            decision_confidence = clip["decision_confidence"]
+            if debug:
+                print("File:", clip["filename"])
+                print(f"   Task: {clip['task']}")
+                print(f"   Prediction: {clip['decision']}")
+            return dict(
+                decision = clip["decision"],
+                task_name = clip["task"],
+                device_num = device_num,
+                source = source,
+                task_confidence_PTX = task_confidence[0],
+                task_confidence_PNB = task_confidence[1],
+                task_confidence_ONSD = task_confidence[2],
+                task_confidence_ETT = task_confidence[3],
+                decision_confidence_0 = decision_confidence[0],
+                decision_confidence_1 = decision_confidence[1],
+                video_length = clip["video_time"],
+                stats = dict(timers=clip["timers"]),
+            )
+
+        files = list(files)
+        next_file = 0
+        running = set()
+        ready = []
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            while next_file < len(files) or running or ready:
+                # Keep the workers busy without holding more than two
+                # batches of decoded videos in memory.
+                while (next_file < len(files) and
+                       len(running) + len(ready) < 2 * batch_size):
+                    running.add(pool.submit(load, files[next_file]))
+                    next_file += 1
+
+                if running and len(ready) < batch_size:
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        clip = future.result()
+                        if "error" in clip:
+                            yield clip["filename"], None
+                        else:
+                            ready.append(clip)
+                    if running and len(ready) < batch_size:
+                        continue
+
+                clips = ready[:batch_size]
+                ready = ready[batch_size:]
+                if len(clips) == 0:
+                    continue
+                try:
+                    predict_batch(clips)
+                except Exception as e:
+                    print(f"ERROR: Could not process batch: {e}")
+                    for clip in clips:
+                        yield clip["filename"], None
+                    continue
+                for clip in clips:
+                    yield clip["filename"], clip_result(clip)
@@ -3,7 +3,7 @@ import os
 from ARGUS_ett_roi_inference import ARGUS_ett_roi_inference
 
 class ARGUS_app_ett:
-    def __init__(self, argus_dir=".", device_num=None, source=None):
+    def __init__(self, argus_dir=".", device_num=None, source=None, load_models=True):
         self.ett_roi = ARGUS_ett_roi_inference(
             config_file_name=os.path.join(argus_dir, "ARGUS_ett_roi.cfg"),
             network_name="vfold",
@@ -11,46 +11,84 @@ class ARGUS_app_ett:
             source=source
         )
         
-        ett_roi_best_models = [9, 2, 0]
-        for r in range(self.ett_roi.num_models):
-            model_name = os.path.join(
-                argus_dir,
-                "Models",
-                "ett_run"+str(r),
-                "best_model_"+str(ett_roi_best_models[r])+".pth"
-            )
-            self.ett_roi.load_model(r, model_name)
+        if load_models:
+            if self.ett_roi.use_student:
+                self.ett_roi.load_model(0, os.path.join(argus_dir, self.ett_roi.student_model_file))
+            else:
+                ett_roi_best_models = [9, 2, 0]
+                for r in range(self.ett_roi.num_models):
+                    model_name = os.path.join(
+                        argus_dir,
+                        "Models",
+                        "ett_run"+str(r),
+                        "best_model_"+str(ett_roi_best_models[r])+".pth"
+                    )
+                    self.ett_roi.load_model(r, model_name)
+        else:
+            # Random networks (benchmarking) also run in inference mode
+            for model in self.ett_roi.model:
+                model.eval()
 
         self.labels = None
 
         self.result = 0
         self.confidence = [0, 0]
+
+        # Input of the last window of roi_inference, explained by gradcam
+        # and occlusion_sensitivity without re-running the models
+        self.explain_tensor = None
             
-    def roi_preprocess(self, vid_img):
-        self.ett_roi.volume_preprocess(vid_img)
+    def roi_preprocess(self, vid_img, preprocess_cache=None, crop_data=True):
+        self.ett_roi.volume_preprocess(vid_img, crop_data=crop_data, preprocess_cache=preprocess_cache)
+        self.explain_tensor = None
         
     def roi_inference(self):
         self.result, self.confidence = self.ett_roi.volume_inference()
+        self.explain_tensor = self.ett_roi.input_tensor
         
     def decision(self):
         return self.result, self.confidence
 
-    def gradcam(self, runs=None, slice_num=None):
-        if slice_num != None:
-            if slice_num < 0:
-                slice_num = self.ett_roi.input_image.GetLargestPossibleRegion().GetSize()[2] + slice_num
-            self.ett_roi.volume_inference(slice_min=slice_num, slice_max=slice_num+1, step=1)
-        else:
-            self.result, self.confidence = self.ett_roi.volume_inference()
-        return self.ett_roi.gradcam(runs)
-    
-    def occlusion_sensitivity(self, runs=None, slice_num=None, mask_size=16):
+    def batch_process(self, vid_imgs, batch_size=None):
+        """ Decisions for source-preprocessed videos, batching the windows
+        of all videos """
+        vid_tensors = []
+        for vid_img in vid_imgs:
+            self.roi_preprocess(vid_img, crop_data=False)
+            vid_tensors.append(self.ett_roi.volume_input_tensors())
+        probs = self.ett_roi.batch_probabilities(
+            [t for input_tensors in vid_tensors for t in input_tensors],
+            batch_size)
+
+        results = []
+        prob_min = 0
+        for input_tensors in vid_tensors:
+            prob_max = prob_min + len(input_tensors)
+            results.append(self.ett_roi.volume_classify(probs[prob_min:prob_max]))
+            prob_min = prob_max
+        return results
+
+    def explain_input(self, slice_num=None):
+        """ The window at slice_num, or by default the last window of
+        roi_inference; only the preprocessing of the window is run """
         if slice_num != None:
             if slice_num < 0:
                 slice_num = self.ett_roi.input_image.GetLargestPossibleRegion().GetSize()[2] + slice_num
-            self.ett_roi.volume_inference(slice_min=slice_num, slice_max=slice_num+1, step=1)
-        else:
-            self.result, self.confidence = self.ett_roi.volume_inference()
-        return self.ett_roi.occlusion_sensitivity(runs, mask_size=mask_size)
+            return self.ett_roi.volume_input_tensors(
+                step=1, slice_min=slice_num, slice_max=slice_num+1)[0]
+        if self.explain_tensor is None:
+            self.explain_tensor = self.ett_roi.volume_input_tensors()[-1]
+        return self.explain_tensor
+
+    def gradcam(self, runs=None, slice_num=None):
+        return self.ett_roi.gradcam(runs, input_tensor=self.explain_input(slice_num))
     
-    
\ No newline at end of file
+    def occlusion_sensitivity(self, runs=None, slice_num=None, mask_size=16, stride=None,
+                              b_box=None, batch_size=64):
+        return self.ett_roi.occlusion_sensitivity(
+            runs,
+            mask_size=mask_size,
+            stride=stride,
+            b_box=b_box,
+            batch_size=batch_size,
+            input_tensor=self.explain_input(slice_num))
@@ -4,7 +4,7 @@ from ARGUS_onsd_ar_inference import ARGUS_onsd_ar_inference
 from ARGUS_onsd_roi_inference import ARGUS_onsd_roi_inference
 
 class ARGUS_app_onsd:
-    def __init__(self, argus_dir=".", device_num=None, source=None):
+    def __init__(self, argus_dir=".", device_num=None, source=None, load_models=True):
         self.onsd_ar = ARGUS_onsd_ar_inference(
             config_file_name=os.path.join(argus_dir, "ARGUS_onsd_ar.cfg"),
             network_name="final",
@@ -13,23 +13,31 @@ class ARGUS_app_onsd:
         )
         self.onsd_roi = ARGUS_onsd_roi_inference()
         
-        onsd_ar_best_models = [5, 8, 5]
-        for r in range(self.onsd_ar.num_models):
-            model_name = os.path.join(
-                argus_dir,
-                "Models",
-                "onsd_vfold_run"+str(r),
-                "best_model_"+str(onsd_ar_best_models[r])+".pth"
-            )
-            self.onsd_ar.load_model(r, model_name)
+        if load_models:
+            if self.onsd_ar.use_student:
+                self.onsd_ar.load_model(0, os.path.join(argus_dir, self.onsd_ar.student_model_file))
+            else:
+                onsd_ar_best_models = [5, 8, 5]
+                for r in range(self.onsd_ar.num_models):
+                    model_name = os.path.join(
+                        argus_dir,
+                        "Models",
+                        "onsd_vfold_run"+str(r),
+                        "best_model_"+str(onsd_ar_best_models[r])+".pth"
+                    )
+                    self.onsd_ar.load_model(r, model_name)
+        else:
+            # Random networks (benchmarking) also run in inference mode
+            for model in self.onsd_ar.model:
+                model.eval()
 
         self.labels = None
 
         self.result = 0
         self.confidence = [0, 0]
             
-    def ar_preprocess(self, vid_img):
-        self.onsd_ar.volume_preprocess(vid_img)
+    def ar_preprocess(self, vid_img, preprocess_cache=None, crop_data=True):
+        self.onsd_ar.volume_preprocess(vid_img, crop_data=crop_data, preprocess_cache=preprocess_cache)
         
     def ar_inference(self):
         self.labels = self.onsd_ar.volume_inference(step=5)
@@ -56,3 +64,14 @@ class ARGUS_app_onsd:
         
     def decision(self):
         return self.result, self.confidence
+
+    def batch_process(self, vid_imgs, batch_size=None):
+        """ Decisions for source-preprocessed videos.  The frames evaluated
+        in the second pass depend on the first, so videos run one at a time. """
+        results = []
+        for vid_img in vid_imgs:
+            self.ar_preprocess(vid_img, crop_data=False)
+            self.ar_inference()
+            self.roi_inference()
+            results.append(self.decision())
+        return results
@@ -4,7 +4,7 @@ from ARGUS_pnb_ar_inference import ARGUS_pnb_ar_inference
 from ARGUS_pnb_roi_inference import ARGUS_pnb_roi_inference
 
 class ARGUS_app_pnb:
-    def __init__(self, argus_dir=".", device_num=None, source=None):
+    def __init__(self, argus_dir=".", device_num=None, source=None, load_models=True):
         self.pnb_ar = ARGUS_pnb_ar_inference(
             config_file_name=os.path.join(argus_dir,"ARGUS_pnb_ar.cfg"),
             network_name="final",
@@ -13,23 +13,31 @@ class ARGUS_app_pnb:
         )
         self.pnb_roi = ARGUS_pnb_roi_inference()
         
-        pnb_ar_best_models = [8, 0, 7]
-        for r in range(self.pnb_ar.num_models):
-            model_name = os.path.join(
-                argus_dir,
-                "Models",
-                "pnb_vfold_run"+str(r),
-                "best_model_"+str(pnb_ar_best_models[r])+".pth"
-            )
-            self.pnb_ar.load_model(r, model_name)
+        if load_models:
+            if self.pnb_ar.use_student:
+                self.pnb_ar.load_model(0, os.path.join(argus_dir, self.pnb_ar.student_model_file))
+            else:
+                pnb_ar_best_models = [8, 0, 7]
+                for r in range(self.pnb_ar.num_models):
+                    model_name = os.path.join(
+                        argus_dir,
+                        "Models",
+                        "pnb_vfold_run"+str(r),
+                        "best_model_"+str(pnb_ar_best_models[r])+".pth"
+                    )
+                    self.pnb_ar.load_model(r, model_name)
+        else:
+            # Random networks (benchmarking) also run in inference mode
+            for model in self.pnb_ar.model:
+                model.eval()
 
         self.labels = None
 
         self.result = 0
         self.confidence = [0, 0]
             
-    def ar_preprocess(self, vid_img):
-        self.pnb_ar.preprocess(vid_img)
+    def ar_preprocess(self, vid_img, preprocess_cache=None, crop_data=True):
+        self.pnb_ar.preprocess(vid_img, crop_data=crop_data, preprocess_cache=preprocess_cache)
         
     def ar_inference(self):
         self.labels = self.pnb_ar.inference()
@@ -41,3 +49,16 @@ class ARGUS_app_pnb:
         
     def decision(self):
         return self.result, self.confidence
+
+    def batch_process(self, vid_imgs, batch_size=None):
+        """ Decisions for source-preprocessed videos, batched across videos """
+        ar_inputs = []
+        for vid_img in vid_imgs:
+            self.ar_preprocess(vid_img, crop_data=False)
+            ar_inputs.append((self.pnb_ar.input_tensor, self.pnb_ar.input_image))
+        labels = self.pnb_ar.batch_inference([x[0] for x in ar_inputs], batch_size)
+
+        results = []
+        for (input_tensor, input_image), vid_labels in zip(ar_inputs, labels):
+            results.append(self.pnb_roi.inference(input_image, vid_labels))
+        return results
@@ -4,7 +4,7 @@ from ARGUS_ptx_ar_inference import ARGUS_ptx_ar_inference
 from ARGUS_ptx_roi_inference import ARGUS_ptx_roi_inference
 
 class ARGUS_app_ptx:
-    def __init__(self, argus_dir=".", device_num=None, source=None):
+    def __init__(self, argus_dir=".", device_num=None, source=None, load_models=True):
         self.ptx_ar = ARGUS_ptx_ar_inference(
             config_file_name=os.path.join(argus_dir, "ARGUS_ptx_ar.cfg"),
             network_name="final",
@@ -17,31 +17,47 @@ class ARGUS_app_ptx:
             device_num=device_num
         )
         
-        ptx_ar_best_models = [8, 3, 6]
-        for r in range(self.ptx_ar.num_models):
-            model_name = os.path.join(
-                argus_dir,
-                "Models",
-                "ptx_vfold_run"+str(r),
-                "best_model_"+str(ptx_ar_best_models[r])+".pth"
-            )
-            self.ptx_ar.load_model(r, model_name)
+        if load_models:
+            if self.ptx_ar.use_student:
+                self.ptx_ar.load_model(0, os.path.join(argus_dir, self.ptx_ar.student_model_file))
+            else:
+                ptx_ar_best_models = [8, 3, 6]
+                for r in range(self.ptx_ar.num_models):
+                    model_name = os.path.join(
+                        argus_dir,
+                        "Models",
+                        "ptx_vfold_run"+str(r),
+                        "best_model_"+str(ptx_ar_best_models[r])+".pth"
+                    )
+                    self.ptx_ar.load_model(r, model_name)
+        else:
+            # Random networks (benchmarking) also run in inference mode
+            for model in self.ptx_ar.model:
+                model.eval()
 
-        ptx_roi_best_models = [4, 3, 1]
-        for r in range(self.ptx_roi.num_models):
-            model_name = os.path.join(
-                argus_dir,
-                "Models",
-                "ptx_roi_run"+str(r),
-                "best_model_"+str(ptx_roi_best_models[r])+".pth"
-            )
-            self.ptx_roi.load_model(r, model_name)
+        if load_models:
+            if self.ptx_roi.use_student:
+                self.ptx_roi.load_model(0, os.path.join(argus_dir, self.ptx_roi.student_model_file))
+            else:
+                ptx_roi_best_models = [4, 3, 1]
+                for r in range(self.ptx_roi.num_models):
+                    model_name = os.path.join(
+                        argus_dir,
+                        "Models",
+                        "ptx_roi_run"+str(r),
+                        "best_model_"+str(ptx_roi_best_models[r])+".pth"
+                    )
+                    self.ptx_roi.load_model(r, model_name)
+        else:
+            # Random networks (benchmarking) also run in inference mode
+            for model in self.ptx_roi.model:
+                model.eval()
             
         self.result = 0
         self.confidence = [0, 0]
         
-    def ar_preprocess(self, vid_img):
-        self.ptx_ar.preprocess(vid_img)
+    def ar_preprocess(self, vid_img, preprocess_cache=None, crop_data=True):
+        self.ptx_ar.preprocess(vid_img, crop_data=crop_data, preprocess_cache=preprocess_cache)
         
     def ar_inference(self):
         labels = self.ptx_ar.inference()
@@ -57,3 +73,21 @@ class ARGUS_app_ptx:
         
     def decision(self):
         return self.result, self.confidence
+
+    def batch_process(self, vid_imgs, batch_size=None):
+        """ Decisions for source-preprocessed videos, batched across videos """
+        ar_inputs = []
+        for vid_img in vid_imgs:
+            self.ar_preprocess(vid_img, crop_data=False)
+            ar_inputs.append((
+                self.ptx_ar.input_tensor,
+                self.ptx_ar.input_image,
+                self.ptx_ar.input_array,
+                self.ptx_ar.label_array))
+        self.ptx_ar.batch_inference([x[0] for x in ar_inputs], batch_size)
+
+        roi_tensors = []
+        for input_tensor, input_image, input_array, label_array in ar_inputs:
+            self.ptx_roi.generate_roi(input_image, input_array, label_array)
+            roi_tensors.append(self.ptx_roi.input_tensor)
+        return self.ptx_roi.batch_inference(roi_tensors, batch_size)
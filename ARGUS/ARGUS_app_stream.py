@@ -0,0 +1,278 @@
+import threading
+
+from time import perf_counter, sleep
+from concurrent.futures import ThreadPoolExecutor
+
+import itk
+
+import numpy as np
+
+import av
+
+from ARGUS_Timing import *
+from ARGUS_app_ai import ARGUS_app_ai
+from ARGUS_app_taskid import ARGUS_app_taskid
+
+class ARGUS_frame_ring_buffer():
+    """ Fixed-capacity buffer of the most recent video frames (t, y, x) """
+
+    def __init__(self, capacity, frame_shape, dtype=np.float32):
+        self.capacity = capacity
+        self.frames = np.zeros((capacity, frame_shape[0], frame_shape[1]), dtype=dtype)
+        self.next_frame = 0
+        self.num_frames = 0
+        self.frames_pushed = 0
+
+    def __len__(self):
+        return self.num_frames
+
+    def push(self, frames):
+        if len(frames) > self.capacity:
+            frames = frames[-self.capacity:]
+        for frame in frames:
+            self.frames[self.next_frame] = frame
+            self.next_frame = (self.next_frame + 1) % self.capacity
+        self.num_frames = min(self.capacity, self.num_frames + len(frames))
+        self.frames_pushed += len(frames)
+
+    def latest(self, num_frames=None):
+        """ Copy of the newest num_frames frames, oldest first """
+        if num_frames == None or num_frames > self.num_frames:
+            num_frames = self.num_frames
+        indx = (np.arange(self.next_frame - num_frames, self.next_frame)
+                % self.capacity)
+        return self.frames[indx]
+
+class ARGUS_app_stream:
+    """ Rolling decisions on a live video.
+
+    Frames passed to push_frames() are source (probe) preprocessed once,
+    on arrival, and kept in a ring buffer.  The ruler/crop calibration is
+    computed from the first frames and reused for later frames.  Every
+    update_interval seconds of video, the task networks are re-run on the
+    newest window of the buffer in a background thread; current_decision()
+    returns the result of the most recent completed update.
+
+    If task is None, raw frames are kept until taskid_seconds of video are
+    available and the task is identified from them before streaming starts.
+
+    Usage:
+        stream = ARGUS_app_stream("PTX", "Butterfly")
+        stream.push_frames(frames)
+        result = stream.current_decision()
+        ...
+        result = stream.finish()
+    """
+
+    # Number of newest frames given to each task's networks.  PTX and PNB
+    # reconstruct near the end of the window (testing_slice), so twice the
+    # cfg num_slices suffices.  ONSD and ETT use the whole buffer.
+    window_frames = dict(
+        PTX = 64,
+        PNB = 64,
+        ONSD = None,
+        ETT = None,
+    )
+
+    def __init__(self,
+                 task=None,
+                 source=None,
+                 argus_dir=".",
+                 device_num=None,
+                 framerate=30,
+                 update_interval=1.0,
+                 buffer_frames=275,
+                 taskid_seconds=2.0,
+                 debug=False):
+        if task != None and task not in ARGUS_app_ai.tasks:
+            raise ValueError(f"Task {task} not defined.")
+
+        self.argus_dir = argus_dir
+        self.device_num = device_num
+        self.source = source
+        self.framerate = framerate
+        self.update_interval = update_interval
+        self.buffer_frames = buffer_frames
+        self.taskid_seconds = taskid_seconds
+        self.debug = debug
+
+        self.task = None
+        self.task_confidence = [0, 0, 0, 0]
+        self.steps = None
+        self.calibration = None
+        self.buffer = None
+        self.spacing = None
+        self.origin = None
+
+        self.raw_frames = []
+        self.frames_at_last_update = 0
+        self.last_frame_time = None
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._update_future = None
+        self._result = None
+
+        if task != None:
+            self.set_task(task)
+
+    def set_task(self, task):
+        app = ARGUS_app_ai.task_apps[task](self.argus_dir, self.device_num, self.source)
+        self.steps = ARGUS_app_ai.task_steps(task, app)
+        self.task = task
+
+    def _frames_to_image(self, frames):
+        vid = itk.GetImageFromArray(np.ascontiguousarray(frames, dtype=np.float32))
+        vid.SetSpacing([1, 1, 1.0/self.framerate])
+        return vid
+
+    def _source_preprocess(self, frames):
+        """ Source preprocess a chunk of raw frames, reusing the calibration """
+        preprocessor = self.steps["preprocessor"]
+        vid = self._frames_to_image(frames)
+        if hasattr(preprocessor, "crop"):
+            if self.calibration == None:
+                self.calibration = preprocessor.get_calibration(vid)
+            vid = preprocessor.resample(
+                preprocessor.crop(vid, self.calibration),
+                preprocessor.new_size)
+        else:
+            vid = preprocessor.process(vid)
+
+        vid_array = itk.GetArrayFromImage(vid)
+        if self.buffer == None:
+            self.spacing = list(vid.GetSpacing())
+            self.origin = list(vid.GetOrigin())
+            self.origin[2] = 0
+            self.buffer = ARGUS_frame_ring_buffer(
+                self.buffer_frames,
+                vid_array.shape[1:])
+        self.buffer.push(vid_array)
+
+    def _identify_task(self):
+        taskid = ARGUS_app_taskid(self.argus_dir, self.device_num, self.source)
+        taskid.preprocess(self._frames_to_image(np.stack(self.raw_frames)))
+        taskid.inference()
+        task_num, self.task_confidence = taskid.decision()
+        if task_num == None:
+            raise RuntimeError("Could not identify task.")
+        self.set_task(ARGUS_app_ai.tasks[task_num])
+        if self.debug:
+            print(f"   Task: {self.task}")
+
+    def push_frames(self, frames):
+        """ Add frames (a 2D frame or an array of frames, t x y x x) """
+        frames = np.asarray(frames, dtype=np.float32)
+        if frames.ndim == 2:
+            frames = frames[np.newaxis]
+        self.last_frame_time = perf_counter()
+
+        if self.task == None:
+            self.raw_frames.extend(frames)
+            if len(self.raw_frames) < self.taskid_seconds * self.framerate:
+                return
+            self._identify_task()
+            frames = np.stack(self.raw_frames[-self.buffer_frames:])
+            self.raw_frames = []
+
+        self._source_preprocess(frames)
+
+        frames_since_update = self.buffer.frames_pushed - self.frames_at_last_update
+        if frames_since_update >= self.update_interval * self.framerate:
+            self._submit_update()
+
+    def _submit_update(self):
+        if self._update_future != None and not self._update_future.done():
+            return
+        if self.buffer == None or len(self.buffer) == 0:
+            return
+        self.frames_at_last_update = self.buffer.frames_pushed
+        window = self.buffer.latest(self.window_frames[self.task])
+        self._update_future = self._executor.submit(
+            self.update,
+            window,
+            self.buffer.frames_pushed,
+            self.last_frame_time)
+
+    def update(self, window, frames_pushed=None, frame_time=None):
+        """ Run the task networks on a window of preprocessed frames """
+        vid = itk.GetImageFromArray(window)
+        vid.SetSpacing(self.spacing)
+        vid.SetOrigin(self.origin)
+
+        with ARGUS_time_this("Stream Update", use_timer=self.debug):
+            self.steps["preprocess"](vid, crop_data=False)
+            if self.steps["ar_inference"] != None:
+                self.steps["ar_inference"]()
+            if self.steps["roi_preprocess"] != None:
+                self.steps["roi_preprocess"]()
+            self.steps["roi_inference"]()
+            decision, decision_confidence = self.steps["decision"]()
+
+        latency = None
+        if frame_time != None:
+            latency = perf_counter() - frame_time
+
+        result = dict(
+            decision = decision,
+            decision_confidence_0 = decision_confidence[0],
+            decision_confidence_1 = decision_confidence[1],
+            task_name = self.task,
+            task_confidence = self.task_confidence,
+            frames = frames_pushed,
+            window_frames = len(window),
+            latency = latency,
+        )
+        with self._lock:
+            self._result = result
+        return result
+
+    def current_decision(self):
+        """ Result of the most recent completed update (None before the first) """
+        with self._lock:
+            return self._result
+
+    def finish(self):
+        """ Run a final update on the newest frames and return its result """
+        if self.task == None and len(self.raw_frames) > 0:
+            self._identify_task()
+            self._source_preprocess(np.stack(self.raw_frames[-self.buffer_frames:]))
+            self.raw_frames = []
+        if self._update_future != None:
+            self._update_future.result()
+        if self.buffer != None and self.buffer.frames_pushed > self.frames_at_last_update:
+            self._submit_update()
+            self._update_future.result()
+        return self.current_decision()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+def ARGUS_replay_video(stream, filename, realtime=True):
+    """ Push the frames of a video file into stream at its native frame rate.
+
+    Returns the final result; its latency is the time from the last frame
+    to the decision being available.
+    """
+    container = av.open(filename)
+    try:
+        video = container.streams.video[0]
+        video.thread_type = 'AUTO'
+        framerate = float(video.average_rate)
+        stream.framerate = framerate
+
+        start = perf_counter()
+        for i,frame in enumerate(container.decode(video)):
+            if realtime:
+                delay = start + i/framerate - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            stream.push_frames(frame.to_ndarray(format='gray'))
+    finally:
+        container.close()
+
+    result = stream.finish()
+    if result != None:
+        print(f"   Prediction: {result['decision']}")
+        print(f"      Latency after last frame: {result['latency']}")
+    return result
@@ -3,37 +3,52 @@ import os
 from ARGUS_taskid_inference import ARGUS_taskid_inference
 
 class ARGUS_app_taskid:
-    def __init__(self, argus_dir=".", device_num=0, source=None):
+    def __init__(self, argus_dir=".", device_num=0, source=None, load_models=True):
         self.taskid = ARGUS_taskid_inference(
             config_file_name=os.path.join(argus_dir, "ARGUS_taskid.cfg"),
             network_name="final",
             device_num=device_num,
             source=source
         )
-        taskid_best_models = [0]
-        for r in range(self.taskid.num_models):
-            model_name = os.path.join(
-                argus_dir,
-                "Models",
-                "taskid_run"+str(r),
-                "best_model_"+str(taskid_best_models[r])+".pth"
-            )
-            self.taskid.load_model(r, model_name)
+        if load_models:
+            taskid_best_models = [0]
+            for r in range(self.taskid.num_models):
+                model_name = os.path.join(
+                    argus_dir,
+                    "Models",
+                    "taskid_run"+str(r),
+                    "best_model_"+str(taskid_best_models[r])+".pth"
+                )
+                self.taskid.load_model(r, model_name)
+        else:
+            # Random networks (benchmarking) also run in inference mode
+            for model in self.taskid.model:
+                model.eval()
             
         self.result = 0
         self.confidence = [0, 0, 0, 0]
             
-    def preprocess(self, vid_img):
+    def preprocess(self, vid_img, preprocess_cache=None, crop_data=True):
         self.taskid.preprocess(
             vid_img,
             lbl=None,
             slice_num=None,
+            crop_data=crop_data,
             scale_data=True,
-            rotate_data=False)
+            rotate_data=False,
+            preprocess_cache=preprocess_cache)
         
     def inference(self):
         self.result, self.confidence = self.taskid.inference()
         
     def decision(self):
         return self.result, self.confidence
+
+    def batch_process(self, vid_imgs, batch_size=None):
+        """ (task, confidence) for source-preprocessed videos, batched across videos """
+        input_tensors = []
+        for vid_img in vid_imgs:
+            self.preprocess(vid_img, crop_data=False)
+            input_tensors.append(self.taskid.input_tensor)
+        return self.taskid.batch_inference(input_tensors, batch_size)
         
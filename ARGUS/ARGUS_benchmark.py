@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+""" Synthetic-probe benchmark of ARGUS_app_ai.predict.
+
+Synthesizes Butterfly-, Sonosite- and Clarius-shaped videos (with rulers
+that the preprocessors detect), runs every task on them with randomly
+initialized networks of the shapes declared in the ARGUS_*.cfg files, and
+reports per-stage latency, throughput and peak memory (sampled per case
+with psutil, when installed).  No patient data or trained models are
+needed.
+
+Usage:
+    python ARGUS_benchmark.py --output results.json
+    python ARGUS_benchmark.py --save-baseline baseline.json
+    python ARGUS_benchmark.py --baseline baseline.json --threshold 0.1
+    python ARGUS_benchmark.py --tune-threads --threads 8 --tasks TaskId \
+        --write-threads-cfg ARGUS_threads.cfg
+
+With --baseline, metrics that are more than threshold slower (or larger)
+than the baseline are reported as regressions and the exit code is 1.
+
+With --tune-threads, every thread allocation of --threads cores (decoder
+threads x share of the concurrent task id stages) is benchmarked on the
+selected cases and the one with the lowest total latency is reported
+and, with --write-threads-cfg, saved as an ARGUS_threads.cfg.  Torch's
+inter-op pool can only be sized once per process, so it is tuned by
+rerunning with --interop-threads.
+"""
+
+import os
+import sys
+import json
+import argparse
+import platform
+import tempfile
+import threading
+
+from time import perf_counter
+
+import numpy as np
+
+import av
+
+import itk
+itk.force_load()
+
+import torch
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from ARGUS_app_ai import ARGUS_app_ai
+from ARGUS_Profiler import ARGUS_profiler
+from ARGUS_thread_budget import ARGUS_thread_budget
+
+# Frame size (y, x) of exported videos, imaging region bounds
+# [y_min, y_max, x_min, x_max], and ruler columns [x_min, x_max) and tick
+# rows, matching the ruler search of each source's preprocessor.
+synthetic_formats = dict(
+    Butterfly=dict(
+        shape=[1080, 1920],
+        region=[40, 1060, 460, 1460],
+        ruler_x=[1912, 1917],
+        ruler_y=[100 + 60*i for i in range(16)],
+    ),
+    Sonosite=dict(
+        shape=[1080, 1920],
+        region=[80, 1060, 200, 1700],
+        ruler_x=[8, 15],
+        # 17 tics, 54.4375 apart: 16 cm depth at zoom 1
+        ruler_y=[int(round(181 + 54.4375*i)) for i in range(17)],
+    ),
+    Clarius=dict(
+        shape=[1440, 2560],
+        region=[20, 1420, 1255, 2510],
+        ruler_x=[2520, 2527],
+        ruler_y=[60 + 80*i for i in range(16)],
+    ),
+)
+
+def ARGUS_synthetic_frames(source, num_frames=150, framerate=30, seed=0):
+    """ uint8 video (t, y, x) in the screen layout of source.
+
+    The imaging region holds a slowly drifting speckle field with moving
+    bright bands (pleura-like) and a pulsing dark disk (vessel-like), so
+    that temporal statistics are not trivial.
+    """
+    fmt = synthetic_formats[source]
+    rng = np.random.default_rng(seed)
+
+    size_y, size_x = fmt["shape"]
+    min_y, max_y, min_x, max_x = fmt["region"]
+    region_y = max_y - min_y
+    region_x = max_x - min_x
+
+    speckle = np.clip(rng.rayleigh(40, size=(region_y+64, region_x+64)), 12, 255)
+    yy, xx = np.mgrid[0:region_y, 0:region_x]
+
+    frames = np.zeros((num_frames, size_y, size_x), dtype=np.uint8)
+    for t in range(num_frames):
+        phase = 2 * np.pi * t / framerate
+        shift = int(16 + 16 * np.sin(phase / 3))
+        img = speckle[shift:shift+region_y, shift//2:shift//2+region_x].copy()
+        for band in range(3):
+            center = region_y * (0.3 + 0.2*band) + 10 * np.sin(phase + band)
+            img += 120 * np.exp(-((yy - center) / 6)**2)
+        radius = region_x * (0.08 + 0.02 * np.sin(phase))
+        disk = (yy - region_y*0.6)**2 + (xx - region_x*0.5)**2 < radius**2
+        img[disk] *= 0.2
+        img += rng.normal(0, 8, size=img.shape)
+        frames[t, min_y:max_y, min_x:max_x] = np.clip(img, 12, 255)
+
+        for tick in fmt["ruler_y"]:
+            frames[t, tick-1:tick+2, fmt["ruler_x"][0]:fmt["ruler_x"][1]] = 255
+
+    return frames
+
+def ARGUS_write_video(filename, frames, framerate=30):
+    """ Write uint8 frames (t, y, x) as a high quality H.264 mp4 """
+    container = av.open(filename, mode="w")
+    try:
+        stream = container.add_stream("libx264", rate=framerate)
+        stream.width = frames.shape[2]
+        stream.height = frames.shape[1]
+        stream.pix_fmt = "yuv420p"
+        stream.options = {"crf": "10"}
+        for frame in frames:
+            for packet in stream.encode(av.VideoFrame.from_ndarray(frame, format="gray")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    finally:
+        container.close()
+
+def synthetic_video_file(video_dir, source, num_frames, framerate, seed):
+    filename = os.path.join(
+        video_dir,
+        f"synthetic_{source}_{num_frames}f_{framerate}fps_s{seed}.mp4")
+    if not os.path.exists(filename):
+        print(f"Synthesizing {filename}")
+        ARGUS_write_video(
+            filename,
+            ARGUS_synthetic_frames(source, num_frames, framerate, seed),
+            framerate)
+    return filename
+
+def source_available(source):
+    if source == "Sonosite":
+        maps_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "linearization_maps_sonosite")
+        if not os.path.isdir(maps_dir):
+            print(f"Skipping Sonosite: {maps_dir} not found.")
+            return False
+    return True
+
+class ARGUS_rss_sampler():
+    """ Highest RSS of this process while the sampler is active.
+
+    The process peak (ru_maxrss) never decreases, so after the largest
+    case it would be reported for every later case of the benchmark;
+    sampling the current RSS every interval seconds gives each case its
+    own peak.  peak and increase (over the RSS at the start) are None
+    without psutil.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.start_rss = None
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        process = psutil.Process()
+        while True:
+            self.peak = max(self.peak, process.memory_info().rss)
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        if psutil != None:
+            self.start_rss = psutil.Process().memory_info().rss
+            self.peak = self.start_rss
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._thread != None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def increase(self):
+        if self.peak == None:
+            return None
+        return self.peak - self.start_rss
+
+def benchmark_case(app_ai, filename, source, task, framerate, repeats, device_num, num_threads,
+                   thread_budget=None):
+    """ Median per-stage latency, throughput and peak memory of predict() """
+    runs = []
+    for r in range(repeats+1):
+        profiler = ARGUS_profiler(memory=False)
+        with profiler, ARGUS_rss_sampler() as memory:
+            start = perf_counter()
+            result = app_ai.predict(filename,
+                                    source,
+                                    task=task,
+                                    stats=profiler,
+                                    device_num=device_num,
+                                    num_threads=num_threads,
+                                    thread_budget=thread_budget)
+            latency = perf_counter() - start
+        if result == None:
+            return dict(error="predict failed")
+        if r == 0:
+            # Warm-up: first-call allocations and lazy initialization
+            continue
+
+        stages = dict()
+        for entry in result["timeline"]:
+            stages[entry["name"]] = stages.get(entry["name"], 0) + entry["elapsed"]
+        runs.append(dict(
+            latency=latency,
+            stages=stages,
+            video_length=result["video_length"],
+            peak_memory=memory.peak,
+            peak_increase=memory.increase,
+        ))
+
+    latency = float(np.median([run["latency"] for run in runs]))
+    stage_names = sorted(set(name for run in runs for name in run["stages"]))
+    video_length = runs[0]["video_length"]
+    metrics = dict(
+        latency=latency,
+        stages={name: float(np.median([run["stages"].get(name, 0) for run in runs]))
+                for name in stage_names},
+        video_length=video_length,
+        realtime_factor=video_length / latency,
+        frames_per_second=video_length * framerate / latency,
+    )
+    peaks = [run["peak_memory"] for run in runs if run["peak_memory"] != None]
+    if len(peaks) > 0:
+        metrics["peak_memory"] = max(peaks)
+    increases = [run["peak_increase"] for run in runs if run["peak_increase"] != None]
+    if len(increases) > 0:
+        metrics["peak_increase"] = max(increases)
+    return metrics
+
+def thread_budget_candidates(num_threads, interop_threads=None):
+    """ Thread allocations of num_threads cores tried by --tune-threads """
+    decode_options = [None] + [n for n in [1, 2, 4, 8] if n <= num_threads]
+    fraction_options = [0.25, 0.5, 0.75, 1.0]
+    candidates = []
+    for decode_threads in decode_options:
+        for concurrent_fraction in fraction_options:
+            candidates.append(ARGUS_thread_budget(
+                num_threads=num_threads,
+                decode_threads=decode_threads,
+                interop_threads=interop_threads,
+                concurrent_fraction=concurrent_fraction))
+    return candidates
+
+def tune_thread_budget(app_ai, cases, framerate, repeats, device_num, num_threads,
+                       interop_threads=None):
+    """ Benchmark each candidate allocation on cases, a list of
+    (case, filename, source, task); returns the fastest budget and the
+    total latency of every candidate """
+    best = None
+    best_latency = None
+    trials = []
+    for budget in thread_budget_candidates(num_threads, interop_threads):
+        latency = 0
+        for case, filename, source, task in cases:
+            metrics = benchmark_case(
+                app_ai, filename, source, task, framerate, repeats, device_num,
+                None, thread_budget=budget)
+            if "error" in metrics:
+                print(f"   {case}: ERROR: {metrics['error']}")
+                latency = None
+                break
+            latency += metrics["latency"]
+        print(f"{budget}: {'failed' if latency == None else f'{latency:.3f}s'}")
+        trials.append(dict(budget=budget.state(), latency=latency))
+        if latency != None and (best_latency == None or latency < best_latency):
+            best = budget
+            best_latency = latency
+    return best, trials
+
+def compare_to_baseline(results, baseline, threshold, min_time=0.01):
+    """ List of (case, metric, baseline, current) that regressed """
+    regressions = []
+    for case, metrics in results["cases"].items():
+        base = baseline["cases"].get(case)
+        if base == None or "error" in metrics or "error" in base:
+            continue
+        checks = [("latency", base.get("latency"), metrics.get("latency"))]
+        for name, elapsed in base.get("stages", dict()).items():
+            # Very short stages are dominated by timer noise
+            if elapsed >= min_time:
+                checks.append((f"stage {name}", elapsed, metrics["stages"].get(name)))
+        checks.append(("peak_memory", base.get("peak_memory"), metrics.get("peak_memory")))
+        for metric, base_value, value in checks:
+            if base_value == None or value == None:
+                continue
+            if value > base_value * (1 + threshold):
+                regressions.append((case, metric, base_value, value))
+    return regressions
+
+def print_results(results):
+    print("")
+    print(f"{'Case':<20} {'Latency(s)':>11} {'xRealtime':>10} {'Frames/s':>9} {'PeakMB':>9}")
+    for case, metrics in results["cases"].items():
+        if "error" in metrics:
+            print(f"{case:<20} ERROR: {metrics['error']}")
+            continue
+        peak = metrics.get("peak_memory")
+        peak = "" if peak == None else f"{peak/2**20:.0f}"
+        print(f"{case:<20} {metrics['latency']:>11.3f} {metrics['realtime_factor']:>10.2f}"
+              f" {metrics['frames_per_second']:>9.1f} {peak:>9}")
+        for name, elapsed in metrics["stages"].items():
+            print(f"   {name:<30} {elapsed:>8.3f}")
+
+def prepare_argparser():
+    parser = argparse.ArgumentParser(description="ARGUS synthetic-probe benchmark")
+    parser.add_argument("--sources", nargs="+", default=ARGUS_app_ai.sources,
+                        choices=ARGUS_app_ai.sources)
+    parser.add_argument("--tasks", nargs="+", default=ARGUS_app_ai.tasks + ["TaskId"],
+                        choices=ARGUS_app_ai.tasks + ["TaskId"],
+                        help="TaskId runs predict() with task identification")
+    parser.add_argument("--frames", type=int, default=150)
+    parser.add_argument("--framerate", type=int, default=30)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--device", type=int, default=None)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--video-dir", default=None,
+                        help="Where synthetic videos are written and reused")
+    parser.add_argument("--output", default="ARGUS_benchmark_results.json")
+    parser.add_argument("--save-baseline", default=None)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--tune-threads", action="store_true",
+                        help="Search for the fastest thread allocation of --threads cores")
+    parser.add_argument("--interop-threads", type=int, default=None,
+                        help="Torch inter-op threads of this process")
+    parser.add_argument("--write-threads-cfg", default=None,
+                        help="With --tune-threads, save the fastest allocation to this cfg")
+    return parser
+
+def tune_threads(app_ai, video_dir, args):
+    num_threads = args.threads or os.cpu_count()
+    cases = []
+    for source in args.sources:
+        if not source_available(source):
+            continue
+        filename = synthetic_video_file(
+            video_dir, source, args.frames, args.framerate, args.seed)
+        for task in args.tasks:
+            cases.append((f"{source}/{task}", filename, source,
+                          None if task == "TaskId" else task))
+    print(f"Tuning the thread allocation of {num_threads} threads on {len(cases)} cases")
+    best, trials = tune_thread_budget(
+        app_ai, cases, args.framerate, args.repeats, args.device, num_threads,
+        args.interop_threads)
+    with open(args.output, "w") as fp:
+        json.dump(dict(
+            num_threads=num_threads,
+            cases=[case[0] for case in cases],
+            trials=trials,
+            best=None if best == None else best.state(),
+        ), fp, indent=1)
+    if best == None:
+        print("ERROR: Every thread allocation failed.")
+        return 1
+    print("")
+    print(f"Fastest: {best}")
+    if args.write_threads_cfg != None:
+        best.to_config(args.write_threads_cfg)
+        print(f"Wrote {args.write_threads_cfg}")
+    return 0
+
+def main(args):
+    argus_dir = os.path.dirname(os.path.abspath(__file__))
+    video_dir = args.video_dir
+    if video_dir == None:
+        video_dir = os.path.join(tempfile.gettempdir(), "ARGUS_benchmark")
+    os.makedirs(video_dir, exist_ok=True)
+
+    thread_budget = ARGUS_thread_budget(
+        num_threads=args.threads,
+        interop_threads=args.interop_threads)
+    app_ai = ARGUS_app_ai(argus_dir=argus_dir, load_models=False, thread_budget=thread_budget)
+
+    if args.tune_threads:
+        return tune_threads(app_ai, video_dir, args)
+
+    results = dict(
+        meta=dict(
+            platform=platform.platform(),
+            processor=platform.processor(),
+            cpu_count=os.cpu_count(),
+            python=platform.python_version(),
+            torch=torch.__version__,
+            itk=itk.Version.GetITKVersion(),
+            device=args.device,
+            threads=args.threads,
+            memory_sampling=psutil != None,
+            frames=args.frames,
+            framerate=args.framerate,
+            repeats=args.repeats,
+        ),
+        cases=dict(),
+    )
+    for source in args.sources:
+        if not source_available(source):
+            continue
+        filename = synthetic_video_file(
+            video_dir, source, args.frames, args.framerate, args.seed)
+        for task in args.tasks:
+            case = f"{source}/{task}"
+            print(f"Benchmarking {case}")
+            results["cases"][case] = benchmark_case(
+                app_ai,
+                filename,
+                source,
+                None if task == "TaskId" else task,
+                args.framerate,
+                args.repeats,
+                args.device,
+                args.threads)
+
+    print_results(results)
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=1)
+    if args.save_baseline != None:
+        with open(args.save_baseline, "w") as fp:
+            json.dump(results, fp, indent=1)
+
+    if args.baseline != None:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        print("")
+        if len(regressions) == 0:
+            print(f"No regressions beyond {args.threshold*100:.0f}%.")
+            return 0
+        print(f"REGRESSIONS beyond {args.threshold*100:.0f}%:")
+        for case, metric, base_value, value in regressions:
+            print(f"   {case:<20} {metric:<35} {base_value:12.4g} -> {value:12.4g}"
+                  f" (+{(value/base_value-1)*100:.0f}%)")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(prepare_argparser().parse_args()))
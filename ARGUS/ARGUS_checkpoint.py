@@ -0,0 +1,66 @@
+import os
+import random
+
+import numpy as np
+
+import torch
+
+from monai.transforms import Compose, Randomizable
+
+def _randomizable_transforms(transform):
+    transforms = transform.transforms if isinstance(transform, Compose) else [transform]
+    return [t for t in transforms if isinstance(t, Randomizable)]
+
+def ARGUS_rng_state(transforms=None):
+    """ Random states of python, numpy, torch (and CUDA) and of the
+    Randomizable transforms of a Compose """
+    state = dict(
+        python=random.getstate(),
+        numpy=np.random.get_state(),
+        torch=torch.get_rng_state(),
+    )
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    if transforms != None:
+        state["transforms"] = [t.R.get_state() for t in _randomizable_transforms(transforms)]
+    return state
+
+def ARGUS_set_rng_state(state, transforms=None):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    if transforms != None and "transforms" in state:
+        randomizable = _randomizable_transforms(transforms)
+        if len(randomizable) == len(state["transforms"]):
+            for t, t_state in zip(randomizable, state["transforms"]):
+                t.R.set_state(t_state)
+        else:
+            print("WARNING: Transforms changed since the checkpoint;"
+                  " their random states were not restored.")
+
+def ARGUS_save_checkpoint(filename, model, optimizer, state, transforms=None):
+    """ Write model, optimizer, RNG states and state (epoch, history, ...)
+    to filename.  The file is replaced atomically, so an interruption
+    leaves the previous checkpoint intact. """
+    checkpoint = dict(
+        model=model.state_dict(),
+        optimizer=optimizer.state_dict(),
+        rng=ARGUS_rng_state(transforms),
+        state=state,
+    )
+    torch.save(checkpoint, filename + ".tmp")
+    os.replace(filename + ".tmp", filename)
+
+def ARGUS_load_checkpoint(filename, model, optimizer, device, transforms=None):
+    """ Restore model, optimizer and RNG states; returns the saved state """
+    try:
+        # RNG states are not tensors, so the full unpickler is needed
+        checkpoint = torch.load(filename, map_location=device, weights_only=False)
+    except TypeError:
+        checkpoint = torch.load(filename, map_location=device)
+    model.load_state_dict(checkpoint["model"])
+    optimizer.load_state_dict(checkpoint["optimizer"])
+    ARGUS_set_rng_state(checkpoint["rng"], transforms)
+    return checkpoint["state"]
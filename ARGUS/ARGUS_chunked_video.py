@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+""" Chunked, random-access video files (.arv).
+
+Training data are stored as compressed float32 .mha volumes, so reading
+any window of frames decompresses the whole clip.  An .arv file holds the
+clip as uint8 with a scale/offset (exact for 0-255 ultrasound intensities
+and for label maps), compressed in independent chunks of frames_per_chunk
+frames, after a JSON header with the shape, ITK spacing/origin/direction,
+original pixel type and chunk offsets.  ARGUS_chunked_video memory maps the
+file and decompresses only the chunks a frame range touches.
+
+    magic (8 bytes) | header length (uint32) | header JSON | chunks...
+
+ARGUS_ChunkedVideoReader lets MONAI LoadImaged read .arv files (other
+files still go to its default readers).
+
+Usage:
+    python ARGUS_chunked_video.py convert ../PTX/Data_PTX/images ../PTX/Data_PTX/images_arv
+    python ARGUS_chunked_video.py benchmark ../PTX/Data_PTX/images/clip.mha ../PTX/Data_PTX/images_arv/clip.arv
+"""
+
+import os
+import sys
+import mmap
+import json
+import zlib
+import struct
+import argparse
+
+from glob import glob
+from time import perf_counter
+from collections import OrderedDict
+
+import numpy as np
+
+import itk
+
+from monai.data import ImageReader
+
+arv_magic = b"ARGUSVC1"
+arv_version = 1
+arv_suffix = ".arv"
+
+def _uint8_mapping(array, lossy=False):
+    """ (scale, offset) such that array == stored*scale + offset, stored in uint8 """
+    min_value = float(array.min()) if array.size > 0 else 0.0
+    max_value = float(array.max()) if array.size > 0 else 0.0
+    integral = np.array_equal(array, np.round(array))
+    if integral and min_value >= 0 and max_value <= 255:
+        return 1.0, 0.0
+    if integral and max_value - min_value <= 255:
+        return 1.0, min_value
+    if not lossy:
+        raise ValueError(f"Values in [{min_value}, {max_value}] do not fit"
+                         f" in uint8 exactly; use lossy=True to quantize.")
+    scale = (max_value - min_value) / 255 if max_value > min_value else 1.0
+    return scale, min_value
+
+def ARGUS_write_chunked_video(filename,
+                              array,
+                              spacing=(1, 1, 1),
+                              origin=(0, 0, 0),
+                              direction=None,
+                              frames_per_chunk=8,
+                              compression_level=6,
+                              lossy=False):
+    """ Write a (t, y, x) array with ITK (x, y, t) spacing as an .arv file.
+
+    Returns the largest absolute quantization error (0 unless lossy).
+    """
+    array = np.asarray(array)
+    scale, offset = _uint8_mapping(array, lossy)
+    stored = np.clip(np.round((array.astype(np.float64) - offset) / scale), 0, 255).astype(np.uint8)
+    error = float(np.abs(stored * scale + offset - array).max()) if array.size > 0 else 0.0
+    if direction is None:
+        direction = np.eye(3)
+
+    chunks = [zlib.compress(np.ascontiguousarray(stored[i:i+frames_per_chunk]).tobytes(),
+                            compression_level)
+              for i in range(0, stored.shape[0], frames_per_chunk)]
+    header = dict(
+        version=arv_version,
+        shape=list(stored.shape),
+        dtype=str(array.dtype),
+        scale=scale,
+        offset=offset,
+        spacing=[float(x) for x in spacing],
+        origin=[float(x) for x in origin],
+        direction=np.asarray(direction, dtype=float).tolist(),
+        frames_per_chunk=frames_per_chunk,
+        chunk_lengths=[len(c) for c in chunks],
+    )
+    header = json.dumps(header).encode("utf-8")
+
+    with open(filename + ".tmp", "wb") as fp:
+        fp.write(arv_magic)
+        fp.write(struct.pack("<I", len(header)))
+        fp.write(header)
+        for chunk in chunks:
+            fp.write(chunk)
+    os.replace(filename + ".tmp", filename)
+    return error
+
+def ARGUS_write_chunked_image(filename, img, **kwargs):
+    """ Write a 3D itk image (x, y, t) as an .arv file """
+    return ARGUS_write_chunked_video(
+        filename,
+        itk.GetArrayViewFromImage(img),
+        spacing=list(img.GetSpacing()),
+        origin=list(img.GetOrigin()),
+        direction=itk.GetArrayFromMatrix(img.GetDirection()),
+        **kwargs)
+
+class ARGUS_chunked_video():
+    """ Random access to the frames of an .arv file.
+
+    Chunks are decompressed on demand from a memory map of the file; the
+    most recently used cache_chunks chunks are kept, so overlapping
+    windows (sliding window training data generation) decompress each
+    chunk once.  bytes_read counts the compressed bytes touched.
+    """
+
+    def __init__(self, filename, cache_chunks=8):
+        self.filename = filename
+        self.cache_chunks = cache_chunks
+        self._file = open(filename, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[:len(arv_magic)] != arv_magic:
+            self.close()
+            raise ValueError(f"{filename} is not an ARGUS chunked video.")
+        header_length = struct.unpack("<I", self._map[8:12])[0]
+        self.header = json.loads(self._map[12:12+header_length].decode("utf-8"))
+        if self.header["version"] > arv_version:
+            self.close()
+            raise ValueError(f"{filename} has unsupported version {self.header['version']}.")
+
+        self.shape = tuple(self.header["shape"])
+        self.num_frames = self.shape[0]
+        self.spacing = self.header["spacing"]
+        self.origin = self.header["origin"]
+        self.direction = np.array(self.header["direction"])
+        self.dtype = np.dtype(self.header["dtype"])
+        self.frames_per_chunk = self.header["frames_per_chunk"]
+
+        self._offsets = np.cumsum([12 + header_length] + self.header["chunk_lengths"])
+        self._chunks = OrderedDict()
+        self.bytes_read = 12 + header_length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if getattr(self, "_map", None) != None:
+            self._map.close()
+            self._map = None
+        if getattr(self, "_file", None) != None:
+            self._file.close()
+            self._file = None
+
+    def _chunk(self, num):
+        chunk = self._chunks.get(num)
+        if chunk is not None:
+            self._chunks.move_to_end(num)
+            return chunk
+        start, end = self._offsets[num], self._offsets[num+1]
+        self.bytes_read += int(end - start)
+        chunk = np.frombuffer(zlib.decompress(self._map[start:end]), dtype=np.uint8)
+        chunk = chunk.reshape((-1,) + self.shape[1:])
+        self._chunks[num] = chunk
+        while len(self._chunks) > self.cache_chunks:
+            self._chunks.popitem(last=False)
+        return chunk
+
+    def read(self, start=0, stop=None, dtype=None):
+        """ Frames [start, stop) as a (t, y, x) array.
+
+        dtype defaults to the pixel type of the original volume.
+        """
+        if stop == None or stop > self.num_frames:
+            stop = self.num_frames
+        start = max(0, start)
+        if dtype == None:
+            dtype = self.dtype
+        out = np.empty((max(0, stop-start),) + self.shape[1:], dtype=dtype)
+        scale = self.header["scale"]
+        offset = self.header["offset"]
+        for num in range(start // self.frames_per_chunk,
+                         (stop-1) // self.frames_per_chunk + 1 if stop > start else 0):
+            chunk = self._chunk(num)
+            chunk_start = num * self.frames_per_chunk
+            lo = max(start, chunk_start)
+            hi = min(stop, chunk_start + len(chunk))
+            frames = chunk[lo-chunk_start:hi-chunk_start]
+            if scale != 1 or offset != 0:
+                frames = frames * scale + offset
+            out[lo-start:hi-start] = frames
+        return out
+
+    def image(self, start=0, stop=None, pixel_type=itk.F):
+        """ Frames [start, stop) as a 3D itk image (itk.F or itk.SS) with matching origin """
+        dtype = np.float32
+        if pixel_type == itk.SS:
+            dtype = np.int16
+        array = self.read(start, stop, dtype=dtype)
+        img = itk.GetImageFromArray(array)
+        img.SetSpacing(self.spacing)
+        origin = np.array(self.origin) + self.direction[:, 2] * self.spacing[2] * max(0, start)
+        img.SetOrigin([float(x) for x in origin])
+        img.SetDirection(itk.GetMatrixFromArray(self.direction))
+        return img
+
+def ARGUS_is_chunked_video(filename):
+    return str(filename).endswith(arv_suffix)
+
+class ARGUS_ChunkedVideoReader(ImageReader):
+    """ MONAI ImageReader for .arv files, for LoadImage(d)(reader=...).
+
+    Returns arrays in the (x, y, t) order of MONAI's ITKReader, so that
+    the trainers' AsChannelFirstd/Resized chains are unchanged.
+    """
+
+    def verify_suffix(self, filename):
+        filenames = filename if isinstance(filename, (list, tuple)) else [filename]
+        return all(ARGUS_is_chunked_video(f) for f in filenames)
+
+    def read(self, data, **kwargs):
+        filenames = data if isinstance(data, (list, tuple)) else [data]
+        videos = []
+        for filename in filenames:
+            with ARGUS_chunked_video(str(filename)) as video:
+                array = video.read(dtype=np.float32)
+                videos.append((array, video.spacing, video.origin, video.direction, str(filename)))
+        return videos if len(videos) > 1 else videos[0]
+
+    def get_data(self, img):
+        videos = img if isinstance(img, list) else [img]
+        arrays = []
+        meta = dict()
+        for array, spacing, origin, direction, filename in videos:
+            arrays.append(array.T)
+            affine = np.eye(4)
+            affine[:3, :3] = direction @ np.diag(spacing)
+            affine[:3, 3] = origin
+            meta = dict(
+                filename_or_obj=filename,
+                spacing=np.array(spacing),
+                affine=affine,
+                original_affine=affine.copy(),
+                spatial_shape=np.array(array.T.shape),
+                original_channel_dim="no_channel",
+            )
+        if len(arrays) > 1:
+            return np.stack(arrays), meta
+        return arrays[0], meta
+
+def ARGUS_convert_to_chunked(input_dir,
+                             output_dir,
+                             pattern="*.mha",
+                             frames_per_chunk=8,
+                             lossy=False,
+                             overwrite=False):
+    """ Convert every image matching pattern in input_dir to .arv in output_dir """
+    os.makedirs(output_dir, exist_ok=True)
+    filenames = sorted(glob(os.path.join(input_dir, pattern)))
+    for num, filename in enumerate(filenames):
+        out_filename = os.path.join(
+            output_dir,
+            os.path.splitext(os.path.basename(filename))[0] + arv_suffix)
+        if os.path.exists(out_filename) and not overwrite:
+            continue
+        img = itk.imread(filename)
+        error = ARGUS_write_chunked_image(
+            out_filename,
+            img,
+            frames_per_chunk=frames_per_chunk,
+            lossy=lossy)
+        in_size = os.path.getsize(filename)
+        out_size = os.path.getsize(out_filename)
+        print(f"{num+1}/{len(filenames)}: {os.path.basename(out_filename)}"
+              f" {in_size/2**20:.1f} MB -> {out_size/2**20:.1f} MB"
+              + (f" (max error {error:.3g})" if error > 0 else ""))
+    return len(filenames)
+
+def ARGUS_benchmark_chunked(mha_filename, arv_filename, num_slices=32, repeats=5):
+    """ Bytes read and latency of one num_slices window: .mha vs .arv """
+    results = dict()
+
+    start = perf_counter()
+    for r in range(repeats):
+        img = itk.imread(mha_filename)
+        array = itk.GetArrayViewFromImage(img)
+        np.array(array[array.shape[0]//2:array.shape[0]//2+num_slices])
+    results["mha"] = dict(
+        bytes=os.path.getsize(mha_filename),
+        latency=(perf_counter() - start) / repeats)
+
+    bytes_read = 0
+    start = perf_counter()
+    for r in range(repeats):
+        with ARGUS_chunked_video(arv_filename) as video:
+            video.read(video.num_frames//2, video.num_frames//2+num_slices)
+            bytes_read = video.bytes_read
+    results["arv_window"] = dict(
+        bytes=bytes_read,
+        latency=(perf_counter() - start) / repeats)
+
+    start = perf_counter()
+    for r in range(repeats):
+        with ARGUS_chunked_video(arv_filename) as video:
+            video.read()
+            bytes_read = video.bytes_read
+    results["arv_clip"] = dict(
+        bytes=bytes_read,
+        latency=(perf_counter() - start) / repeats)
+
+    for name, result in results.items():
+        print(f"{name:<12} {result['bytes']/2**20:9.2f} MB {result['latency']*1000:9.1f} ms")
+    return results
+
+def prepare_argparser():
+    parser = argparse.ArgumentParser(description="ARGUS chunked video files")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="Convert a directory of volumes to .arv")
+    convert.add_argument("input_dir")
+    convert.add_argument("output_dir")
+    convert.add_argument("--pattern", default="*.mha")
+    convert.add_argument("--frames-per-chunk", type=int, default=8)
+    convert.add_argument("--lossy", action="store_true",
+                         help="Quantize volumes that are not exactly uint8 representable")
+    convert.add_argument("--overwrite", action="store_true")
+
+    benchmark = commands.add_parser("benchmark", help="Compare window reads of .mha and .arv")
+    benchmark.add_argument("mha_filename")
+    benchmark.add_argument("arv_filename")
+    benchmark.add_argument("--num-slices", type=int, default=32)
+    benchmark.add_argument("--repeats", type=int, default=5)
+    return parser
+
+def main(args):
+    if args.command == "convert":
+        ARGUS_convert_to_chunked(
+            args.input_dir,
+            args.output_dir,
+            args.pattern,
+            args.frames_per_chunk,
+            args.lossy,
+            args.overwrite)
+    else:
+        ARGUS_benchmark_chunked(
+            args.mha_filename,
+            args.arv_filename,
+            args.num_slices,
+            args.repeats)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(prepare_argparser().parse_args()))
@@ -23,11 +23,11 @@ from monai.transforms import (
     ToTensor,
 )
 
-from monai.visualize import GradCAMpp
-from monai.visualize import OcclusionSensitivity
-
 from ARGUS_Transforms import *
 
+from ARGUS_Profiler import ARGUS_profiled
+from ARGUS_explain import ARGUS_explainer
+
 class ARGUS_classification_inference:
     def __init__(self, config_file_name, network_name="final", device_num=0):
  
@@ -73,11 +73,30 @@ class ARGUS_classification_inference:
             self.reduce_to_statistics = True   
             self.net_in_channels = 12
             
-        self.model = [monai.networks.nets.DenseNet121(
-            spatial_dims=self.net_in_dims,
-            in_channels=self.net_in_channels,
-            out_channels=self.num_classes,
-        ).to(self.device)] * self.num_models
+        # A single distilled student (see ARGUS_distillation.py) can be
+        # deployed in place of the ensemble; it may be a narrower DenseNet
+        self.student_init_features = 64
+        if config.has_option(network_name, 'student_init_features'):
+            self.student_init_features = int(config[network_name]['student_init_features'])
+        self.student_growth_rate = 32
+        if config.has_option(network_name, 'student_growth_rate'):
+            self.student_growth_rate = int(config[network_name]['student_growth_rate'])
+        self.use_student = False
+        if config.has_option(network_name, 'use_student'):
+            self.use_student = config[network_name]['use_student'] == "True"
+        self.student_model_file = None
+        if config.has_option(network_name, 'student_model_file'):
+            self.student_model_file = config[network_name]['student_model_file']
+
+        if self.use_student:
+            self.num_models = 1
+            self.model = [self.student_model()]
+        else:
+            self.model = [monai.networks.nets.DenseNet121(
+                spatial_dims=self.net_in_dims,
+                in_channels=self.net_in_channels,
+                out_channels=self.num_classes,
+            ).to(self.device)] * self.num_models
         
         # preload itk libs
         ImageF = itk.Image[itk.F, 3]
@@ -127,10 +146,22 @@ class ARGUS_classification_inference:
             out_channels=self.num_classes,
         ).to(self.device)
         
+    def student_model(self):
+        """ DenseNet121 with the student's width """
+        return monai.networks.nets.DenseNet(
+            spatial_dims=self.net_in_dims,
+            in_channels=self.net_in_channels,
+            out_channels=self.num_classes,
+            init_features=self.student_init_features,
+            growth_rate=self.student_growth_rate,
+            block_config=(6, 12, 24, 16),
+        ).to(self.device)
+
     def load_model(self, model_num, filename):
         self.model[model_num].load_state_dict(torch.load(filename, map_location=self.device))
         self.model[model_num].eval()
         
+    @ARGUS_profiled
     def generate_roi(self, ar_image, ar_array, ar_labels):
         roi_min_x = 0
         roi_max_x = ar_labels.shape[1]-1
@@ -214,6 +245,12 @@ class ARGUS_classification_inference:
         self.model[model_num].load_state_dict(torch.load(filename, map_location=self.device))
         self.model[model_num].eval()
 
+    def source_preprocess(self, preprocessor, vid_img, preprocess_cache=None):
+        if preprocess_cache != None:
+            return preprocess_cache.process(preprocessor, vid_img)
+        return preprocessor.process(vid_img)
+
+    @ARGUS_profiled
     def preprocess(self, vid_img, lbl_img=None, slice_num=None, scale_data=True, rotate_data=True):
         ImageF = itk.Image[itk.F, 3]
         ImageSS = itk.Image[itk.SS, 3]
@@ -332,49 +369,67 @@ class ARGUS_classification_inference:
         class_num = np.argmax(run_output, axis=0)
         return class_num
     
-    def inference(self):
-        prob_total = np.zeros(self.num_classes)
+    @ARGUS_profiled
+    def batch_probabilities(self, input_tensors, batch_size=None):
+        """ Ensemble-averaged probabilities for a list of input tensors,
+        running each model once per batch of up to batch_size inputs """
+        prob_totals = [np.zeros(self.num_classes) for i in range(len(input_tensors))]
+        if batch_size == None:
+            batch_size = len(input_tensors)
         with torch.no_grad():
-            for run_num in range(self.num_models):
-                run_output = self.model[run_num](self.input_tensor[0].to(self.device))
-                prob = self.clean_probabilities(run_output[0].cpu().detach().numpy())
-                prob_total += prob
-        prob_total /= self.num_models
-        prob = self.clean_probabilities(prob_total)
-        classification = self.classify_probabilities(prob)
-        return int(classification), prob
+            for batch_min in range(0, len(input_tensors), batch_size):
+                batch_tensors = input_tensors[batch_min:batch_min+batch_size]
+                batch = torch.cat([t[0] for t in batch_tensors]).to(self.device)
+                for run_num in range(self.num_models):
+                    run_output = self.model[run_num](batch).cpu().detach().numpy()
+                    for i in range(len(batch_tensors)):
+                        prob = self.clean_probabilities(run_output[i])
+                        prob_totals[batch_min+i] += prob
+        for prob_total in prob_totals:
+            prob_total /= self.num_models
+        return prob_totals
 
-    def gradcam(self, runs=None):
-        if runs == None:
-            runs = range(self.num_models)
-        target_layers = ["class_layers.relu"]
-        for i,run_num in enumerate(runs):
-            if i == 0:
-                cam = GradCAMpp(nn_module=self.model[run_num], target_layers=target_layers)
-                results = np.abs(cam(x=self.input_tensor[0].to(self.device), class_idx=1).cpu().detach().numpy())
-            else:
-                cam = GradCAMpp(nn_module=self.model[run_num], target_layers=target_layers)
-                results += np.abs(cam(x=self.input_tensor[0].to(self.device), class_idx=1).cpu().detach().numpy())
-        results /= len(runs)
-        return self.input_tensor[0], results
-    
-    def occlusion_sensitivity(self, runs=None, mask_size=16):
+    @ARGUS_profiled
+    def batch_inference(self, input_tensors, batch_size=None):
+        """ (classification, probabilities) for a list of input tensors """
+        results = []
+        for prob_total in self.batch_probabilities(input_tensors, batch_size):
+            prob = self.clean_probabilities(prob_total)
+            classification = self.classify_probabilities(prob)
+            results.append((int(classification), prob))
+        return results
+
+    def inference(self):
+        return self.batch_inference([self.input_tensor])[0]
+
+    def explainer(self, runs=None):
+        """ ARGUS_explainer of the models runs (default all) """
         if runs == None:
             runs = range(self.num_models)
-        target_layers = ["class_layers.relu"]
-        for i,run_num in enumerate(runs):
-            if i == 0:
-                occ_sens = OcclusionSensitivity(nn_module=self.model[run_num], mask_size=mask_size) #, mode='mean_patch')
-                tmp_occ_map, tmp_occ_class = occ_sens(x=self.input_tensor[0].to(self.device)) #,
-                                                        #b_box=[10, 240, 10, 240], mask_size=mask_size)
-                occ_map = tmp_occ_map.cpu().detach().numpy()
-                occ_class = tmp_occ_class.cpu().detach().numpy()
-            else:
-                occ_sens = OcclusionSensitivity(nn_module=self.model[run_num], mask_size=mask_size) #, mode='mean_patch')
-                tmp_occ_map, tmp_occ_class = occ_sens(x=self.input_tensor[0].to(self.device)) #,
-                                                        #b_box=[10, 240, 10, 240], mask_size=mask_size)
-                occ_map += tmp_occ_map.cpu().detach().numpy()
-                occ_class += tmp_occ_class.cpu().detach().numpy()
-        occ_map /= len(runs)
-        return self.input_tensor[0], occ_map,occ_class
+        return ARGUS_explainer([self.model[run_num] for run_num in runs], self.device)
+
+    def gradcam(self, runs=None, input_tensor=None, class_idx=1):
+        """ GradCAM++ of class_idx for input_tensor (default the current
+        input_tensor), averaged over the models runs; all models are
+        evaluated in one pass """
+        if input_tensor is None:
+            input_tensor = self.input_tensor
+        cams = self.explainer(runs).gradcam(input_tensor[0], class_idx)
+        return input_tensor[0], np.abs(cams).mean(axis=0)
+
+    def occlusion_sensitivity(self, runs=None, mask_size=16, stride=None, b_box=None,
+                              batch_size=64, input_tensor=None):
+        """ Occlusion sensitivity of the ensemble of runs for input_tensor
+        (default the current input_tensor).  The fill, mask placement and
+        class map differ from the MONAI OcclusionSensitivity used before;
+        see ARGUS_explainer.occlusion_sensitivity. """
+        if input_tensor is None:
+            input_tensor = self.input_tensor
+        occ_map, occ_class = self.explainer(runs).occlusion_sensitivity(
+            input_tensor[0],
+            mask_size=mask_size,
+            stride=stride,
+            b_box=b_box,
+            batch_size=batch_size)
+        return input_tensor[0], occ_map, occ_class
         
\ No newline at end of file
@@ -15,7 +15,6 @@ from monai.transforms import (
     ToTensord,
 )
 from monai.data import (
-    PersistentDataset,
     CacheDataset,
     DataLoader,
     Dataset,
@@ -24,6 +23,7 @@ from monai.data import (
 )
 
 import torch
+from torch.utils.data import DistributedSampler
 
 import os
 import json
@@ -33,8 +33,6 @@ import configparser
 
 import random
 
-import pathlib
-
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.ndimage import rotate
@@ -43,6 +41,19 @@ import itk
 from itk import TubeTK as tube
 
 from ARGUS_Transforms import ARGUS_RandSpatialCropSlicesd
+from ARGUS_chunked_video import ARGUS_ChunkedVideoReader
+from ARGUS_feature_store import ARGUS_FeatureStoreDataset
+from ARGUS_distillation import ARGUS_teacher_ensemble, ARGUS_distillation_loss
+from ARGUS_validation_schedule import ARGUS_validation_schedule
+from ARGUS_fold_manifest import ARGUS_write_fold_manifest, ARGUS_load_fold_manifest
+from ARGUS_cotraining import (ARGUS_split_member_transforms, ARGUS_member_augmentation,
+                              ARGUS_ensemble_member)
+from ARGUS_distributed import (ARGUS_distributed_world_size, ARGUS_distributed_rank,
+                               ARGUS_is_main_rank,
+                               ARGUS_distributed_model, ARGUS_distributed_mean,
+                               ARGUS_distributed_broadcast_flag,
+                               ARGUS_distributed_seed_transforms)
+from ARGUS_shared_cache import ARGUS_SharedPersistentDataset, ARGUS_print_cache_report
 from ARGUS_classification_inference import ARGUS_classification_inference
 
 class ARGUS_classification_train(ARGUS_classification_inference):
@@ -69,19 +80,60 @@ class ARGUS_classification_train(ARGUS_classification_inference):
         self.refold_interval = int(config[network_name]['refold_interval'])
         
         self.validation_interval = int(config[network_name]['validation_interval'])
+        # Epochs between full (resumable) checkpoints
+        self.checkpoint_interval = 10
+        if config.has_option(network_name, 'checkpoint_interval'):
+            self.checkpoint_interval = int(config[network_name]['checkpoint_interval'])
         
         self.class_fileprefix = json.loads(config[network_name]['class_fileprefix'])
         self.class_labels = json.loads(config[network_name]['class_labels'])
 
         self.results_filename_base = config[network_name]['results_filename_base']
         self.results_dirname = config[network_name]['results_dirname']
+
+        # The fold split is saved to (and then loaded from) this manifest;
+        # see ARGUS_fold_manifest.py
+        self.fold_manifest = None
+        if config.has_option(network_name, 'fold_manifest'):
+            self.fold_manifest = config[network_name]['fold_manifest']
+        # Settings of the current split; see vfold_settings()
+        self.fold_settings = None
         
         tmp_str = config[network_name]['use_persistent_cache']
         self.use_persistent_cache = False
         if tmp_str == "True":
             self.use_persistent_cache = True
+        # One content-addressed cache is shared by all folds, runs and splits
+        self.persistent_cache_dir = os.path.join(".", "data_cache", network_name)
+        if config.has_option(network_name, 'persistent_cache_dir'):
+            self.persistent_cache_dir = config[network_name]['persistent_cache_dir']
+        # Precomputed statistics (see ARGUS_feature_store.py) replace the
+        # cached datasets when given
+        self.feature_store_dir = None
+        if config.has_option(network_name, 'feature_store_dir'):
+            self.feature_store_dir = config[network_name]['feature_store_dir']
         
+        # Distillation: the model is trained as a student of the ensemble
+        # in distill_teacher_files (paths relative to the cfg file); see
+        # ARGUS_distillation.py
+        self.distill_teacher_files = []
+        if config.has_option(network_name, 'distill_teacher_files'):
+            self.distill_teacher_files = [
+                os.path.join(os.path.dirname(config_file_name), x)
+                for x in json.loads(config[network_name]['distill_teacher_files'])]
+        self.distill_temperature = 1.0
+        if config.has_option(network_name, 'distill_temperature'):
+            self.distill_temperature = float(config[network_name]['distill_temperature'])
+        self.distill_alpha = 1.0
+        if config.has_option(network_name, 'distill_alpha'):
+            self.distill_alpha = float(config[network_name]['distill_alpha'])
+
         self.max_epochs = int(config[network_name]['max_epochs'])
+
+        # Early stopping and adaptive validation (off unless set in the cfg);
+        # the warm-up defaults to that of best model selection
+        self.validation_schedule_options = ARGUS_validation_schedule.config_options(
+            config, network_name, self.max_epochs // 5)
         
         tmp_str = config[network_name]['already_preprocessed']
         self.already_preprocessed = False
@@ -100,13 +152,31 @@ class ARGUS_classification_train(ARGUS_classification_inference):
         self.num_workers_test = 1
         self.batch_size_test = 1
 
+        # Loader settings can be tuned per machine (see ARGUS_train_benchmark.py)
+        for name in ["num_workers_train", "batch_size_train",
+                     "num_workers_val", "batch_size_val",
+                     "num_workers_test", "batch_size_test"]:
+            if config.has_option(network_name, name):
+                setattr(self, name, int(config[network_name][name]))
+
+        # Windows cropped from each loaded training video; a batch of
+        # batch_size_train samples then comes from fewer videos
+        self.num_samples_train = 1
+        if config.has_option(network_name, 'num_samples_train'):
+            self.num_samples_train = int(config[network_name]['num_samples_train'])
+
         self.all_train_images = []
         self.all_train_labels = []
 
+        # Per-member augmentation of co-trained runs (setup_training_vfold)
+        self.member_augmentation = None
+
         if self.already_preprocessed:
+            # Preprocessed files are single samples
+            self.num_samples_train = 1
             self.train_transforms = Compose(
                 [
-                    LoadImaged(keys=["image"]),
+                    LoadImaged(keys=["image"], reader=ARGUS_ChunkedVideoReader()),
                     AsChannelFirstd(keys=["image"]),
                     RandFlipd(prob=0.5, spatial_axis=1, keys=["image"]),
                     RandZoomd(prob=0.5, 
@@ -120,14 +190,14 @@ class ARGUS_classification_train(ARGUS_classification_inference):
             )
             self.val_transforms = Compose(
                 [
-                    LoadImaged(keys=["image"]),
+                    LoadImaged(keys=["image"], reader=ARGUS_ChunkedVideoReader()),
                     AsChannelFirstd(keys=["image"]),
                     ToTensord(keys=["image"], dtype=torch.float),
                 ]
             )
             self.test_transforms = Compose(
                 [
-                    LoadImaged(keys=["image"]),
+                    LoadImaged(keys=["image"], reader=ARGUS_ChunkedVideoReader()),
                     AsChannelFirstd(keys=["image"]),
                     ToTensord(keys=["image"], dtype=torch.float),
                 ]
@@ -135,13 +205,24 @@ class ARGUS_classification_train(ARGUS_classification_inference):
         else:
             self.train_transforms = Compose(
                 [
-                    LoadImaged(keys=["image"]),
+                    LoadImaged(keys=["image"], reader=ARGUS_ChunkedVideoReader()),
                     AsChannelFirstd(keys=["image"]),
                     Resized(
                         spatial_size=[self.size_y,self.size_x],
                         mode=['bilinear'],
                         keys=["image"],
                     ),
+                    # Pick the window before rotating, so only num_slices
+                    # frames are rotated.  Rotation is per-frame, so samples
+                    # have the same distribution as rotating the whole video
+                    # and then cropping (seeded runs draw different ones).
+                    ARGUS_RandSpatialCropSlicesd(
+                        num_slices=self.num_slices,
+                        axis=0,
+                        reduce_to_statistics=False,
+                        num_samples=self.num_samples_train,
+                        keys=["image"],
+                    ),
                     RandRotated(prob=0.2,
                         range_z=0.15,
                         keep_size=True,
@@ -149,6 +230,7 @@ class ARGUS_classification_train(ARGUS_classification_inference):
                     ),
                     ARGUS_RandSpatialCropSlicesd(
                         num_slices=self.num_slices,
+                        center_slice=self.num_slices//2,
                         axis=0,
                         reduce_to_statistics=self.reduce_to_statistics,
                         extended=self.reduce_to_statistics,
@@ -168,7 +250,7 @@ class ARGUS_classification_train(ARGUS_classification_inference):
             )
             self.val_transforms = Compose(
                 [
-                    LoadImaged(keys=["image"]),
+                    LoadImaged(keys=["image"], reader=ARGUS_ChunkedVideoReader()),
                     AsChannelFirstd(keys=["image"]),
                     Resized(
                         spatial_size=[self.size_y,self.size_x],
@@ -189,7 +271,7 @@ class ARGUS_classification_train(ARGUS_classification_inference):
             )
             self.test_transforms = Compose(
                 [
-                    LoadImaged(keys=["image"]),
+                    LoadImaged(keys=["image"], reader=ARGUS_ChunkedVideoReader()),
                     AsChannelFirstd(keys=["image"]),
                     Resized(
                         spatial_size=[self.size_y,self.size_x],
@@ -211,13 +293,49 @@ class ARGUS_classification_train(ARGUS_classification_inference):
             )
 
     def init_model(self, model_num):
+        if len(self.distill_teacher_files) > 0:
+            self.model[model_num] = self.student_model()
+            return
         self.model[model_num] = monai.networks.nets.DenseNet121(
             spatial_dims=self.net_in_dims,
             in_channels=self.net_in_channels,
             out_channels=self.num_classes,
         ).to(self.device)
 
-    def setup_vfold_files(self):
+    def teacher_model(self):
+        """ A new model of the ensemble architecture """
+        return monai.networks.nets.DenseNet121(
+            spatial_dims=self.net_in_dims,
+            in_channels=self.net_in_channels,
+            out_channels=self.num_classes,
+        ).to(self.device)
+
+    def vfold_settings(self):
+        """ The settings the fold split depends on, from the current
+        attributes (the select scripts change them after construction) """
+        return dict(
+            image_dirname=self.image_dirname,
+            image_filesuffix=self.image_filesuffix,
+            class_fileprefix=list(self.class_fileprefix),
+            train_data_portion=self.train_data_portion,
+            validation_data_portion=self.validation_data_portion,
+            test_data_portion=self.test_data_portion,
+            num_folds=self.num_folds,
+            randomize_folds=self.randomize_folds,
+        )
+
+    def setup_vfold_files(self, use_manifest=True):
+        """ Assign the files to folds, or load the assignment from
+        fold_manifest.  use_manifest=False recomputes it without reading or
+        writing the manifest (refolding).  Raises
+        ARGUS_fold_manifest_mismatch if the manifest was made with other
+        settings. """
+        self.fold_settings = self.vfold_settings()
+        if (use_manifest and self.fold_manifest != None
+                and os.path.exists(self.fold_manifest)):
+            ARGUS_load_fold_manifest(self, self.fold_manifest)
+            return
+
         all_train_images = []
         for dirname in self.image_dirname:
             all_train_images = all_train_images + sorted(glob(os.path.join(dirname, self.image_filesuffix)))
@@ -325,46 +443,92 @@ class ARGUS_classification_train(ARGUS_classification_inference):
             #print( "   VAL", self.val_files[i])
             #print( "   TEST", self.test_files[i])
 
-    def setup_training_vfold(self, vfold_num, run_num):
+        if use_manifest and self.fold_manifest != None:
+            if not ARGUS_write_fold_manifest(self, self.fold_manifest):
+                # Another job wrote it first; use its split
+                ARGUS_load_fold_manifest(self, self.fold_manifest)
+
+    def setup_training_vfold(self, vfold_num, run_num=0, num_members=1,
+                             keep_augmentation=False):
+        """ num_members > 1 sets up a loader shared by that many
+        co-trained models (see train_vfold_ensemble).  keep_augmentation
+        reuses the members' augmentation transforms, and so continues
+        their random streams, when only the fold files changed (refolding
+        and resuming). """
         self.vfold_num = vfold_num
 
-        if self.use_persistent_cache:
-            persistent_cache = pathlib.Path(
-                ".",
-                "data_cache",
-                self.network_name+"_f"+str(vfold_num)+"_r"+str(run_num)
+        self.train_loader_transforms = self.train_transforms
+        if num_members > 1:
+            self.train_loader_transforms, member_transforms = ARGUS_split_member_transforms(
+                self.train_transforms)
+            if (not keep_augmentation
+                    or self.member_augmentation == None
+                    or len(self.member_augmentation.transforms) != num_members):
+                self.member_augmentation = ARGUS_member_augmentation(
+                    member_transforms, num_members, seed=ARGUS_distributed_rank())
+        else:
+            self.member_augmentation = None
+
+        if self.feature_store_dir != None:
+            train_ds = ARGUS_FeatureStoreDataset(
+                data=self.train_files[self.vfold_num],
+                store_dir=self.feature_store_dir,
+                transform=self.train_loader_transforms,
             )
-            persistent_cache.mkdir(parents=True, exist_ok=True)
-            train_ds = PersistentDataset(
+        elif self.use_persistent_cache:
+            train_ds = ARGUS_SharedPersistentDataset(
                 data=self.train_files[self.vfold_num],
-                transform=self.train_transforms,
-                cache_dir=persistent_cache,
+                transform=self.train_loader_transforms,
+                cache_dir=self.persistent_cache_dir,
             )
+            ARGUS_print_cache_report("Train", train_ds.cache_report())
         else:
             train_ds = CacheDataset(
                 data=self.train_files[self.vfold_num],
-                transform=self.train_transforms,
+                transform=self.train_loader_transforms,
                 cache_rate=self.cache_rate_train,
                 num_workers=self.num_workers_train,
             )
 
 
+        # Each item of the train chain yields num_samples_train samples
+        batch_size = self.batch_size_train
+        if self.feature_store_dir == None:
+            batch_size = max(1, batch_size // self.num_samples_train)
+        # With several ranks (ARGUS_distributed.py) each loads its shard of
+        # the epoch, and batch_size_train is split over the ranks
+        self.train_sampler = None
+        world_size = ARGUS_distributed_world_size()
+        if world_size > 1:
+            self.train_sampler = DistributedSampler(train_ds, shuffle=True)
+            batch_size = max(1, batch_size // world_size)
         self.train_loader = DataLoader(
             train_ds,
-            batch_size=self.batch_size_train,
-            shuffle=True,
+            batch_size=batch_size,
+            shuffle=self.train_sampler == None,
+            sampler=self.train_sampler,
             num_workers=self.num_workers_train,
             collate_fn=list_data_collate,
             pin_memory=True,
         )
 
-        if len(self.val_files) > self.vfold_num and len(self.val_files[self.vfold_num]) > 0:
-            if self.use_persistent_cache:
-                val_ds = PersistentDataset(
+        # Only rank 0 validates
+        if (ARGUS_is_main_rank()
+                and len(self.val_files) > self.vfold_num
+                and len(self.val_files[self.vfold_num]) > 0):
+            if self.feature_store_dir != None:
+                val_ds = ARGUS_FeatureStoreDataset(
                     data=self.val_files[self.vfold_num],
+                    store_dir=self.feature_store_dir,
                     transform=self.val_transforms,
-                    cache_dir=persistent_cache,
                 )
+            elif self.use_persistent_cache:
+                val_ds = ARGUS_SharedPersistentDataset(
+                    data=self.val_files[self.vfold_num],
+                    transform=self.val_transforms,
+                    cache_dir=self.persistent_cache_dir,
+                )
+                ARGUS_print_cache_report("Val", val_ds.cache_report())
             else:
                 val_ds = CacheDataset(
                     data=self.val_files[self.vfold_num],
@@ -380,22 +544,23 @@ class ARGUS_classification_train(ARGUS_classification_inference):
                 pin_memory=True,
             )
 
-    def setup_testing_vfold(self, vfold_num, run_num):
+    def setup_testing_vfold(self, vfold_num, run_num=0):
         self.vfold_num = vfold_num
 
         if len(self.test_files) > self.vfold_num and len(self.test_files[self.vfold_num]) > 0:
-            if self.use_persistent_cache:
-                persistent_cache = pathlib.Path(
-                    ".",
-                    "data_cache",
-                    self.network_name+"_f"+str(vfold_num)+"_r"+str(run_num)
+            if self.feature_store_dir != None:
+                test_ds = ARGUS_FeatureStoreDataset(
+                    data=self.test_files[self.vfold_num],
+                    store_dir=self.feature_store_dir,
+                    transform=self.test_transforms,
                 )
-                persistent_cache.mkdir(parents=True, exist_ok=True)
-                test_ds = PersistentDataset(
+            elif self.use_persistent_cache:
+                test_ds = ARGUS_SharedPersistentDataset(
                     data=self.test_files[self.vfold_num],
                     transform=self.test_transforms,
-                    cache_dir=persistent_cache,
+                    cache_dir=self.persistent_cache_dir,
                 )
+                ARGUS_print_cache_report("Test", test_ds.cache_report())
             else:
                 test_ds = CacheDataset(
                     data=self.test_files[self.vfold_num],
@@ -411,116 +576,239 @@ class ARGUS_classification_train(ARGUS_classification_inference):
                 pin_memory=True,
             )
 
-    def train_vfold(self, run_id=0):
-        model_filename_base = os.path.join(
-            ".",
-            self.results_dirname,
-            self.results_filename_base + "_run" + str(run_id)
-        )
-        if not os.path.exists(model_filename_base):
-            os.makedirs(model_filename_base)
+    def train_vfold(self, run_id=0, resume=False):
+        """ Train model run_id on the current fold.
+
+        Every checkpoint_interval epochs a full checkpoint (model,
+        optimizer, epoch, random states, loss/metric history and best
+        metric) is written.  With resume=True, training continues from
+        that checkpoint if it exists.
+        """
+        self.train_vfold_ensemble([run_id], resume)
+
+    def vfold_files(self):
+        """ [train, val, test] files of the current fold, as saved in
+        checkpoints.  setup_vfold_files adds no val or test list for a
+        fold whose split is empty; [] stands for it here. """
+        files = [self.train_files[self.vfold_num]]
+        for split in [self.val_files, self.test_files]:
+            files.append(split[self.vfold_num] if len(split) > self.vfold_num else [])
+        return files
+
+    def set_vfold_files(self, files):
+        """ Restore the current fold's files from vfold_files() """
+        self.train_files[self.vfold_num] = files[0]
+        for split, split_files in [(self.val_files, files[1]), (self.test_files, files[2])]:
+            while len(split) <= self.vfold_num:
+                split.append([])
+            split[self.vfold_num] = split_files
+
+    def member_transforms(self, member):
+        """ The random transforms applied for a co-trained member, whose
+        states its checkpoints save """
+        if self.member_augmentation == None:
+            return self.train_transforms
+        return self.member_augmentation.transforms[member]
+
+    def train_vfold_ensemble(self, run_ids=None, resume=False):
+        """ Co-train the models run_ids (default all num_models) on the
+        current fold from one data stream.
+
+        Each batch of the train loader is loaded and windowed once and then
+        trained on by every model, each with its own optimizer, validation
+        schedule, best model and checkpoint (the files train_vfold writes
+        for that run); flips and zooms are drawn per model (see
+        ARGUS_cotraining.py).  Call init_model for each run_id and
+        setup_training_vfold(vfold, num_members=len(run_ids)) first.  The
+        models share the fold split.
+        """
+        if run_ids == None:
+            run_ids = list(range(self.num_models))
+        if len(run_ids) > 1 and self.member_augmentation == None:
+            print("ERROR: Call setup_training_vfold with num_members =", len(run_ids))
+            return
 
         loss_function = torch.nn.CrossEntropyLoss()
-        
-        optimizer = torch.optim.Adam(self.model[run_id].parameters(), 1e-4)
-        
-        best_metric = -1
-        best_metric_epoch = -1
-        epoch_loss_values = []
-        metric_values = []
 
-        for epoch in range(self.max_epochs):
+        teachers = None
+        if len(self.distill_teacher_files) > 0:
+            teachers = ARGUS_teacher_ensemble(
+                self.distill_teacher_files, self.teacher_model, self.device)
+            distill_loss = ARGUS_distillation_loss(
+                self.distill_temperature, self.distill_alpha)
+
+        members = []
+        for m, run_id in enumerate(run_ids):
+            members.append(ARGUS_ensemble_member(self, run_id, self.member_transforms(m)))
+
+        if resume:
+            for member in members:
+                files = member.resume(self.device, self.max_epochs)
+                if files != None and files != self.vfold_files():
+                    # Folds were re-randomized (refold_interval) during the run
+                    self.set_vfold_files(files)
+                    self.setup_training_vfold(self.vfold_num, num_members=len(members),
+                                              keep_augmentation=True)
+        for m, member in enumerate(members):
+            member.check_augmentation(self.member_transforms(m))
+        start_epoch = min(member.start_epoch for member in members)
+        ARGUS_distributed_seed_transforms(self.train_loader_transforms, start_epoch)
+        for m, member in enumerate(members):
+            ARGUS_distributed_seed_transforms(member.transforms, start_epoch + m + 1)
+
+        # All-reduces the gradients when running as several ranks
+        for member in members:
+            member.train_model = ARGUS_distributed_model(member.model)
+        is_main_rank = ARGUS_is_main_rank()
+
+        for epoch in range(start_epoch, self.max_epochs):
+            active = [m for m, member in enumerate(members) if member.is_training(epoch)]
+            if len(active) == 0:
+                break
+            for m in active:
+                members[m].schedule.start_epoch()
+                members[m].train_model.train()
             print("-" * 10)
             print(f"{self.vfold_num}: epoch {epoch + 1}/{self.max_epochs}",flush=True)
-            self.model[run_id].train()
-            epoch_loss = 0
+            if self.train_sampler != None:
+                self.train_sampler.set_epoch(epoch)
+            epoch_loss = [0] * len(members)
             epoch_size = 0
             for step,batch_data in enumerate(self.train_loader):
-                inputs = batch_data["image"].to(self.device)
-                labels = batch_data["label"].to(self.device)
-                optimizer.zero_grad()
-                outputs = self.model[run_id](inputs)
-                loss = loss_function(outputs, labels)
-                loss.backward()
-                optimizer.step()
-                epoch_loss += loss.item()
+                for m in active:
+                    member = members[m]
+                    member_data = batch_data
+                    if self.member_augmentation != None:
+                        member_data = self.member_augmentation(batch_data, m)
+                    inputs = member_data["image"].to(self.device)
+                    labels = member_data["label"].to(self.device)
+                    member.optimizer.zero_grad()
+                    outputs = member.train_model(inputs)
+                    loss = loss_function(outputs, labels)
+                    if teachers != None:
+                        loss = distill_loss(
+                            outputs,
+                            teachers(inputs, self.distill_temperature),
+                            loss)
+                    loss.backward()
+                    member.optimizer.step()
+                    epoch_loss[m] += loss.item()
+                    print(
+                        f"{step} /"
+                        f" {len(self.train_loader)},"
+                        f" run {member.run_id} train_loss: {loss.item():.4f}", flush=True
+                    )
                 epoch_size = step
+
+            for m in active:
+                member = members[m]
+                member_loss = ARGUS_distributed_mean(epoch_loss[m] / epoch_size)
+                member.epoch_loss_values.append(member_loss)
                 print(
-                    f"{step} /"
-                    f" {len(self.train_files[self.vfold_num])//self.train_loader.batch_size},"
-                    f" train_loss: {loss.item():.4f}", flush=True
+                    f"{self.vfold_num} run {member.run_id} epoch {epoch+1}"
+                    f" average loss: {member_loss:.4f}",
+                    flush=True,
                 )
-            epoch_loss /= epoch_size
-            epoch_loss_values.append(epoch_loss)
-            print(
-                f"{self.vfold_num} epoch {epoch+1}" f" average loss: {epoch_loss:.4f}",
-                flush=True,
-            )
 
-            if self.validation_interval > 0 and (epoch + 1) % self.validation_interval == 0:
-                self.model[run_id].eval()
-                
-                num_correct = 0.0
-                metric_count = 0
-                metric_value = 0
-                with torch.no_grad():
-                    for val_data in self.val_loader:
-                        val_inputs = val_data["image"].to(self.device)
-                        val_labels = val_data["label"].to(self.device)
-                        val_outputs = self.model[run_id](val_inputs)
-                        out_labels = val_outputs.argmax(dim=1)
-                        value = torch.eq(out_labels, val_labels)
-                        metric_count += len(value)
-                        num_correct += value.sum().item()
-                        val_outputs2 = val_outputs.cpu()
-                        for i in range(len(val_outputs2)):
-                            minv = min(val_outputs2[i])
-                            maxv = max(val_outputs2[i])
-                            maxv2 = max([x for x in val_outputs2[i] if x < maxv])
-                            denom = maxv2-minv
-                            if denom == 0:
-                                denom = 1
-                            metric_value += (val_outputs2[i,val_labels[i]] - minv)/denom
-                    correct = num_correct / metric_count
-                    metric = (metric_value / metric_count) * correct
-
-                    metric_values.append(metric)
-                    
+                if is_main_rank and member.schedule.should_validate(epoch):
+                    metric, correct = self.validation_metric(member.model)
+                    member.metric_values.append(metric)
+
                     metric_window = 5
                     mean_metric = -1
-                    if len(metric_values) > metric_window:
-                        mean_metric = np.mean(metric_values[-metric_window:])
+                    if len(member.metric_values) > metric_window:
+                        mean_metric = np.mean(member.metric_values[-metric_window:])
                     if epoch > self.max_epochs // 5:
-                        if mean_metric > best_metric:
-                            best_metric = mean_metric
-                            best_metric_epoch = epoch + 1
+                        if mean_metric > member.best_metric:
+                            member.best_metric = mean_metric
+                            member.best_metric_epoch = epoch + 1
                             torch.save(
-                                self.model[run_id].state_dict(),
-                                os.path.join(model_filename_base,
-                                             "best_model_" + str(self.vfold_num) + ".pth"),
+                                member.model.state_dict(),
+                                member.filename("best_model_", self.vfold_num),
                             )
-                            print("saved new best metric model")
-                    print( f"Current epoch: {epoch + 1}" )
+                            print(f"run {member.run_id}: saved new best metric model")
+                    print( f"Run {member.run_id} current epoch: {epoch + 1}" )
                     print( f"   Current portion correct: {correct:.4f}" )
                     print( f"   Current accuracy value: {metric:.4f}" )
                     print( f"   Current mean accuracy value: {mean_metric:.4f}" )
-                    print( f"Best mean accuracy value: {best_metric:.4f}" )
-                    print( f"    at epoch: {best_metric_epoch}" )
+                    print( f"Best mean accuracy value: {member.best_metric:.4f}" )
+                    print( f"    at epoch: {member.best_metric_epoch}" )
+                    member.stop = member.schedule.update(
+                        epoch,
+                        mean_metric if len(member.metric_values) > metric_window else None)
                     torch.save(
-                        self.model[run_id].state_dict(),
-                        os.path.join(model_filename_base,  "last_model_" + str(self.vfold_num) + ".pth"),
+                        member.model.state_dict(),
+                        member.filename("last_model_", self.vfold_num),
                     )
                     np.save(
-                        os.path.join(model_filename_base, "loss_" + str(self.vfold_num) + ".npy"),
-                        epoch_loss_values,
+                        member.filename("loss_", self.vfold_num, ".npy"),
+                        member.epoch_loss_values,
                     )
                     np.save(
-                        os.path.join(model_filename_base, "val_acc_" + str(self.vfold_num) + ".npy"),
-                        metric_values,
+                        member.filename("val_acc_", self.vfold_num, ".npy"),
+                        member.metric_values,
                     )
             if self.randomize_folds and self.refold_interval > 0 and (epoch + 1) % self.refold_interval == 0:
-                self.setup_vfold_files()
-                self.setup_training_vfold(self.vfold_num)
+                self.setup_vfold_files(use_manifest=False)
+                self.setup_training_vfold(self.vfold_num, num_members=len(members),
+                                          keep_augmentation=True)
+                for m, member in enumerate(members):
+                    member.check_augmentation(self.member_transforms(m))
+
+            for m in active:
+                member = members[m]
+                member.stop = ARGUS_distributed_broadcast_flag(member.stop)
+                member.schedule.end_epoch()
+                if (is_main_rank
+                        and self.checkpoint_interval > 0
+                        and ((epoch + 1) % self.checkpoint_interval == 0
+                             or epoch + 1 == self.max_epochs
+                             or member.stop)):
+                    member.save_checkpoint(epoch, self.vfold_files())
+
+        if not is_main_rank:
+            return
+        for member in members:
+            summary = member.schedule.summary()
+            if summary["stopped_epoch"] != None:
+                print(f"{self.vfold_num} run {member.run_id}: early stop at epoch {summary['stopped_epoch']},"
+                      f" {summary['epochs_saved']} of {summary['max_epochs']} epochs saved"
+                      f" ({summary['fraction_saved']*100:.0f}%,"
+                      f" ~{summary['seconds_saved_estimate']/3600:.2f} hours)")
+            print(f"{self.vfold_num} run {member.run_id}: {summary['validations']} validations"
+                  f" ({summary['validations_fixed_interval']} at a fixed interval)")
+            with open(member.filename("schedule_", self.vfold_num, ".json"), "w") as fp:
+                json.dump(summary, fp, indent=1)
+
+    def validation_metric(self, model):
+        """ Accuracy value (mean confidence margin of the true class times
+        the portion correct) and portion correct of model on the current
+        fold's validation set """
+        model.eval()
+        num_correct = 0.0
+        metric_count = 0
+        metric_value = 0
+        with torch.no_grad():
+            for val_data in self.val_loader:
+                val_inputs = val_data["image"].to(self.device)
+                val_labels = val_data["label"].to(self.device)
+                val_outputs = model(val_inputs)
+                out_labels = val_outputs.argmax(dim=1)
+                value = torch.eq(out_labels, val_labels)
+                metric_count += len(value)
+                num_correct += value.sum().item()
+                val_outputs2 = val_outputs.cpu()
+                for i in range(len(val_outputs2)):
+                    minv = min(val_outputs2[i])
+                    maxv = max(val_outputs2[i])
+                    maxv2 = max([x for x in val_outputs2[i] if x < maxv])
+                    denom = maxv2-minv
+                    if denom == 0:
+                        denom = 1
+                    metric_value += (val_outputs2[i,val_labels[i]] - minv)/denom
+        correct = num_correct / metric_count
+        metric = (metric_value / metric_count) * correct
+        return metric, correct
 
     def test_vfold(self, model_type="best", run_id=0, model_vfold=-1):
         if model_vfold == -1:
@@ -566,21 +854,14 @@ class ARGUS_classification_train(ARGUS_classification_inference):
                         maxv2 = max([x for x in test_outputs[i] if x < maxv])
                         metric += test_outputs[i, out_labels[i]] - maxv2
 
-                    if batch_num == 0:
-                        test_images_total = test_data["image"]
-                        test_labels_total = test_data["label"]
-                        test_outputs_total = test_outputs
-                    else:
-                        test_images_total = np.concatenate(
-                            (test_images_total, test_data["image"]), axis=0
-                        )
-                        test_labels_total = np.concatenate(
-                            (test_labels_total, test_data["label"]), axis=0
-                        )
-                        test_outputs_total = np.concatenate(
-                            (test_outputs_total, test_outputs), axis=0
-                        )
+                    # Collected per batch and concatenated once below
+                    test_images_total.append(np.asarray(test_data["image"]))
+                    test_labels_total.append(np.asarray(test_data["label"]))
+                    test_outputs_total.append(np.asarray(test_outputs.cpu()))
                         
+                test_images_total = np.concatenate(test_images_total, axis=0)
+                test_labels_total = np.concatenate(test_labels_total, axis=0)
+                test_outputs_total = np.concatenate(test_outputs_total, axis=0)
                 accuracy = num_correct / metric_count
                 metric = metric / metric_count
                 metric *= accuracy
@@ -0,0 +1,170 @@
+import os
+import copy
+
+import numpy as np
+
+import torch
+
+from monai.data import list_data_collate
+from monai.transforms import Compose
+
+from ARGUS_Transforms import ARGUS_RandSpatialCropSlicesd
+from ARGUS_checkpoint import ARGUS_save_checkpoint, ARGUS_load_checkpoint, ARGUS_rng_state
+from ARGUS_validation_schedule import ARGUS_validation_schedule
+from ARGUS_shared_cache import ARGUS_deterministic_prefix
+
+def ARGUS_split_member_transforms(transform):
+    """ Split a train chain into the part shared by the co-trained members
+    and the part each member applies with its own random state.
+
+    Everything up to the last ARGUS_RandSpatialCropSlicesd (loading,
+    resizing, window selection, rotation and statistics) is shared; the
+    transforms that follow it (flips, zooms, ToTensord) are per member.
+    Chains without a crop share only their deterministic prefix.
+    """
+    transforms = transform.transforms if isinstance(transform, Compose) else [transform]
+    crops = [i for i, t in enumerate(transforms)
+             if isinstance(t, ARGUS_RandSpatialCropSlicesd)]
+    if len(crops) > 0:
+        split = crops[-1] + 1
+    else:
+        split = len(ARGUS_deterministic_prefix(transform))
+    return Compose(transforms[:split]), transforms[split:]
+
+class ARGUS_member_augmentation():
+    """ Applies each member's copy of the per-member transforms to the
+    samples of a shared batch.
+
+    Member m's copy is seeded with seed*num_members+m, so the members (and
+    the ranks of a distributed run, which pass their rank as seed) draw
+    different flips and zooms from the same loaded windows.  The copies
+    are the members' checkpointed random streams, so they are kept when
+    the fold files are reloaded (setup_training_vfold keep_augmentation).
+    """
+
+    def __init__(self, member_transforms, num_members, seed=0):
+        self.transforms = []
+        for m in range(num_members):
+            member_transform = Compose(copy.deepcopy(member_transforms))
+            member_transform.set_random_state(seed=seed * num_members + m)
+            self.transforms.append(member_transform)
+
+    def __call__(self, batch_data, member):
+        keys = [k for k in ["image", "label", "task"] if k in batch_data]
+        items = [{k: batch_data[k][i] for k in keys}
+                 for i in range(len(batch_data["image"]))]
+        return list_data_collate([self.transforms[member](item) for item in items])
+
+def _transform_states(transforms):
+    return ARGUS_rng_state(transforms)["transforms"]
+
+def _same_states(states, other_states):
+    """ Whether two lists of numpy RandomState states are equal """
+    if len(states) != len(other_states):
+        return False
+    for state, other in zip(states, other_states):
+        for value, other_value in zip(state, other):
+            if isinstance(value, np.ndarray):
+                if not np.array_equal(value, other_value):
+                    return False
+            elif value != other_value:
+                return False
+    return True
+
+class ARGUS_ensemble_member():
+    """ Training state of one co-trained model (one run_id): its model,
+    optimizer, validation schedule, loss/metric history, best metric and
+    result files.  The files are those train_vfold writes for the run, so
+    co-trained and separately trained runs are interchangeable. """
+
+    def __init__(self, trainer, run_id, transforms):
+        self.run_id = run_id
+        self.model = trainer.model[run_id]
+        self.transforms = transforms
+        self.model_filename_base = os.path.join(
+            ".",
+            trainer.results_dirname,
+            trainer.results_filename_base + "_run" + str(run_id)
+        )
+        if not os.path.exists(self.model_filename_base):
+            os.makedirs(self.model_filename_base)
+        self.checkpoint_filename = os.path.join(
+            self.model_filename_base,
+            "checkpoint_" + str(trainer.vfold_num) + ".pth")
+
+        self.optimizer = torch.optim.Adam(self.model.parameters(), 1e-4)
+        self.schedule = ARGUS_validation_schedule(
+            trainer.max_epochs,
+            trainer.validation_interval,
+            **trainer.validation_schedule_options)
+
+        self.start_epoch = 0
+        self.best_metric = -1
+        self.best_metric_epoch = -1
+        self.epoch_loss_values = []
+        self.metric_values = []
+        self.stop = False
+        self.train_model = None
+        self.resumed_states = None
+
+    def filename(self, prefix, vfold_num, suffix=".pth"):
+        return os.path.join(self.model_filename_base, prefix + str(vfold_num) + suffix)
+
+    def resume(self, device, max_epochs):
+        """ Continue from the member's checkpoint; returns its fold files,
+        or None if there is no checkpoint """
+        if not os.path.exists(self.checkpoint_filename):
+            return None
+        state = ARGUS_load_checkpoint(
+            self.checkpoint_filename,
+            self.model,
+            self.optimizer,
+            device,
+            self.transforms)
+        self.start_epoch = state["epoch"]
+        self.best_metric = state["best_metric"]
+        self.best_metric_epoch = state["best_metric_epoch"]
+        self.epoch_loss_values = state["epoch_loss_values"]
+        self.metric_values = state["metric_values"]
+        self.schedule.set_state(state["schedule"])
+        self.resumed_states = _transform_states(self.transforms)
+        if self.schedule.stopped_epoch != None:
+            self.start_epoch = max_epochs
+        print(f"Run {self.run_id}: resuming from epoch {self.start_epoch}"
+              f" of {self.checkpoint_filename}")
+        return state["files"]
+
+    def check_augmentation(self, transforms):
+        """ Raise unless transforms, those the trainer applies for this
+        member, are the ones its checkpoints save and, after resume(),
+        still hold the restored random states (the streams continue from
+        where the checkpointed run stopped) """
+        if transforms is not self.transforms:
+            raise RuntimeError(
+                f"Run {self.run_id}: augmentation transforms were rebuilt;"
+                f" their random states would not be checkpointed.")
+        if self.resumed_states != None:
+            if not _same_states(_transform_states(transforms), self.resumed_states):
+                raise RuntimeError(
+                    f"Run {self.run_id}: augmentation streams do not continue"
+                    f" from {self.checkpoint_filename}.")
+            self.resumed_states = None
+
+    def is_training(self, epoch):
+        return epoch >= self.start_epoch and not self.stop
+
+    def save_checkpoint(self, epoch, files):
+        ARGUS_save_checkpoint(
+            self.checkpoint_filename,
+            self.model,
+            self.optimizer,
+            dict(
+                epoch=epoch + 1,
+                best_metric=self.best_metric,
+                best_metric_epoch=self.best_metric_epoch,
+                epoch_loss_values=self.epoch_loss_values,
+                metric_values=self.metric_values,
+                schedule=self.schedule.state(),
+                files=files,
+            ),
+            self.transforms)
@@ -0,0 +1,111 @@
+import os
+import json
+
+import torch
+
+from monai.data import Dataset
+
+from ARGUS_precollated_validation import ARGUS_precollated_validation
+
+class ARGUS_teacher_ensemble():
+    """ The averaged softmax outputs of a fixed ensemble of models.
+
+    model_factory() must return a new, untrained model of the teachers'
+    architecture; each teacher file is loaded into one and kept in eval
+    mode.
+    """
+
+    def __init__(self, filenames, model_factory, device):
+        self.models = []
+        for filename in filenames:
+            model = model_factory()
+            model.load_state_dict(torch.load(filename, map_location=device))
+            model.eval()
+            self.models.append(model)
+
+    def __call__(self, inputs, temperature=1.0):
+        with torch.no_grad():
+            return torch.stack(
+                [torch.softmax(m(inputs) / temperature, dim=1) for m in self.models]
+            ).mean(dim=0)
+
+class ARGUS_distillation_loss():
+    """ alpha * soft loss + (1-alpha) * hard loss.
+
+    The soft loss is the cross-entropy of the student's softmax at the
+    given temperature with the teacher probabilities, minus the teacher
+    entropy (i.e. their KL divergence), averaged over samples and pixels and
+    scaled by temperature**2 so its gradients do not shrink with the
+    temperature.
+    """
+
+    def __init__(self, temperature=1.0, alpha=1.0):
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def __call__(self, student_outputs, teacher_probs, hard_loss=None):
+        log_student = torch.log_softmax(student_outputs / self.temperature, dim=1)
+        log_teacher = torch.log(teacher_probs.clamp(min=1e-8))
+        soft_loss = (teacher_probs * (log_teacher - log_student)).sum(dim=1).mean()
+        soft_loss = soft_loss * self.temperature * self.temperature
+        if hard_loss is None or self.alpha >= 1:
+            return soft_loss
+        return self.alpha * soft_loss + (1 - self.alpha) * hard_loss
+
+def ARGUS_distillation_report(trainer, run_id=0, model_type="best", vfolds=None, batch_size=16):
+    """ Compare each vfold's student with the teacher ensemble on that
+    vfold's test split.
+
+    Reports the agreement of their argmax (pixels for segmentation,
+    videos for classification), their Dice (segmentation) or accuracy
+    (classification) against the labels, and for segmentation the Dice of
+    the student against the ensemble's labels.  The report is printed and
+    written to distill_report.json in the student's results directory.
+    """
+    teachers = ARGUS_teacher_ensemble(
+        trainer.distill_teacher_files, trainer.teacher_model, trainer.device)
+    model_filename_base = os.path.join(
+        ".",
+        trainer.results_dirname,
+        trainer.results_filename_base + "_run" + str(run_id)
+    )
+    if vfolds == None:
+        vfolds = range(trainer.num_folds)
+
+    report = []
+    for vfold in vfolds:
+        if len(trainer.test_files) <= vfold or len(trainer.test_files[vfold]) == 0:
+            continue
+        model_file = os.path.join(
+            model_filename_base, model_type + "_model_" + str(vfold) + ".pth")
+        if not os.path.exists(model_file):
+            print("ERROR: Model file not found:", model_file, "!!")
+            continue
+        trainer.model[run_id].load_state_dict(torch.load(model_file, map_location=trainer.device))
+        trainer.model[run_id].eval()
+
+        eval_set = ARGUS_precollated_validation(
+            Dataset(data=trainer.test_files[vfold], transform=trainer.test_transforms),
+            trainer.device)
+        student_pred = eval_set.predict(trainer.model[run_id], batch_size)
+        teacher_pred = eval_set.predict(teachers, batch_size)
+
+        result = dict(vfold=vfold,
+                      num_test=len(eval_set),
+                      agreement=(student_pred == teacher_pred).float().mean().item())
+        if eval_set.labels.dim() > 2:
+            result["student_dice"] = eval_set.dice_of(student_pred, trainer.num_classes)
+            result["ensemble_dice"] = eval_set.dice_of(teacher_pred, trainer.num_classes)
+            result["student_vs_ensemble_dice"] = eval_set.dice_of(
+                student_pred, trainer.num_classes, labels=teacher_pred)
+        else:
+            labels = eval_set.labels.view(-1)
+            result["student_accuracy"] = (student_pred.view(-1) == labels).float().mean().item()
+            result["ensemble_accuracy"] = (teacher_pred.view(-1) == labels).float().mean().item()
+        print(", ".join(f"{k}={v:.4f}" if isinstance(v, float) else f"{k}={v}"
+                        for k, v in result.items()))
+        report.append(result)
+
+    with open(os.path.join(model_filename_base, "distill_report.json"), "w") as fp:
+        json.dump(report, fp, indent=1)
+    return report
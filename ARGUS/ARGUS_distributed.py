@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+""" Data-parallel training of one (fold, run) on several CPU processes.
+
+Each rank is a process with its own copy of the model and a 1/N shard of
+the training set (DistributedSampler); gradients are all-reduced by
+DistributedDataParallel over the gloo backend, so every rank takes the
+same optimizer step and the N copies stay identical.  The per-rank batch
+is batch_size_train/N, so an epoch matches the single-process run.
+
+Rank 0 validates, decides early stopping and writes the best/last models,
+checkpoints and schedule; the other ranks wait for its stop decision at
+the end of each epoch.  All ranks seed python's random module with the
+same value, so setup_vfold_files (and refolding) gives every rank the
+same split.
+
+The trainers use the helpers below, which fall back to plain
+single-process behaviour when torch.distributed is not initialized, so
+nothing changes for the usual train_vfold calls.
+
+Usage:
+    # 4 local ranks
+    python ARGUS_distributed.py --config ARGUS_ptx_ar.cfg --vfold 0 --run 0 --nproc 4 \\
+        --trainer ARGUS_ptx_ar_train:ARGUS_ptx_ar_train --path ../PTX
+
+    # 2 hosts x 8 ranks, one command per host
+    torchrun --nnodes 2 --nproc_per_node 8 --node_rank <0|1> \\
+        --master_addr <host0> --master_port 29500 \\
+        ARGUS_distributed.py --config ARGUS_ptx_ar.cfg --vfold 0 --run 0
+"""
+
+import os
+import sys
+import random
+import argparse
+
+import torch
+import torch.distributed as dist
+
+def ARGUS_distributed_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size()
+    return 1
+
+def ARGUS_distributed_rank():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank()
+    return 0
+
+def ARGUS_is_main_rank():
+    return ARGUS_distributed_rank() == 0
+
+def ARGUS_distributed_init(backend="gloo"):
+    """ Join the process group described by the environment (RANK,
+    WORLD_SIZE, MASTER_ADDR, MASTER_PORT), as set by torchrun or
+    run_rank() """
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method="env://")
+    return ARGUS_distributed_rank(), ARGUS_distributed_world_size()
+
+def ARGUS_distributed_model(model, find_unused_parameters=False):
+    """ The model wrapped for gradient all-reduce, or model itself when
+    running in one process.  The wrapper shares model's parameters, so
+    model can still be saved, validated and loaded directly. """
+    if ARGUS_distributed_world_size() == 1:
+        return model
+    return torch.nn.parallel.DistributedDataParallel(
+        model, find_unused_parameters=find_unused_parameters)
+
+def ARGUS_distributed_mean(value):
+    """ Mean of a float over all ranks """
+    if ARGUS_distributed_world_size() == 1:
+        return value
+    tensor = torch.tensor([float(value)], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item() / ARGUS_distributed_world_size()
+
+def ARGUS_distributed_broadcast_flag(flag):
+    """ Rank 0's value of flag, on every rank """
+    if ARGUS_distributed_world_size() == 1:
+        return flag
+    tensor = torch.tensor([1 if flag else 0], dtype=torch.int32)
+    dist.broadcast(tensor, src=0)
+    return bool(tensor.item())
+
+def ARGUS_distributed_seed_transforms(transforms, epoch=0):
+    """ Give each rank its own augmentation stream.  Checkpoints hold rank
+    0's transform states, so this is repeated after a resume. """
+    if ARGUS_distributed_world_size() > 1:
+        transforms.set_random_state(seed=epoch * 1009 + ARGUS_distributed_rank())
+
+def run_rank(rank, args):
+    """ Train the fold as one rank.  rank is None when the rank comes from
+    the environment (torchrun). """
+    if rank != None:
+        os.environ["RANK"] = str(rank)
+        os.environ["LOCAL_RANK"] = str(rank)
+        os.environ["WORLD_SIZE"] = str(args.nproc)
+        os.environ["MASTER_ADDR"] = args.master_addr
+        os.environ["MASTER_PORT"] = str(args.master_port)
+    local_size = int(os.environ.get("LOCAL_WORLD_SIZE", args.nproc))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // local_size)
+    torch.set_num_threads(threads)
+
+    for path in args.path:
+        sys.path.insert(0, path)
+    from ARGUS_train_scheduler import _load_trainer_class
+
+    rank, world_size = ARGUS_distributed_init(args.backend)
+    print(f"Rank {rank} of {world_size}, {threads} threads", flush=True)
+
+    trainer_class = _load_trainer_class(args.trainer, args.config, args.network)
+    nnet = trainer_class(args.config, args.network, device_num=None)
+
+    random.seed(f"{args.seed}_{args.run}")
+    nnet.setup_vfold_files()
+    nnet.init_model(args.run)
+    if args.pretrained != None:
+        nnet.load_model(args.run, args.pretrained.format(run=args.run, fold=args.vfold))
+    nnet.setup_training_vfold(args.vfold, args.run)
+    nnet.train_vfold(args.run, resume=args.resume)
+
+    dist.destroy_process_group()
+
+def prepare_argparser():
+    parser = argparse.ArgumentParser(description="Data-parallel CPU training of one ARGUS fold")
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--network", default="vfold")
+    parser.add_argument("--trainer", default=None,
+                        help="module:Class of the trainer, e.g. ARGUS_ptx_ar_train:ARGUS_ptx_ar_train")
+    parser.add_argument("--path", nargs="+", default=[],
+                        help="Directories added to sys.path")
+    parser.add_argument("--vfold", type=int, default=0)
+    parser.add_argument("--run", type=int, default=0)
+    parser.add_argument("--pretrained", default=None,
+                        help="Model to start from; {run} and {fold} are replaced")
+    parser.add_argument("--nproc", type=int, default=2,
+                        help="Local ranks to spawn (ignored under torchrun)")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Torch threads per rank; defaults to cores/ranks")
+    parser.add_argument("--backend", default="gloo")
+    parser.add_argument("--master-addr", default="127.0.0.1")
+    parser.add_argument("--master-port", type=int, default=29500)
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the fold split, shared by all ranks")
+    parser.add_argument("--resume", action="store_true")
+    return parser
+
+def main(args):
+    if "RANK" in os.environ:
+        # Launched by torchrun, one process per rank
+        run_rank(None, args)
+    else:
+        torch.multiprocessing.spawn(run_rank, args=(args,), nprocs=args.nproc, join=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(prepare_argparser().parse_args()))
@@ -3,10 +3,10 @@ from itk import TubeTK as tube
 
 import numpy as np
 
-import torch
-
 from ARGUS_classification_inference import ARGUS_classification_inference
 
+from ARGUS_Profiler import ARGUS_profiled
+
 from ARGUS_preprocess_butterfly import ARGUS_preprocess_butterfly
 from ARGUS_preprocess_sonosite import ARGUS_preprocess_sonosite
 from ARGUS_preprocess_clarius import ARGUS_preprocess_clarius
@@ -25,16 +25,17 @@ class ARGUS_ett_roi_inference(ARGUS_classification_inference):
         self.number_of_seconds = 10.0
         self.minimum_number_of_positive_seconds = 3.0
         
-    def preprocess(self, vid, lbl=None, slice_num=None, crop_data=True, scale_data=True, rotate_data=True):
+    def preprocess(self, vid, lbl=None, slice_num=None, crop_data=True, scale_data=True, rotate_data=True, preprocess_cache=None):
         if crop_data:
-            self.preprocessed_ett_video = self.preprocess_ett.process( vid )
+            self.preprocessed_ett_video = self.source_preprocess(self.preprocess_ett, vid, preprocess_cache)
         else:
             self.preprocessed_ett_video = vid
         super().preprocess(self.preprocessed_ett_video, lbl, slice_num, scale_data, rotate_data)
 
-    def volume_preprocess(self, vid, crop_data=True, slice_num=None, scale_data=True, rotate_data=True):
+    @ARGUS_profiled
+    def volume_preprocess(self, vid, crop_data=True, slice_num=None, scale_data=True, rotate_data=True, preprocess_cache=None):
         if crop_data:
-            self.preprocessed_ett_video = self.preprocess_ett.process( vid )
+            self.preprocessed_ett_video = self.source_preprocess(self.preprocess_ett, vid, preprocess_cache)
         else:
             self.preprocessed_ett_video = vid
             
@@ -70,18 +71,17 @@ class ARGUS_ett_roi_inference(ARGUS_classification_inference):
 
         self.input_image = vid_roi_img
 
-    def volume_inference(self, step=10, slice_min=None, slice_max=None, use_cache=True):
+    @ARGUS_profiled
+    def volume_input_tensors(self, step=10, slice_min=None, slice_max=None, use_cache=True):
+        """ Network inputs for the windows evaluated by volume_inference """
         img_size = self.input_image.GetLargestPossibleRegion().GetSize()
         img_spacing = self.input_image.GetSpacing()
 
-        self.prob_array  = []
-        self.classification_array = []
-        self.prob_total  = np.zeros(self.num_classes)
+        input_tensors = []
         if not use_cache:
             self.ARGUS_Preprocess._gradient_cache = None
             self.ARGUS_Preprocess.cache_gradient = True
             
-        num_slices = 0
         window_size = self.num_slices
         resize_window = False
         if img_size[2] < window_size-1:
@@ -113,23 +113,25 @@ class ARGUS_ett_roi_inference(ARGUS_classification_inference):
             ar_input_array[0,0] = roi_array
     
             self.input_tensor = self.ConvertToTensor(ar_input_array.astype(np.float32))
+            input_tensors.append(self.input_tensor)
+
+        if resize_window:
+            self.ARGUS_Preprocess.num_slices = self.num_slices
 
-            prob_total = np.zeros(self.num_classes)
-            with torch.no_grad():
-                for m in range(self.num_models):
-                    test_outputs = self.model[m](self.input_tensor[0].to(self.device))
-                    prob = self.clean_probabilities(test_outputs[0].cpu().detach().numpy())
-                    prob_total += prob
-            prob_total /= self.num_models
+        return input_tensors
+
+    @ARGUS_profiled
+    def volume_classify(self, prob_totals):
+        """ Video classification from the probabilities of each window """
+        self.prob_array  = []
+        self.classification_array = []
+        self.prob_total  = np.zeros(self.num_classes)
+        for prob_total in prob_totals:
             self.prob_array.append(self.clean_probabilities(prob_total))
             self.classification_array.append(self.classify_probabilities(prob_total))
             self.prob_total += prob_total
-            num_slices += 1
-
-        if resize_window:
-            self.ARGUS_Preprocess.num_slices = self.num_slices
             
-        self.prob_total /= num_slices
+        self.prob_total /= len(prob_totals)
 
         frames = len(self.classification_array)
         frames_positive = np.count_nonzero(self.classification_array)
@@ -142,3 +144,7 @@ class ARGUS_ett_roi_inference(ARGUS_classification_inference):
             self.classification = 1
 
         return self.classification, [frames_negative, frames_positive]
+
+    def volume_inference(self, step=10, slice_min=None, slice_max=None, use_cache=True):
+        input_tensors = self.volume_input_tensors(step, slice_min, slice_max, use_cache)
+        return self.volume_classify(self.batch_probabilities(input_tensors))
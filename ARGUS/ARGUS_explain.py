@@ -0,0 +1,149 @@
+import itertools
+
+import numpy as np
+
+import torch
+import torch.nn.functional as F
+
+class ARGUS_explainer():
+    """ GradCAM++ and occlusion sensitivity of an ensemble of classification
+    models for one input tensor.
+
+    gradcam() runs each model forward once, hooked at target_layer, and
+    takes the gradients of all models' class scores with one
+    torch.autograd.grad call.  The models share no parameters, so each
+    model's layer gradient is that of its own score, and the ensemble's
+    maps cost one pass instead of one GradCAMpp object and pass per model.
+
+    occlusion_sensitivity() covers the input with a mask_size patch every
+    stride pixels inside b_box.  The occluded copies are stacked into
+    batches of batch_size, and each batch is run through every model, so a
+    map costs positions/batch_size forward passes per model instead of
+    one per mask position.
+
+    A model listed more than once (the inference classes start with
+    num_models references to one network) is evaluated once.
+    """
+
+    def __init__(self, models, device, target_layer="class_layers.relu"):
+        self.models = []
+        for model in models:
+            if not any(model is m for m in self.models):
+                self.models.append(model)
+        self.device = device
+        self.target_layer = target_layer
+
+    def gradcam(self, x, class_idx=1):
+        """ GradCAM++ map of class_idx for x (1, channels, *spatial) from
+        each model, upsampled to the size of x and scaled to [0, 1];
+        returns an array of shape (models, 1, 1, *spatial) """
+        x = x.to(self.device)
+        activations = [None] * len(self.models)
+        handles = []
+        for m, model in enumerate(self.models):
+            def hook(module, inputs, output, m=m):
+                activations[m] = output
+            layer = dict(model.named_modules())[self.target_layer]
+            handles.append(layer.register_forward_hook(hook))
+        try:
+            with torch.enable_grad():
+                scores = [model(x)[:, class_idx] for model in self.models]
+                gradients = torch.autograd.grad(torch.stack(scores).sum(), activations)
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        mode = "bilinear" if x.dim() == 4 else "trilinear"
+        cams = []
+        for acti, grad, score in zip(activations, gradients, scores):
+            acti = acti.detach()
+            dims = tuple(range(2, grad.dim()))
+            alpha_nr = grad.pow(2)
+            alpha_dr = alpha_nr.mul(2) + acti.mul(grad.pow(3)).sum(dim=dims, keepdim=True)
+            alpha_dr = torch.where(alpha_dr != 0, alpha_dr, torch.ones_like(alpha_dr))
+            alpha = alpha_nr / alpha_dr
+            score = score.detach().exp().view((-1,) + (1,) * (grad.dim() - 1))
+            weights = (alpha * F.relu(score * grad)).sum(dim=dims, keepdim=True)
+            cam = F.relu((weights * acti).sum(dim=1, keepdim=True))
+            cam = F.interpolate(cam, size=x.shape[2:], mode=mode, align_corners=False)
+            cam_min = cam.amin(dim=dims, keepdim=True)
+            cam_range = cam.amax(dim=dims, keepdim=True) - cam_min
+            cam = (cam - cam_min) / torch.where(cam_range > 0, cam_range, torch.ones_like(cam_range))
+            cams.append(cam.cpu().numpy())
+        return np.stack(cams)
+
+    def ensemble_outputs(self, batch, activate=False):
+        outputs = [model(batch) for model in self.models]
+        if activate:
+            outputs = [torch.softmax(output, dim=1) for output in outputs]
+        return torch.stack(outputs).mean(dim=0)
+
+    def occlusion_sensitivity(self, x, mask_size=16, stride=None, b_box=None,
+                              batch_size=64, fill_value=None, activate=True):
+        """ Occlusion sensitivity of the ensemble for x (1, channels, *spatial).
+
+        stride defaults to mask_size//2.  b_box ([min0, max0, min1, max1,
+        ...], max exclusive) limits the masks to a region of interest.
+        fill_value defaults to each channel's mean.  activate applies a
+        softmax to each model's output, as MONAI does by default.
+
+        Returns (map, classes): map (1, num_classes, *spatial) holds the
+        ensemble-mean output when the pixel is occluded, averaged over the
+        masks covering it (the unoccluded output outside b_box), and
+        classes (1, 1, *spatial) its argmax.
+
+        This is not MONAI's OcclusionSensitivity, which the classification
+        inference used before, and the maps of the two are not comparable:
+        masked pixels are set to fill_value, not blended with MONAI's
+        default gaussian mask; masks are placed every stride pixels (pass
+        stride=1 for MONAI's dense placement); and classes is the argmax of
+        the ensemble map, where the MONAI path summed each model's argmax.
+        """
+        x = x.to(self.device)
+        spatial = list(x.shape[2:])
+        if stride == None:
+            stride = max(1, mask_size // 2)
+        if b_box == None:
+            b_box = [v for size in spatial for v in (0, size)]
+
+        ranges = []
+        for d, size in enumerate(spatial):
+            low = max(0, b_box[2*d])
+            high = min(size, b_box[2*d+1])
+            last = max(low, high - mask_size)
+            starts = list(range(low, last + 1, stride))
+            if starts[-1] != last:
+                starts.append(last)
+            ranges.append(starts)
+        positions = list(itertools.product(*ranges))
+
+        spatial_dims = tuple(range(2, x.dim()))
+        if fill_value == None:
+            fill = x.mean(dim=spatial_dims, keepdim=True)[0]
+        else:
+            fill = torch.full((x.shape[1],) + (1,) * len(spatial), float(fill_value),
+                              dtype=x.dtype, device=x.device)
+
+        with torch.no_grad():
+            baseline = self.ensemble_outputs(x, activate)[0]
+            num_classes = baseline.shape[0]
+            total = torch.zeros([num_classes] + spatial, device=x.device)
+            count = torch.zeros(spatial, device=x.device)
+            for batch_min in range(0, len(positions), batch_size):
+                batch_positions = positions[batch_min:batch_min+batch_size]
+                batch = x.repeat((len(batch_positions),) + (1,) * (x.dim() - 1))
+                regions = [tuple(slice(p, p + mask_size) for p in position)
+                           for position in batch_positions]
+                for i, region in enumerate(regions):
+                    batch[(i, slice(None)) + region] = fill
+                outputs = self.ensemble_outputs(batch, activate)
+                for i, region in enumerate(regions):
+                    total[(slice(None),) + region] += outputs[i].view(
+                        (num_classes,) + (1,) * len(spatial))
+                    count[region] += 1
+            occ_map = torch.where(
+                count > 0,
+                total / count.clamp(min=1),
+                baseline.view((num_classes,) + (1,) * len(spatial)))
+        occ_class = occ_map.argmax(dim=0, keepdim=True)
+        return occ_map[None].cpu().numpy(), occ_class[None].cpu().numpy()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+""" Precomputed temporal-statistics feature store.
+
+Every training sample reduces a num_slices window of a video to the
+statistics channels (ARGUS_RandSpatialCropSlices with reduce_to_statistics).
+ARGUS_build_feature_store computes those statistics once, for every center
+slice a training chain can draw, and stores them per video as a
+memory-mapped .npy of shape (centers, channels, y, x), so one sample is one
+contiguous read.  The label slice of each center (segmentation) is stored
+alongside, and the manifest lists the centers whose label frame is not
+blank, which replaces the retry loop of require_labeled.
+
+ARGUS_FeatureStoreDataset samples from the store.  It takes the trainer's
+transform chain, draws centers the way its crop would (random, or the fixed
+testing_slice), and applies only the transforms that follow the crop, so
+an epoch reads the bytes it needs and computes no statistics.  Transforms
+that run before the statistics (RandRotated of the window) cannot be
+applied to stored statistics and are skipped.
+
+Usage:
+    python ARGUS_feature_store.py ARGUS_ptx_ar.cfg --network vfold --store-dir feature_store
+and set feature_store_dir in the cfg to train from it.
+"""
+
+import os
+import sys
+import copy
+import json
+import hashlib
+import argparse
+import configparser
+
+import numpy as np
+
+from monai.data import Dataset
+from monai.transforms import Compose, Randomizable, apply_transform
+
+from ARGUS_Transforms import ARGUS_RandSpatialCropSlicesd
+from ARGUS_shared_cache import ARGUS_deterministic_prefix, ARGUS_transform_digest
+
+manifest_version = 1
+
+def _crops(transform):
+    """ Indices of the ARGUS_RandSpatialCropSlicesd in a transform chain """
+    transforms = transform.transforms if isinstance(transform, Compose) else [transform]
+    indices = [i for i, t in enumerate(transforms)
+               if isinstance(t, ARGUS_RandSpatialCropSlicesd)]
+    if len(indices) == 0:
+        raise ValueError("Transform chain has no ARGUS_RandSpatialCropSlicesd.")
+    return transforms, indices
+
+def _window_crop(transform):
+    """ The first ARGUS_RandSpatialCropSlicesd, which selects the window """
+    transforms, indices = _crops(transform)
+    return transforms[indices[0]]
+
+def _store_settings(transform):
+    """ Settings of the image statistics that a store and a chain must share """
+    transforms, indices = _crops(transform)
+    window = transforms[indices[0]]
+    reduce = transforms[indices[-1]]
+    image = list(reduce.keys).index("image")
+    if not reduce.reduce_to_statistics[image]:
+        raise ValueError("Feature stores require reduce_to_statistics.")
+    return dict(
+        prefix=ARGUS_transform_digest(ARGUS_deterministic_prefix(transform)),
+        num_slices=window.num_slices[list(window.keys).index("image")],
+        axis=reduce.axis,
+        extended=reduce.extended,
+        include_center_slice=reduce.include_center_slice,
+        include_mean_abs_diff=reduce.include_mean_abs_diff,
+        include_skewness=reduce.include_skewness,
+        include_kurtosis=reduce.include_kurtosis,
+        include_gradient=reduce.include_gradient,
+    )
+
+def _valid_centers(num_frames, crop):
+    """ The centers ARGUS_RandSpatialCropSlicesd.randomize can draw """
+    buffer = 0
+    if crop.boundary*2 == max(crop.num_slices):
+        buffer = 1
+    centers = list(range(crop.boundary, num_frames-crop.boundary+buffer))
+    if len(centers) == 0:
+        centers = [num_frames//2]
+    return centers
+
+def _clamp_center(center, num_frames):
+    return max(min(center, num_frames-1), 0)
+
+def _store_filename(store_dir, image_filename, suffix):
+    name = os.path.splitext(os.path.basename(image_filename))[0]
+    digest = hashlib.sha1(os.path.abspath(image_filename).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(store_dir, f"{name}_{digest}.{suffix}.npy")
+
+def _write_manifest(store_dir, manifest):
+    filename = os.path.join(store_dir, "manifest.json")
+    with open(filename + ".tmp", "w") as fp:
+        json.dump(manifest, fp, indent=1)
+    os.replace(filename + ".tmp", filename)
+
+def ARGUS_load_feature_store_manifest(store_dir):
+    with open(os.path.join(store_dir, "manifest.json")) as fp:
+        manifest = json.load(fp)
+    if manifest.get("version") != manifest_version:
+        raise ValueError(f"Feature store {store_dir} has version"
+                         f" {manifest.get('version')}, expected {manifest_version}.")
+    return manifest
+
+def ARGUS_build_feature_store(trainer, store_dir, dtype="float32", rebuild=False):
+    """ Compute the statistics of every video of trainer for every center.
+
+    The deterministic prefix and the statistics crop of trainer's val
+    chain define the features; the centers are all those the train chain
+    can draw plus the fixed testing centers of the val and test chains.
+    Videos already in the store are skipped unless rebuild, so an
+    interrupted build resumes.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+
+    if len(getattr(trainer, "train_files", [])) == 0:
+        trainer.setup_vfold_files()
+    files = dict()
+    for fold_files in [trainer.train_files, trainer.val_files, trainer.test_files]:
+        for fold in fold_files:
+            for item in fold:
+                files[os.path.abspath(item["image"])] = item
+
+    settings = _store_settings(trainer.val_transforms)
+    manifest = dict(version=manifest_version, settings=settings, videos=dict())
+    manifest_filename = os.path.join(store_dir, "manifest.json")
+    if os.path.exists(manifest_filename) and not rebuild:
+        manifest = ARGUS_load_feature_store_manifest(store_dir)
+        if manifest["settings"] != settings:
+            raise ValueError(f"Feature store {store_dir} was built with other"
+                             f" settings; use rebuild.")
+
+    val_crop = _window_crop(trainer.val_transforms)
+    has_labels = "label" in val_crop.keys
+    prefix = Compose(ARGUS_deterministic_prefix(trainer.val_transforms))
+    train_crop = _window_crop(trainer.train_transforms)
+    fixed_centers = [crop.center_slice
+                     for crop in [val_crop, _window_crop(trainer.test_transforms)]
+                     if crop.center_slice != 99999]
+
+    for num, (image_filename, item) in enumerate(sorted(files.items())):
+        if image_filename in manifest["videos"]:
+            continue
+        print(f"{num+1}/{len(files)}: {image_filename}")
+        data = prefix(dict(item))
+        num_frames = np.asarray(data["image"]).shape[settings["axis"]]
+
+        centers = set(_valid_centers(num_frames, train_crop))
+        centers.update(_clamp_center(center, num_frames) for center in fixed_centers)
+        centers = sorted(centers)
+
+        labeled_rows = None
+        if has_labels:
+            label = np.asarray(data["label"])
+            labeled_rows = [row for row, center in enumerate(centers)
+                            if (np.take(label, center, axis=settings["axis"]) != 0).any()]
+
+        features_filename = _store_filename(store_dir, image_filename, "features")
+        labels_filename = None
+        features = None
+        labels = None
+        crop = copy.deepcopy(val_crop)
+        for row, center in enumerate(centers):
+            crop.center_slice = center
+            out = crop(dict(data))
+            if features is None:
+                features = np.lib.format.open_memmap(
+                    features_filename + ".tmp",
+                    mode="w+",
+                    dtype=dtype,
+                    shape=(len(centers),) + tuple(out["image"].shape))
+                if has_labels:
+                    labels_filename = _store_filename(store_dir, image_filename, "labels")
+                    labels = np.lib.format.open_memmap(
+                        labels_filename + ".tmp",
+                        mode="w+",
+                        dtype=np.float32,
+                        shape=(len(centers),) + tuple(np.asarray(out["label"]).shape))
+            features[row] = np.asarray(out["image"])
+            if labels is not None:
+                labels[row] = np.asarray(out["label"])
+
+        features.flush()
+        del features
+        os.replace(features_filename + ".tmp", features_filename)
+        if labels is not None:
+            labels.flush()
+            del labels
+            os.replace(labels_filename + ".tmp", labels_filename)
+
+        manifest["videos"][image_filename] = dict(
+            num_frames=int(num_frames),
+            centers=centers,
+            labeled_rows=labeled_rows,
+            features=os.path.basename(features_filename),
+            labels=None if labels_filename == None else os.path.basename(labels_filename),
+        )
+        _write_manifest(store_dir, manifest)
+
+    return manifest
+
+class _CenterSampler(Randomizable):
+    """ Random row selection; seeded per DataLoader worker by MONAI """
+
+    def randomize(self, num_rows):
+        return self.R.randint(num_rows)
+
+class ARGUS_FeatureStoreDataset(Dataset):
+    """ Dataset of stored temporal statistics for a trainer's transform chain.
+
+    transform is the trainer's full chain (e.g. self.train_transforms);
+    its first ARGUS_RandSpatialCropSlicesd decides how centers are drawn
+    (center_slice, require_labeled) and the transforms after its last one
+    are applied to the stored statistics.
+    """
+
+    def __init__(self, data, store_dir, transform):
+        self.store_dir = store_dir
+        self.manifest = ARGUS_load_feature_store_manifest(store_dir)
+        settings = _store_settings(transform)
+        if self.manifest["settings"] != settings:
+            raise ValueError(f"Feature store {store_dir} does not match the"
+                             f" transforms; rebuild it with ARGUS_feature_store.py.")
+
+        transforms, indices = _crops(transform)
+        crop = transforms[indices[0]]
+        self.center_slice = crop.center_slice
+        self.require_labeled = crop.require_labeled
+        self.sampler = _CenterSampler()
+
+        self.records = []
+        for item in data:
+            image_filename = os.path.abspath(item["image"])
+            if image_filename not in self.manifest["videos"]:
+                raise KeyError(f"{image_filename} is not in feature store {store_dir}.")
+            self.records.append(self.manifest["videos"][image_filename])
+
+        super().__init__(data=data, transform=Compose(transforms[indices[-1]+1:]))
+        self._arrays = dict()
+
+    def _array(self, filename):
+        # Opened lazily so that each DataLoader worker maps its own view
+        array = self._arrays.get(filename)
+        if array is None:
+            array = np.load(os.path.join(self.store_dir, filename), mmap_mode="r")
+            self._arrays[filename] = array
+        return array
+
+    def row(self, index):
+        record = self.records[index]
+        if self.center_slice != 99999:
+            center = _clamp_center(self.center_slice, record["num_frames"])
+            if center not in record["centers"]:
+                raise KeyError(f"Center {center} of {self.data[index]['image']}"
+                               f" is not in the feature store; rebuild it.")
+            return record["centers"].index(center)
+        rows = record["labeled_rows"]
+        if self.require_labeled and rows:
+            return rows[self.sampler.randomize(len(rows))]
+        return self.sampler.randomize(len(record["centers"]))
+
+    def _transform(self, index):
+        record = self.records[index]
+        row = self.row(index)
+        item = dict(self.data[index])
+        item["image"] = np.array(self._array(record["features"])[row], dtype=np.float32)
+        if record["labels"] != None:
+            item["label"] = np.array(self._array(record["labels"])[row])
+        return apply_transform(self.transform, item)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_arrays"] = dict()
+        return state
+
+def prepare_argparser():
+    parser = argparse.ArgumentParser(description="Build an ARGUS temporal-statistics feature store")
+    parser.add_argument("config_file_name")
+    parser.add_argument("--network", default="vfold")
+    parser.add_argument("--store-dir", default=None,
+                        help="Defaults to feature_store_dir of the cfg")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    parser.add_argument("--rebuild", action="store_true")
+    return parser
+
+def main(args):
+    config = configparser.ConfigParser()
+    config.read(args.config_file_name)
+    store_dir = args.store_dir
+    if store_dir == None:
+        if not config.has_option(args.network, "feature_store_dir"):
+            print("ERROR: No --store-dir given and no feature_store_dir in the cfg.")
+            return 1
+        store_dir = config[args.network]["feature_store_dir"]
+
+    if config.has_option(args.network, "class_fileprefix"):
+        from ARGUS_classification_train import ARGUS_classification_train
+        trainer = ARGUS_classification_train(args.config_file_name, args.network, None)
+    else:
+        from ARGUS_segmentation_train import ARGUS_segmentation_train
+        trainer = ARGUS_segmentation_train(args.config_file_name, args.network, None)
+
+    manifest = ARGUS_build_feature_store(trainer, store_dir, args.dtype, args.rebuild)
+    num_rows = sum(len(v["centers"]) for v in manifest["videos"].values())
+    size = sum(os.path.getsize(os.path.join(store_dir, v[key]))
+               for v in manifest["videos"].values()
+               for key in ["features", "labels"] if v[key] != None)
+    print(f"{len(manifest['videos'])} videos, {num_rows} centers,"
+          f" {size/2**30:.2f} GB in {store_dir}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(prepare_argparser().parse_args()))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+""" Versioned JSON manifests of the vfold splits of a cfg.
+
+setup_vfold_files globs the data directories, assigns the files to folds
+and builds the train/val/test file lists of every fold.  When the cfg sets
+fold_manifest, the first setup_vfold_files writes those lists to that
+JSON file and every later call (training jobs, testing, the select
+scripts) loads them instead, so all of them see the same split and setup
+does no globbing or matching.  With randomize_folds this means all runs
+share one random split; refolding (refold_interval) still re-randomizes
+in memory without touching the manifest.
+
+The manifest records the settings the split depends on, taken from the
+trainer when setup_vfold_files runs.  If they no longer match (a cfg
+change, or a script that changes the data directories or folds before
+setup), setup_vfold_files raises ARGUS_fold_manifest_mismatch rather than
+use or replace a split other jobs rely on.  Scripts that need their own
+split call setup_vfold_files(use_manifest=False).  A manifest, and with
+it the files added to the data directories, is only replaced explicitly:
+    python ARGUS_fold_manifest.py ARGUS_ptx_ar.cfg --network vfold --rebuild
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+
+manifest_version = 1
+
+class ARGUS_fold_manifest_mismatch(Exception):
+    """ Raised when a fold manifest does not match the trainer's settings """
+    pass
+
+class ARGUS_prefix_index():
+    """ Maps a file to the fold prefix its basename starts with.
+
+    Prefixes are matched exactly at the start of the basename, longest
+    first, with one dict lookup per distinct prefix length.
+    """
+
+    def __init__(self, prefixes):
+        self.prefixes = set(prefixes)
+        self.lengths = sorted(set(len(p) for p in self.prefixes), reverse=True)
+
+    def prefix(self, filename):
+        basename = os.path.basename(filename)
+        for length in self.lengths:
+            if basename[:length] in self.prefixes:
+                return basename[:length]
+        return None
+
+def ARGUS_write_fold_manifest(trainer, filename, replace=False):
+    """ Write the trainer's current fold file lists to filename.
+
+    Unless replace, an existing manifest is kept (the first of several
+    concurrent jobs wins); returns True if this call wrote the file.
+    """
+    manifest = dict(
+        version=manifest_version,
+        settings=trainer.fold_settings,
+        num_folds=trainer.num_folds,
+        train_files=trainer.train_files,
+        val_files=trainer.val_files,
+        test_files=trainer.test_files,
+    )
+    dirname = os.path.dirname(filename)
+    if dirname != "" and not os.path.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    with open(tmp_filename, "w") as fp:
+        json.dump(manifest, fp, indent=1)
+    if replace:
+        os.replace(tmp_filename, filename)
+        return True
+    try:
+        # Atomic and fails if another job already wrote the manifest
+        os.link(tmp_filename, filename)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+def ARGUS_load_fold_manifest(trainer, filename):
+    """ Set the trainer's fold file lists from filename.
+
+    Raises ARGUS_fold_manifest_mismatch (leaving the trainer unchanged) if
+    the manifest is of another version or was made with settings other
+    than trainer.fold_settings.
+    """
+    with open(filename) as fp:
+        manifest = json.load(fp)
+    rebuild = ("; rebuild it with ARGUS_fold_manifest.py <cfg> --network"
+               f" {trainer.network_name} --manifest {filename} --rebuild")
+    if manifest.get("version") != manifest_version:
+        raise ARGUS_fold_manifest_mismatch(
+            f"Fold manifest {filename} has version {manifest.get('version')},"
+            f" expected {manifest_version}" + rebuild)
+    # Round trip through JSON so tuples and lists compare equal
+    settings = json.loads(json.dumps(trainer.fold_settings))
+    if manifest["settings"] != settings:
+        changed = sorted(k for k in set(settings) | set(manifest["settings"])
+                         if settings.get(k) != manifest["settings"].get(k))
+        raise ARGUS_fold_manifest_mismatch(
+            f"Fold manifest {filename} was made with other settings"
+            f" ({', '.join(changed)})" + rebuild)
+    trainer.num_folds = manifest["num_folds"]
+    trainer.train_files = manifest["train_files"]
+    trainer.val_files = manifest["val_files"]
+    trainer.test_files = manifest["test_files"]
+    # Every file is in one of the splits of fold 0
+    files = {}
+    for split in [trainer.train_files, trainer.val_files, trainer.test_files]:
+        if len(split) > 0:
+            for file in split[0]:
+                files[file["image"]] = file["label"]
+    trainer.all_train_images = list(files.keys())
+    trainer.all_train_labels = list(files.values())
+    print(f"Loaded {trainer.num_folds} folds from {filename}")
+    return True
+
+def prepare_argparser():
+    parser = argparse.ArgumentParser(description="Build the fold manifest of an ARGUS cfg")
+    parser.add_argument("config_file_name")
+    parser.add_argument("--network", default="vfold")
+    parser.add_argument("--trainer", default=None,
+                        help="module:Class of the trainer, e.g. ARGUS_ptx_ar_train:ARGUS_ptx_ar_train")
+    parser.add_argument("--manifest", default=None,
+                        help="Defaults to the cfg's fold_manifest")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of randomize_folds")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Replace an existing manifest")
+    return parser
+
+def main(args):
+    from ARGUS_train_scheduler import _load_trainer_class
+
+    trainer_class = _load_trainer_class(args.trainer, args.config_file_name, args.network)
+    trainer = trainer_class(args.config_file_name, args.network, device_num=None)
+    filename = args.manifest or trainer.fold_manifest
+    if filename == None:
+        print("ERROR: Give --manifest or set fold_manifest in the cfg.")
+        return 1
+
+    random.seed(args.seed)
+    trainer.fold_manifest = None
+    trainer.setup_vfold_files()
+    if not ARGUS_write_fold_manifest(trainer, filename, replace=args.rebuild):
+        print(f"{filename} exists; use --rebuild to replace it.")
+        return 1
+    for i in range(trainer.num_folds):
+        print(f"VFold {i}: {len(trainer.train_files[i])} train,"
+              f" {len(trainer.val_files[i]) if i < len(trainer.val_files) else 0} val,"
+              f" {len(trainer.test_files[i]) if i < len(trainer.test_files) else 0} test")
+    print(f"Wrote {filename}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(prepare_argparser().parse_args()))
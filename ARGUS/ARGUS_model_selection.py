@@ -0,0 +1,131 @@
+import os
+import json
+import time
+
+import torch
+
+from monai.data import Dataset
+
+from ARGUS_classification_train import ARGUS_classification_train
+from ARGUS_precollated_validation import ARGUS_precollated_validation
+from ARGUS_shared_cache import ARGUS_SharedPersistentDataset
+from ARGUS_feature_store import ARGUS_FeatureStoreDataset
+
+class ARGUS_model_selection():
+    """ Rank every saved checkpoint (runs x vfolds) on one evaluation set.
+
+    The evaluation set (trainer.test_files[vfold_num] through the
+    trainer's test_transforms) is loaded and stacked once; each candidate
+    model is then run over it in batches and scored with the metric of the
+    trainer's test_vfold (mean Dice for segmentation, accuracy times
+    confidence margin for classification).
+
+    Usage, after trainer.setup_vfold_files():
+        selection = ARGUS_model_selection(trainer)
+        selection.evaluate(runs=range(trainer.num_models),
+                           model_vfolds=range(num_folds))
+        selection.write_table("ptx_ar_selection")
+
+    The table lists candidates best first; best_models holds, for each
+    run, the vfold of its best model, as used by the ARGUS_app_* best
+    model lists.
+    """
+
+    def __init__(self, trainer, vfold_num=0, model_type="best", batch_size=32):
+        self.trainer = trainer
+        self.vfold_num = vfold_num
+        self.model_type = model_type
+        self.batch_size = batch_size
+        self.is_classification = isinstance(trainer, ARGUS_classification_train)
+
+        self.eval_set = None
+        self.results = []
+
+    def load(self):
+        trainer = self.trainer
+        data = trainer.test_files[self.vfold_num]
+        if trainer.feature_store_dir != None:
+            ds = ARGUS_FeatureStoreDataset(
+                data=data,
+                store_dir=trainer.feature_store_dir,
+                transform=trainer.test_transforms,
+            )
+        elif trainer.use_persistent_cache:
+            ds = ARGUS_SharedPersistentDataset(
+                data=data,
+                transform=trainer.test_transforms,
+                cache_dir=trainer.persistent_cache_dir,
+            )
+        else:
+            ds = Dataset(data=data, transform=trainer.test_transforms)
+        start = time.perf_counter()
+        self.eval_set = ARGUS_precollated_validation(ds, trainer.device)
+        print(f"Loaded {len(self.eval_set)} evaluation items"
+              f" in {time.perf_counter()-start:.1f} seconds")
+
+    def model_filename(self, run_id, model_vfold):
+        return os.path.join(
+            ".",
+            self.trainer.results_dirname,
+            self.trainer.results_filename_base + "_run" + str(run_id),
+            self.model_type + "_model_" + str(model_vfold) + ".pth")
+
+    def score(self, model):
+        if not self.is_classification:
+            return self.eval_set.dice(model, self.batch_size, self.trainer.num_classes)
+        outputs = self.eval_set.outputs(model, self.batch_size)
+        correct = (outputs.argmax(dim=1) == self.eval_set.labels).float().mean()
+        top2 = outputs.topk(2, dim=1).values
+        confidence = (top2[:, 0] - top2[:, 1]).mean()
+        return (confidence * correct).item()
+
+    def evaluate(self, runs, model_vfolds):
+        """ Score every existing model file of runs x model_vfolds """
+        if self.eval_set == None:
+            self.load()
+        for run_id in runs:
+            model = self.trainer.model[run_id]
+            for model_vfold in model_vfolds:
+                filename = self.model_filename(run_id, model_vfold)
+                if not os.path.exists(filename):
+                    print("ERROR: Model file not found:", filename, "!!")
+                    continue
+                start = time.perf_counter()
+                model.load_state_dict(torch.load(filename, map_location=self.trainer.device))
+                model.eval()
+                metric = self.score(model)
+                self.results.append(dict(
+                    run=run_id,
+                    vfold=model_vfold,
+                    metric=metric,
+                    model_file=filename))
+                print(f"Run {run_id} vfold {model_vfold}: {metric:.4f}"
+                      f" ({time.perf_counter()-start:.1f} seconds)", flush=True)
+        return self.ranking()
+
+    def ranking(self):
+        return sorted(self.results, key=lambda r: r["metric"], reverse=True)
+
+    def best_models(self):
+        """ The vfold of the best model of each run, in run order """
+        best = {}
+        for result in self.ranking():
+            if result["run"] not in best:
+                best[result["run"]] = result["vfold"]
+        return [best[run_id] for run_id in sorted(best)]
+
+    def write_table(self, filename_base):
+        """ Write filename_base.csv (ranked table) and filename_base.json
+        (ranked table and per-run best models) """
+        ranking = self.ranking()
+        with open(filename_base + ".csv", "w") as fp:
+            fp.write("rank,run,vfold,metric,model_file\n")
+            for rank, result in enumerate(ranking):
+                fp.write(f"{rank},{result['run']},{result['vfold']},"
+                         f"{result['metric']:.6f},{result['model_file']}\n")
+        with open(filename_base + ".json", "w") as fp:
+            json.dump(dict(model_type=self.model_type,
+                           ranking=ranking,
+                           best_models=self.best_models()),
+                      fp, indent=1)
+        print("best_models =", self.best_models())
@@ -0,0 +1,169 @@
+import torch
+import torch.nn as nn
+
+from monai.networks.blocks import Convolution, ResidualUnit
+from monai.networks.layers import Act, Norm
+
+class ARGUS_MultiTaskUNet(nn.Module):
+    """ A UNet with one shared encoder and one decoder per task.
+
+    The layers are those of monai.networks.nets.UNet with the same
+    channels, strides and num_res_units, so a single-task UNet state dict
+    (e.g. the pretrained "half" AR model or one member of a task's
+    ensemble) can initialize the encoder and any decoder
+    (see load_unet_state_dict).
+
+    forward(x, task) runs only the decoder of task when task is an int.
+    When task is a tensor of per-sample task ids, the encoder runs once on
+    the whole batch and each task's decoder runs on its samples, so
+    samples of different tasks can share a batch.
+    """
+
+    def __init__(self,
+                 spatial_dims,
+                 in_channels,
+                 out_channels,
+                 channels,
+                 strides,
+                 num_tasks,
+                 num_res_units=0,
+                 kernel_size=3,
+                 up_kernel_size=3,
+                 act=Act.PRELU,
+                 norm=Norm.INSTANCE,
+                 dropout=0.0):
+        super().__init__()
+        self.spatial_dims = spatial_dims
+        self.num_tasks = num_tasks
+        self.num_res_units = num_res_units
+        self.kernel_size = kernel_size
+        self.up_kernel_size = up_kernel_size
+        self.act = act
+        self.norm = norm
+        self.dropout = dropout
+
+        num_levels = len(strides)
+        self.num_levels = num_levels
+        self.encoder = nn.ModuleList([
+            self._down_layer(in_channels if i == 0 else channels[i-1],
+                             channels[i],
+                             strides[i])
+            for i in range(num_levels)])
+        self.bottom = self._down_layer(channels[num_levels-1], channels[num_levels], 1)
+
+        def up_in(i):
+            if i == num_levels-1:
+                return channels[i] + channels[num_levels]
+            return channels[i] * 2
+        self.decoders = nn.ModuleList([
+            nn.ModuleList([
+                self._up_layer(up_in(i),
+                               out_channels if i == 0 else channels[i-1],
+                               strides[i],
+                               i == 0)
+                for i in range(num_levels)])
+            for t in range(num_tasks)])
+
+    def _down_layer(self, in_channels, out_channels, strides):
+        if self.num_res_units > 0:
+            return ResidualUnit(
+                spatial_dims=self.spatial_dims,
+                in_channels=in_channels,
+                out_channels=out_channels,
+                strides=strides,
+                kernel_size=self.kernel_size,
+                subunits=self.num_res_units,
+                act=self.act,
+                norm=self.norm,
+                dropout=self.dropout)
+        return Convolution(
+            spatial_dims=self.spatial_dims,
+            in_channels=in_channels,
+            out_channels=out_channels,
+            strides=strides,
+            kernel_size=self.kernel_size,
+            act=self.act,
+            norm=self.norm,
+            dropout=self.dropout)
+
+    def _up_layer(self, in_channels, out_channels, strides, is_top):
+        conv = Convolution(
+            spatial_dims=self.spatial_dims,
+            in_channels=in_channels,
+            out_channels=out_channels,
+            strides=strides,
+            kernel_size=self.up_kernel_size,
+            act=self.act,
+            norm=self.norm,
+            dropout=self.dropout,
+            conv_only=is_top and self.num_res_units == 0,
+            is_transposed=True)
+        if self.num_res_units > 0:
+            ru = ResidualUnit(
+                spatial_dims=self.spatial_dims,
+                in_channels=out_channels,
+                out_channels=out_channels,
+                strides=1,
+                kernel_size=self.kernel_size,
+                subunits=1,
+                act=self.act,
+                norm=self.norm,
+                dropout=self.dropout,
+                last_conv_only=is_top)
+            conv = nn.Sequential(conv, ru)
+        return conv
+
+    def encode(self, x):
+        skips = []
+        for down in self.encoder:
+            x = down(x)
+            skips.append(x)
+        return skips, self.bottom(x)
+
+    def decode(self, skips, x, task):
+        decoder = self.decoders[task]
+        for i in reversed(range(self.num_levels)):
+            x = decoder[i](torch.cat([skips[i], x], dim=1))
+        return x
+
+    def forward(self, x, task=0):
+        skips, x = self.encode(x)
+        if isinstance(task, int):
+            return self.decode(skips, x, task)
+        task = task.view(-1)
+        outputs = None
+        for t in torch.unique(task).tolist():
+            idx = (task == t).nonzero(as_tuple=True)[0]
+            task_outputs = self.decode([s[idx] for s in skips], x[idx], int(t))
+            if outputs is None:
+                outputs = task_outputs.new_zeros((x.shape[0],) + task_outputs.shape[1:])
+            outputs[idx] = task_outputs
+        return outputs
+
+    def _unet_prefixes(self):
+        """ Keys of the encoder, bottom and decoder layers in a
+        monai.networks.nets.UNet state dict """
+        down = ["model." + "1.submodule." * i + "0." for i in range(self.num_levels)]
+        up = ["model." + "1.submodule." * i + "2." for i in range(self.num_levels)]
+        bottom = "model." + "1.submodule." * self.num_levels
+        return down, bottom, up
+
+    def load_unet_state_dict(self, state_dict, tasks=None, encoder=True):
+        """ Copy the layers of a single-task UNet state dict into the
+        encoder (if encoder) and into the decoders of tasks (default all) """
+        down, bottom, up = self._unet_prefixes()
+        if tasks == None:
+            tasks = range(self.num_tasks)
+        mapping = []
+        if encoder:
+            for i in range(self.num_levels):
+                mapping.append((down[i], ["encoder." + str(i) + "."]))
+            mapping.append((bottom, ["bottom."]))
+        for i in range(self.num_levels):
+            mapping.append((up[i], ["decoders." + str(t) + "." + str(i) + "." for t in tasks]))
+        own_state = self.state_dict()
+        for key, value in state_dict.items():
+            for prefix, own_prefixes in mapping:
+                if key.startswith(prefix):
+                    for own_prefix in own_prefixes:
+                        own_state[own_prefix + key[len(prefix):]].copy_(value)
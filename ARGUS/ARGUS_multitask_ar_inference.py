@@ -0,0 +1,144 @@
+import configparser
+import json
+
+import torch
+
+from monai.networks.layers import Norm
+
+from ARGUS_segmentation_inference import ARGUS_segmentation_inference
+from ARGUS_multitask import ARGUS_MultiTaskUNet
+
+from ARGUS_Profiler import ARGUS_profiled
+
+from ARGUS_preprocess_butterfly import ARGUS_preprocess_butterfly
+from ARGUS_preprocess_sonosite import ARGUS_preprocess_sonosite
+from ARGUS_preprocess_clarius import ARGUS_preprocess_clarius
+
+class ARGUS_multitask_ar_inference(ARGUS_segmentation_inference):
+    """ AR inference for several tasks (PTX, PNB, ONSD) from one
+    ARGUS_MultiTaskUNet model file.
+
+    The cfg lists task_names; options prefixed with a task name
+    (e.g. ptx_class_blur) override the shared post-processing options for
+    that task.  set_task() selects the task of the following preprocess()
+    and inference() calls; only that task's decoder is run.
+    """
+
+    post_processing_options = ["class_prior", "class_blur", "class_min_size",
+                               "class_max_size", "class_keep_only_largest",
+                               "class_morph"]
+
+    # The acquisition device each production AR network is preprocessed for
+    default_sources = {"ptx": "Sonosite", "pnb": "Butterfly", "onsd": "Butterfly"}
+
+    def __init__(self, config_file_name="ARGUS_multitask_ar.cfg", network_name="final", device_num=0, source=None):
+        super().__init__(config_file_name, network_name, device_num)
+
+        config = configparser.ConfigParser()
+        config.read(config_file_name)
+        self.task_names = json.loads(config[network_name]['task_names'])
+
+        self.task_options = []
+        for task_name in self.task_names:
+            options = {}
+            for name in self.post_processing_options:
+                value = getattr(self, name)
+                if config.has_option(network_name, task_name + "_" + name):
+                    value = json.loads(config[network_name][task_name + "_" + name])
+                    if name == "class_keep_only_largest":
+                        value = [bool(x) for x in value]
+                options[name] = value
+            self.task_options.append(options)
+
+        self.task_preprocess = []
+        for task_name in self.task_names:
+            task_source = source
+            if task_source == None:
+                task_source = self.default_sources.get(task_name, "Butterfly")
+            if task_source == "Sonosite":
+                self.task_preprocess.append(ARGUS_preprocess_sonosite(new_size=[self.size_x, self.size_y]))
+            elif task_source == "Clarius":
+                self.task_preprocess.append(ARGUS_preprocess_clarius(new_size=[self.size_x, self.size_y]))
+            else:
+                self.task_preprocess.append(ARGUS_preprocess_butterfly(new_size=[self.size_x, self.size_y]))
+
+        # One model replaces the per-task ensembles
+        self.num_models = 1
+        self.model = [ARGUS_MultiTaskUNet(
+            spatial_dims=self.net_in_dims,
+            in_channels=self.net_in_channels,
+            out_channels=self.num_classes,
+            channels=self.net_layer_channels,
+            strides=self.net_layer_strides,
+            num_tasks=len(self.task_names),
+            num_res_units=self.net_num_residual_units,
+            norm=Norm.BATCH,
+        ).to(self.device)]
+
+        self.task = 0
+        self.set_task(0)
+
+    def load_model(self, filename):
+        """ Load the single multi-task model file """
+        super().load_model(0, filename)
+
+    def task_index(self, task):
+        if isinstance(task, str):
+            return self.task_names.index(task)
+        return task
+
+    def set_task(self, task):
+        """ Select the task (name or index) of later calls """
+        self.task = self.task_index(task)
+        for name, value in self.task_options[self.task].items():
+            setattr(self, name, value)
+
+    def preprocess(self, vid, lbl=None, slice_num=None, crop_data=True, scale_data=True, rotate_data=True, preprocess_cache=None):
+        if crop_data:
+            vid = self.source_preprocess(self.task_preprocess[self.task], vid, preprocess_cache)
+        super().preprocess(vid, lbl, slice_num, scale_data, rotate_data)
+
+    @ARGUS_profiled
+    def batch_probabilities(self, input_tensors, batch_size=None, tasks=None):
+        """ Probabilities for a list of input tensors, running the encoder
+        once per batch and, per sample, the decoder of its task (default
+        the current task) """
+        if tasks == None:
+            tasks = [self.task] * len(input_tensors)
+        tasks = [self.task_index(t) for t in tasks]
+        prob_totals = []
+        if batch_size == None:
+            batch_size = max(1, len(input_tensors))
+        current_task = self.task
+        with torch.no_grad():
+            for batch_min in range(0, len(input_tensors), batch_size):
+                batch_tensors = input_tensors[batch_min:batch_min+batch_size]
+                batch_tasks = tasks[batch_min:batch_min+batch_size]
+                batch = torch.cat([t[0] for t in batch_tensors]).to(self.device)
+                if len(set(batch_tasks)) == 1:
+                    test_outputs = self.model[0](batch, batch_tasks[0])
+                else:
+                    test_outputs = self.model[0](
+                        batch, torch.tensor(batch_tasks, device=batch.device))
+                for i in range(len(batch_tensors)):
+                    self.set_task(batch_tasks[i])
+                    prob_totals.append(self.clean_probabilities_array(test_outputs[i].cpu()))
+        self.set_task(current_task)
+        return prob_totals
+
+    @ARGUS_profiled
+    def batch_inference(self, input_tensors, batch_size=None, tasks=None):
+        """ Class arrays for a list of input tensors of possibly different
+        tasks (see batch_probabilities) """
+        if tasks == None:
+            tasks = [self.task] * len(input_tensors)
+        current_task = self.task
+        class_arrays = []
+        probs = self.batch_probabilities(input_tensors, batch_size, tasks)
+        for task, prob_total in zip(tasks, probs):
+            self.set_task(task)
+            self.prob_array = self.clean_probabilities_array(prob_total, use_blur=False)
+            self.class_array = self.classify_probabilities_array(self.prob_array)
+            class_arrays.append(self.class_array)
+        self.set_task(current_task)
+        return class_arrays
@@ -9,6 +9,8 @@ from monai.inferers import sliding_window_inference
 
 from ARGUS_segmentation_inference import ARGUS_segmentation_inference
 
+from ARGUS_Profiler import ARGUS_profiled
+
 from ARGUS_preprocess_butterfly import ARGUS_preprocess_butterfly
 from ARGUS_preprocess_sonosite import ARGUS_preprocess_sonosite
 from ARGUS_preprocess_clarius import ARGUS_preprocess_clarius
@@ -25,17 +27,18 @@ class ARGUS_onsd_ar_inference(ARGUS_segmentation_inference):
         elif source=="Clarius":
             self.preprocess_onsd = ARGUS_preprocess_clarius(new_size=[self.size_x, self.size_y])
         
-    def preprocess(self, vid, lbl=None, slice_num=None, crop_data=True, scale_data=True, rotate_data=True):
+    def preprocess(self, vid, lbl=None, slice_num=None, crop_data=True, scale_data=True, rotate_data=True, preprocess_cache=None):
         if crop_data:
-            self.preprocessed_onsd_video = self.preprocess_onsd.process( vid )
+            self.preprocessed_onsd_video = self.source_preprocess(self.preprocess_onsd, vid, preprocess_cache)
         else:
             self.preprocessed_onsd_video = vid
             
         super().preprocess(self.preprocessed_onsd_video, lbl, slice_num, scale_data, rotate_data)
 
-    def volume_preprocess(self, vid, lbl_img=None, crop_data=True, slice_num=None, scale_data=True, rotate_data=True):
+    @ARGUS_profiled
+    def volume_preprocess(self, vid, lbl_img=None, crop_data=True, slice_num=None, scale_data=True, rotate_data=True, preprocess_cache=None):
         if crop_data:
-            self.preprocessed_onsd_video = self.preprocess_onsd.process( vid )
+            self.preprocessed_onsd_video = self.source_preprocess(self.preprocess_onsd, vid, preprocess_cache)
         else:
             self.preprocessed_onsd_video = vid
             
@@ -89,6 +92,7 @@ class ARGUS_onsd_ar_inference(ARGUS_segmentation_inference):
         else:
             self.label_image = None
 
+    @ARGUS_profiled
     def volume_inference(self, step=5, slice_min=None, slice_max=None, use_cache=False):
         roi_size = (self.size_x, self.size_y)
 
@@ -0,0 +1,217 @@
+import os
+import threading
+
+from time import perf_counter, thread_time
+from traceback import print_exception
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import itk
+import torch
+
+from ARGUS_Timing import ARGUS_time_this
+
+def ARGUS_set_stage_threads(num_threads):
+    """ Default per-stage thread budget: torch intra-op threads.
+
+    With torch's OpenMP backend the intra-op thread count is taken from
+    the calling thread, so concurrently running stages each see their own
+    budget.
+    """
+    torch.set_num_threads(num_threads)
+
+def ARGUS_set_pipeline_threads(num_threads):
+    """ Default thread budget of a whole run: ITK filters.
+
+    ITK's default thread count is process-global, so setting it per stage
+    would let whichever concurrent stage started last decide it for all
+    of them.  It is set once, before any stage starts, and applies to the
+    filters created during the run.
+    """
+    itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(num_threads)
+
+class ARGUS_pipeline_abort(Exception):
+    """ Raised by a stage to stop the pipeline with a message and no traceback """
+    pass
+
+class ARGUS_stage():
+    """ One node of an ARGUS_pipeline.
+
+    Args:
+        name: unique stage name.  A non-None return value of func is
+            stored in the context under this name.
+        func: callable taking the shared context dict.
+        depends: names of stages that must finish (or be skipped) first.
+            They must be declared before this stage.
+        threads: thread budget for this stage (None = all threads).
+        timer: name passed to time_this (defaults to name).
+        group: name of the summary timer this stage contributes to.
+        condition: callable taking the context; the stage is skipped
+            when it returns False.  Evaluated once depends are done.
+        error: message printed if func raises.
+    """
+
+    def __init__(self,
+                 name,
+                 func,
+                 depends=[],
+                 threads=None,
+                 timer=None,
+                 group=None,
+                 condition=None,
+                 error=None):
+        self.name = name
+        self.func = func
+        self.depends = list(depends)
+        self.threads = threads
+        self.timer = timer if timer != None else name
+        self.group = group
+        self.condition = condition
+        self.error = error
+
+class ARGUS_pipeline():
+    """ Executor for a graph of ARGUS_stage.
+
+    Stages whose dependencies are satisfied run concurrently as long as
+    the sum of their thread budgets fits in num_threads (a stage is always
+    started if nothing else is running).  A stage's budget applies to its
+    torch threads (set_threads); ITK filters share the run's num_threads
+    (set_pipeline_threads).  Every executed stage is recorded
+    in self.timeline with wall and thread-CPU time relative to the start
+    of run().
+    """
+
+    def __init__(self,
+                 stages,
+                 num_threads=None,
+                 time_this=ARGUS_time_this,
+                 set_threads=ARGUS_set_stage_threads,
+                 set_pipeline_threads=ARGUS_set_pipeline_threads):
+        self.stages = list(stages)
+        if num_threads == None:
+            num_threads = os.cpu_count()
+        self.num_threads = max(1, num_threads)
+        self.time_this = time_this
+        self.set_threads = set_threads
+        self.set_pipeline_threads = set_pipeline_threads
+
+        names = set()
+        for stage in self.stages:
+            if stage.name in names:
+                raise ValueError(f"Stage {stage.name} defined twice.")
+            for dep in stage.depends:
+                if dep not in names:
+                    raise ValueError(
+                        f"Stage {stage.name} depends on {dep},"
+                        f" which is not declared before it.")
+            names.add(stage.name)
+
+        self.timeline = []
+        self._timeline_lock = threading.Lock()
+        self._start = 0
+
+    def stage_threads(self, stage):
+        if stage.threads == None:
+            return self.num_threads
+        return max(1, min(stage.threads, self.num_threads))
+
+    def _run_stage(self, stage, context, threads):
+        if self.set_threads != None:
+            self.set_threads(threads)
+        start = perf_counter()
+        cpu_start = thread_time()
+        try:
+            with self.time_this(stage.timer):
+                result = stage.func(context)
+        finally:
+            end = perf_counter()
+            with self._timeline_lock:
+                self.timeline.append(dict(
+                    name=stage.name,
+                    group=stage.group,
+                    thread=threading.current_thread().name,
+                    threads=threads,
+                    start=start - self._start,
+                    end=end - self._start,
+                    elapsed=end - start,
+                    cpu=thread_time() - cpu_start,
+                ))
+        if result is not None:
+            context[stage.name] = result
+
+    def run(self, context):
+        """ Run all stages.  Returns False if any stage failed. """
+        self.timeline = []
+        if self.set_pipeline_threads != None:
+            self.set_pipeline_threads(self.num_threads)
+        self._start = perf_counter()
+
+        pending = list(self.stages)
+        finished = set()
+        running = dict()
+        used_threads = 0
+        failed = False
+
+        with ThreadPoolExecutor(max_workers=len(self.stages)) as pool:
+            while (pending and not failed) or running:
+                progress = True
+                while progress and not failed:
+                    progress = False
+                    for stage in list(pending):
+                        if not all(dep in finished for dep in stage.depends):
+                            continue
+                        if stage.condition != None and not stage.condition(context):
+                            pending.remove(stage)
+                            finished.add(stage.name)
+                            progress = True
+                            continue
+                        threads = self.stage_threads(stage)
+                        if running and used_threads + threads > self.num_threads:
+                            continue
+                        pending.remove(stage)
+                        used_threads += threads
+                        future = pool.submit(self._run_stage, stage, context, threads)
+                        running[future] = (stage, threads)
+                        progress = True
+
+                if not running:
+                    break
+
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, threads = running.pop(future)
+                    used_threads -= threads
+                    exc = future.exception()
+                    if exc == None:
+                        finished.add(stage.name)
+                        continue
+                    failed = True
+                    if isinstance(exc, ARGUS_pipeline_abort):
+                        print(f"ERROR: {exc}")
+                    else:
+                        if stage.error != None:
+                            print(f"ERROR: {stage.error}")
+                        print_exception(type(exc), exc, exc.__traceback__, limit=0)
+
+        if pending and not failed:
+            print(f"ERROR: Stages never ran: {[s.name for s in pending]}")
+            failed = True
+
+        self.timeline.sort(key=lambda x: x["start"])
+        return not failed
+
+    def group_elapsed(self):
+        """ Wall time spanned by the stages in each group """
+        spans = dict()
+        for entry in self.timeline:
+            if entry["group"] == None:
+                continue
+            start, end = spans.get(entry["group"], (entry["start"], entry["end"]))
+            spans[entry["group"]] = (min(start, entry["start"]), max(end, entry["end"]))
+        return {group: end - start for group, (start, end) in spans.items()}
+
+    def print_timeline(self):
+        print("   Timeline:")
+        for entry in self.timeline:
+            print(f"      {entry['start']:8.3f} - {entry['end']:8.3f}"
+                  f" ({entry['elapsed']:7.3f}s wall, {entry['cpu']:7.3f}s cpu,"
+                  f" {entry['threads']} threads) {entry['name']}")
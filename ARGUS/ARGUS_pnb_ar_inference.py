@@ -17,9 +17,9 @@ class ARGUS_pnb_ar_inference(ARGUS_segmentation_inference):
         elif source=="Clarius":
             self.preprocess_pnb = ARGUS_preprocess_clarius(new_size=[self.size_x, self.size_y])
         
-    def preprocess(self, vid, lbl=None, slice_num=None, crop_data=True, scale_data=True, rotate_data=True):
+    def preprocess(self, vid, lbl=None, slice_num=None, crop_data=True, scale_data=True, rotate_data=True, preprocess_cache=None):
         if crop_data:
-            self.preprocessed_pnb_video = self.preprocess_pnb.process( vid )
+            self.preprocessed_pnb_video = self.source_preprocess(self.preprocess_pnb, vid, preprocess_cache)
         else:
             self.preprocessed_pnb_video = vid
         super().preprocess(self.preprocessed_pnb_video, lbl, slice_num, scale_data, rotate_data)
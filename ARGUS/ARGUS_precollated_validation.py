@@ -0,0 +1,103 @@
+import torch
+
+class ARGUS_precollated_validation():
+    """ A validation set held as one stacked input and label tensor.
+
+    The segmentation val transforms are deterministic (fixed
+    testing_slice), so the set is built once per fold and each periodic
+    validation is a few large batched forwards plus a vectorized one-hot
+    Dice, without a DataLoader, decollation or per-item AsDiscrete.
+
+    dice() matches DiceMetric(include_background=False, reduction="mean")
+    applied to argmax/one-hot outputs: classes absent from an item's label
+    are ignored, each item's Dice is the mean over its remaining classes,
+    and the result is the mean over items with at least one such class.
+
+    Items with a task_key entry (multi-task AR training) are passed to the
+    model with their task ids, and dice() can also report each task.
+    """
+
+    def __init__(self, dataset, device, image_key="image", label_key="label", task_key="task"):
+        inputs = []
+        labels = []
+        tasks = []
+        for i in range(len(dataset)):
+            item = dataset[i]
+            inputs.append(torch.as_tensor(item[image_key], dtype=torch.float))
+            labels.append(torch.as_tensor(item[label_key]))
+            if task_key in item:
+                tasks.append(int(item[task_key]))
+        self.device = device
+        self.inputs = torch.stack(inputs).to(device)
+        self.labels = torch.stack(labels).to(device).long()
+        self.tasks = None
+        if len(tasks) == len(inputs) and len(tasks) > 0:
+            self.tasks = torch.tensor(tasks, device=device)
+
+    def __len__(self):
+        return self.inputs.shape[0]
+
+    def nbytes(self):
+        return (self.inputs.element_size() * self.inputs.nelement()
+                + self.labels.element_size() * self.labels.nelement())
+
+    def forward(self, model, start, stop):
+        if self.tasks is None:
+            return model(self.inputs[start:stop])
+        return model(self.inputs[start:stop], self.tasks[start:stop])
+
+    def outputs(self, model, batch_size):
+        """ Raw network outputs for the whole set (small outputs only,
+        e.g. class logits) """
+        outputs = []
+        with torch.no_grad():
+            for start in range(0, len(self), batch_size):
+                outputs.append(self.forward(model, start, start+batch_size))
+        return torch.cat(outputs)
+
+    def predict(self, model, batch_size):
+        """ Argmax class of each pixel, as a (N, 1, ...) tensor """
+        preds = []
+        with torch.no_grad():
+            for start in range(0, len(self), batch_size):
+                outputs = self.forward(model, start, start+batch_size)
+                preds.append(torch.argmax(outputs, dim=1, keepdim=True))
+        return torch.cat(preds)
+
+    def dice(self, model, batch_size, num_classes, per_task=False):
+        """ Mean Dice of the foreground classes over the validation set;
+        with per_task=True also a list of the mean Dice of each task """
+        return self.dice_of(self.predict(model, batch_size), num_classes, per_task)
+
+    def dice_of(self, pred, num_classes, per_task=False, labels=None):
+        """ dice() of given (N, 1, ...) class predictions, against labels
+        (default the set's labels) """
+        if labels is None:
+            labels = self.labels
+        classes = torch.arange(1, num_classes, device=self.device).view(
+            1, -1, *([1] * (pred.dim() - 2)))
+        pred_onehot = (pred == classes)
+        label_onehot = (labels == classes)
+        dims = tuple(range(2, pred_onehot.dim()))
+        intersection = (pred_onehot & label_onehot).sum(dim=dims).float()
+        denominator = pred_onehot.sum(dim=dims).float() + label_onehot.sum(dim=dims).float()
+        present = label_onehot.sum(dim=dims) > 0
+        dice = torch.where(present,
+                           2.0 * intersection / denominator.clamp(min=1),
+                           torch.zeros_like(intersection))
+        num_present = present.sum(dim=1)
+        item_dice = dice.sum(dim=1) / num_present.clamp(min=1)
+        valid = num_present > 0
+
+        def mean_dice(items):
+            if not items.any():
+                return 0.0
+            return item_dice[items].mean().item()
+
+        if not per_task:
+            return mean_dice(valid)
+        task_dice = []
+        if self.tasks is not None:
+            for t in range(int(self.tasks.max().item()) + 1):
+                task_dice.append(mean_dice(valid & (self.tasks == t)))
+        return mean_dice(valid), task_dice
@@ -7,6 +7,8 @@ from os import path
 import itk
 from itk import TubeTK as tube
 
+from ARGUS_Profiler import ARGUS_profiled
+
 class ARGUS_preprocess_butterfly():
 
     def __init__(self, new_size=None):
@@ -95,17 +97,19 @@ class ARGUS_preprocess_butterfly():
         else:
             new_size = [320,320]
         
-            
+        tmp_new_img = self.crop(vid)
+
+        return self.resample(tmp_new_img, new_size)
+
+    @ARGUS_profiled
+    def get_calibration(self, vid):
+        """ Find the ruler and the imaging region (spacing and crop bounds) """
         vid_array = itk.GetArrayViewFromImage(vid)
         tic_num,tic_min,tic_max,tic_diff = self.get_roi(vid_array)
 
         pixel_spacing = 2/tic_diff
-        spacing = [pixel_spacing,pixel_spacing,vid.GetSpacing()[2]]
-        vid.SetSpacing(spacing)
 
-        crop_min_z = 0
-        crop_max_z = vid.shape[0]
-        mid_z = crop_max_z//2
+        mid_z = vid_array.shape[0]//2
         
         crop_min_y = int(tic_min+tic_diff)
         crop_max_y = int(tic_max-tic_diff)
@@ -123,6 +127,27 @@ class ARGUS_preprocess_butterfly():
             count = np.count_nonzero(vid_array[mid_z,:,max_x]//10)
         crop_min_x = min_x + 10
         crop_max_x = max_x - 10
+
+        return dict(
+            pixel_spacing=pixel_spacing,
+            crop_min=[crop_min_x, crop_min_y],
+            crop_max=[crop_max_x, crop_max_y])
+
+    @ARGUS_profiled
+    def crop(self, vid, calibration=None):
+        """ Set the spacing and crop to the imaging region """
+        if calibration == None:
+            calibration = self.get_calibration(vid)
+
+        pixel_spacing = calibration["pixel_spacing"]
+        spacing = [pixel_spacing,pixel_spacing,vid.GetSpacing()[2]]
+        vid.SetSpacing(spacing)
+
+        crop_min_z = 0
+        crop_max_z = vid.shape[0]
+        
+        crop_min_x,crop_min_y = calibration["crop_min"]
+        crop_max_x,crop_max_y = calibration["crop_max"]
         
         Crop = tube.CropImage.New(Input=vid)
         Crop.SetMin([crop_min_x,crop_min_y,crop_min_z])
@@ -130,6 +155,14 @@ class ARGUS_preprocess_butterfly():
         Crop.Update()
         tmp_new_img = Crop.GetOutput()
 
+        return tmp_new_img
+
+    @ARGUS_profiled
+    def resample(self, tmp_new_img, new_size=None):
+        """ Blur (if downsampling) and resample a cropped video to new_size """
+        if new_size == None:
+            new_size = self.new_size
+
         org = list(tmp_new_img.GetOrigin())
         indx = list(tmp_new_img.GetLargestPossibleRegion().GetIndex())
         sz = list(tmp_new_img.GetLargestPossibleRegion().GetSize())
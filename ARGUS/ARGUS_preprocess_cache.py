@@ -0,0 +1,104 @@
+import threading
+
+from time import perf_counter
+
+from ARGUS_Timing import ARGUS_time_this
+
+class ARGUS_preprocess_cache():
+    """ Per-request cache of source (probe) preprocessed videos.
+
+    Task identification and the task networks run the same source
+    preprocessor (ruler detection, crop, blur, resample) over the same
+    video.  Results are keyed by (source, new_size, frame range) so that
+    each is only computed once per request.  Preprocessors that provide
+    separate crop() and resample() steps (Butterfly, Clarius) also share
+    the size-independent crop between networks that use different sizes.
+    Preprocessors without those steps (Sonosite linearization) do not
+    depend on new_size, so they are keyed by (source, None, frame range).
+
+    Lookups are thread safe: concurrent requests for the same key wait
+    for a single computation.
+    """
+
+    def __init__(self, time_this=ARGUS_time_this):
+        self.time_this = time_this
+
+        self._cache = dict()
+        self._cost = dict()
+        self._lock = threading.Lock()
+        self._key_locks = dict()
+
+        self.hits = 0
+        self.misses = 0
+        self.time_saved = 0
+
+    def clear(self):
+        with self._lock:
+            self._cache = dict()
+            self._cost = dict()
+            self._key_locks = dict()
+
+    def _frame_range(self, vid_img):
+        region = vid_img.GetLargestPossibleRegion()
+        min_frame = region.GetIndex()[2]
+        max_frame = min_frame + region.GetSize()[2]
+        return (min_frame, max_frame)
+
+    def _lookup(self, key, name, func):
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            if key in self._cache:
+                with self._lock:
+                    self.hits += 1
+                    self.time_saved += self._cost[key]
+                with self.time_this(f"Preprocess Cache: Hit {name}"):
+                    return self._cache[key]
+
+            with self.time_this(f"Preprocess Cache: Miss {name}"):
+                start = perf_counter()
+                result = func()
+                cost = perf_counter() - start
+            with self._lock:
+                self.misses += 1
+                self._cache[key] = result
+                self._cost[key] = cost
+        return result
+
+    def calibrate(self, preprocessor, vid_img):
+        """ Run the size-independent part of the source preprocessing """
+        source = type(preprocessor).__name__
+        frames = self._frame_range(vid_img)
+
+        if not hasattr(preprocessor, "crop"):
+            return self._lookup(
+                (source, None, frames),
+                f"{source} process",
+                lambda: preprocessor.process(vid_img))
+
+        return self._lookup(
+            (source, None, frames),
+            f"{source} crop",
+            lambda: preprocessor.crop(vid_img))
+
+    def process(self, preprocessor, vid_img):
+        source = type(preprocessor).__name__
+        frames = self._frame_range(vid_img)
+
+        if not hasattr(preprocessor, "crop"):
+            return self.calibrate(preprocessor, vid_img)
+
+        new_size = preprocessor.new_size
+        if new_size == None:
+            new_size = [320, 320]
+        new_size = tuple(new_size)
+
+        def crop_and_resample():
+            crop_img = self.calibrate(preprocessor, vid_img)
+            return preprocessor.resample(crop_img, new_size)
+
+        return self._lookup(
+            (source, new_size, frames),
+            f"{source} resample {list(new_size)}",
+            crop_and_resample)
@@ -4,6 +4,8 @@ from os import path
 import itk
 itkResampleImageUsingMapFilter = itk.itkARGUS.ResampleImageUsingMapFilter
 
+from ARGUS_Profiler import ARGUS_profiled
+
 ####
 # Estimate Zoom and Depth
 ####
@@ -109,6 +111,7 @@ class ARGUS_preprocess_sonosite():
         else:
             return vid
     
+    @ARGUS_profiled
     def process(self, vid_img):
         vid = itk.GetArrayViewFromImage(vid_img)
         
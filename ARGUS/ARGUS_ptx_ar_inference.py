@@ -19,9 +19,9 @@ class ARGUS_ptx_ar_inference(ARGUS_segmentation_inference):
             self.preprocess_ptx = ARGUS_preprocess_clarius(new_size=[self.size_x, self.size_y])
             
             
-    def preprocess(self, vid_img, lbl=None, slice_num=None, crop_data=True, scale_data=True, rotate_data=True):
+    def preprocess(self, vid_img, lbl=None, slice_num=None, crop_data=True, scale_data=True, rotate_data=True, preprocess_cache=None):
         if crop_data:
-            self.preprocessed_ptx_video = self.preprocess_ptx.process(vid_img)
+            self.preprocessed_ptx_video = self.source_preprocess(self.preprocess_ptx, vid_img, preprocess_cache)
         else:
             self.preprocessed_ptx_video = vid_img
         super().preprocess(self.preprocessed_ptx_video, lbl, slice_num, scale_data, rotate_data)
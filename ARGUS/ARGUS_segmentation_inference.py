@@ -16,6 +16,8 @@ from monai.inferers import sliding_window_inference
 
 from ARGUS_Transforms import *
 
+from ARGUS_Profiler import ARGUS_profiled
+
 class ARGUS_segmentation_inference:
 
     def __init__(self, config_file_name, network_name="final", device_num=0):
@@ -51,6 +53,22 @@ class ARGUS_segmentation_inference:
         self.net_layer_channels = tuple([int(x) for x in json.loads(config[network_name]['layer_channels'])])
         self.net_layer_strides = tuple([int(x) for x in json.loads(config[network_name]['layer_strides'])])
         self.net_num_residual_units = int(config[network_name]['num_residual_units'])
+
+        # A single distilled student (see ARGUS_distillation.py) can be
+        # deployed in place of the ensemble; it may have fewer channels
+        self.student_layer_channels = self.net_layer_channels
+        if config.has_option(network_name, 'student_layer_channels'):
+            self.student_layer_channels = tuple([int(x) for x in json.loads(config[network_name]['student_layer_channels'])])
+        self.use_student = False
+        if config.has_option(network_name, 'use_student'):
+            self.use_student = config[network_name]['use_student'] == "True"
+        self.student_model_file = None
+        if config.has_option(network_name, 'student_model_file'):
+            self.student_model_file = config[network_name]['student_model_file']
+        model_layer_channels = self.net_layer_channels
+        if self.use_student:
+            self.num_models = 1
+            model_layer_channels = self.student_layer_channels
         
         if config.has_option(network_name, 'class_prior'):
             self.class_prior = [float(x) for x in json.loads(config[network_name]['class_prior'])]
@@ -67,7 +85,7 @@ class ARGUS_segmentation_inference:
             spatial_dims=self.net_in_dims,
             in_channels=self.net_in_channels,
             out_channels=self.num_classes,
-            channels=self.net_layer_channels,
+            channels=model_layer_channels,
             strides=self.net_layer_strides,
             num_res_units=self.net_num_residual_units,
             norm=Norm.BATCH,
@@ -115,6 +133,12 @@ class ARGUS_segmentation_inference:
         self.model[model_num].load_state_dict(torch.load(filename, map_location=self.device))
         self.model[model_num].eval()
 
+    def source_preprocess(self, preprocessor, vid_img, preprocess_cache=None):
+        if preprocess_cache != None:
+            return preprocess_cache.process(preprocessor, vid_img)
+        return preprocessor.process(vid_img)
+
+    @ARGUS_profiled
     def preprocess(self, vid_img, lbl_img=None, slice_num=None, scale_data=True, rotate_data=True):
         ImageF = itk.Image[itk.F, 3]
         ImageSS = itk.Image[itk.SS, 3]
@@ -316,19 +340,40 @@ class ARGUS_segmentation_inference:
 
         return class_array.astype(np.short)
     
-    def inference(self):
+    @ARGUS_profiled
+    def batch_probabilities(self, input_tensors, batch_size=None):
+        """ Ensemble-averaged probabilities for a list of input tensors,
+        running each model once per batch of up to batch_size inputs """
         roi_size = (self.size_x, self.size_y)
         prob_size = (self.num_classes, self.size_x, self.size_y)
-        prob_total = np.zeros(prob_size)
+        prob_totals = [np.zeros(prob_size) for i in range(len(input_tensors))]
+        if batch_size == None:
+            batch_size = len(input_tensors)
         with torch.no_grad():
-            for m in range(self.num_models):
-                test_outputs = sliding_window_inference(
-                    self.input_tensor[0].to(self.device), roi_size, 1, self.model[m])
-                prob = self.clean_probabilities_array(test_outputs[0].cpu())
-                prob_total += prob
-        prob_total /= self.num_models
-        self.prob_array = self.clean_probabilities_array(prob_total, use_blur=False)
+            for batch_min in range(0, len(input_tensors), batch_size):
+                batch_tensors = input_tensors[batch_min:batch_min+batch_size]
+                batch = torch.cat([t[0] for t in batch_tensors]).to(self.device)
+                for m in range(self.num_models):
+                    test_outputs = sliding_window_inference(
+                        batch, roi_size, 1, self.model[m])
+                    for i in range(len(batch_tensors)):
+                        prob = self.clean_probabilities_array(test_outputs[i].cpu())
+                        prob_totals[batch_min+i] += prob
+        for prob_total in prob_totals:
+            prob_total /= self.num_models
+        return prob_totals
+
+    @ARGUS_profiled
+    def batch_inference(self, input_tensors, batch_size=None):
+        """ Class arrays for a list of input tensors (see inference) """
+        class_arrays = []
+        for prob_total in self.batch_probabilities(input_tensors, batch_size):
+            self.prob_array = self.clean_probabilities_array(prob_total, use_blur=False)
         
-        self.class_array = self.classify_probabilities_array(self.prob_array)
+            self.class_array = self.classify_probabilities_array(self.prob_array)
+            class_arrays.append(self.class_array)
         
-        return self.class_array
+        return class_arrays
+
+    def inference(self):
+        return self.batch_inference([self.input_tensor])[0]
@@ -23,9 +23,10 @@ from monai.transforms import (
 from monai.metrics import DiceMetric
 from monai.losses import DiceLoss
 from monai.inferers import sliding_window_inference
-from monai.data import PersistentDataset, CacheDataset, DataLoader, Dataset, decollate_batch, list_data_collate
+from monai.data import CacheDataset, DataLoader, Dataset, decollate_batch, list_data_collate
 
 import torch
+from torch.utils.data import DistributedSampler
 
 import configparser
 
@@ -37,8 +38,6 @@ from glob import glob
 
 import random
 
-import pathlib
-
 import itk
 
 import matplotlib.pyplot as plt
@@ -46,6 +45,22 @@ from scipy.ndimage import rotate
 
 from ARGUS_segmentation_inference import ARGUS_segmentation_inference
 from ARGUS_Transforms import ARGUS_RandSpatialCropSlicesd
+from ARGUS_chunked_video import ARGUS_ChunkedVideoReader
+from ARGUS_feature_store import ARGUS_FeatureStoreDataset
+from ARGUS_multitask import ARGUS_MultiTaskUNet
+from ARGUS_precollated_validation import ARGUS_precollated_validation
+from ARGUS_distillation import ARGUS_teacher_ensemble, ARGUS_distillation_loss
+from ARGUS_validation_schedule import ARGUS_validation_schedule
+from ARGUS_fold_manifest import (ARGUS_prefix_index, ARGUS_write_fold_manifest,
+                                 ARGUS_load_fold_manifest)
+from ARGUS_cotraining import (ARGUS_split_member_transforms, ARGUS_member_augmentation,
+                              ARGUS_ensemble_member)
+from ARGUS_distributed import (ARGUS_distributed_world_size, ARGUS_distributed_rank,
+                               ARGUS_is_main_rank,
+                               ARGUS_distributed_model, ARGUS_distributed_mean,
+                               ARGUS_distributed_broadcast_flag,
+                               ARGUS_distributed_seed_transforms)
+from ARGUS_shared_cache import ARGUS_SharedPersistentDataset, ARGUS_print_cache_report
 
 class ARGUS_segmentation_train(ARGUS_segmentation_inference):
     def __init__(self, config_file_name, network_name="vfold", device_num=0):
@@ -74,20 +89,69 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
         self.refold_interval = int(config[network_name]['refold_interval'])
         
         self.validation_interval = int(config[network_name]['validation_interval'])
+        # Epochs between full (resumable) checkpoints
+        self.checkpoint_interval = 10
+        if config.has_option(network_name, 'checkpoint_interval'):
+            self.checkpoint_interval = int(config[network_name]['checkpoint_interval'])
         
+        # Multi-task AR training: one image_dirname (and label_dirname)
+        # per task, one shared encoder and one decoder per task
+        self.task_names = None
+        if config.has_option(network_name, 'task_names'):
+            self.task_names = json.loads(config[network_name]['task_names'])
+            if len(self.task_names) != len(self.image_dirname):
+                print("ERROR: task_names and image_dirname must have the same length")
+
         self.pos_prefix = json.loads(config[network_name]['pos_prefix'])
         self.neg_prefix = json.loads(config[network_name]['neg_prefix'])
 
         self.results_filename_base = config[network_name]['results_filename_base']
         self.results_dirname = config[network_name]['results_dirname']
+
+        # The fold split is saved to (and then loaded from) this manifest;
+        # see ARGUS_fold_manifest.py
+        self.fold_manifest = None
+        if config.has_option(network_name, 'fold_manifest'):
+            self.fold_manifest = config[network_name]['fold_manifest']
+        # Settings of the current split; see vfold_settings()
+        self.fold_settings = None
         
         tmp_str = config[network_name]['use_persistent_cache']
         self.use_persistent_cache = False
         if tmp_str == "True":
             self.use_persistent_cache = True
+        # One content-addressed cache is shared by all folds, runs and splits
+        self.persistent_cache_dir = os.path.join(".", "data_cache", network_name)
+        if config.has_option(network_name, 'persistent_cache_dir'):
+            self.persistent_cache_dir = config[network_name]['persistent_cache_dir']
+        # Precomputed statistics (see ARGUS_feature_store.py) replace the
+        # cached datasets when given
+        self.feature_store_dir = None
+        if config.has_option(network_name, 'feature_store_dir'):
+            self.feature_store_dir = config[network_name]['feature_store_dir']
         
+        # Distillation: the model is trained as a student of the ensemble
+        # in distill_teacher_files (paths relative to the cfg file); see
+        # ARGUS_distillation.py
+        self.distill_teacher_files = []
+        if config.has_option(network_name, 'distill_teacher_files'):
+            self.distill_teacher_files = [
+                os.path.join(os.path.dirname(config_file_name), x)
+                for x in json.loads(config[network_name]['distill_teacher_files'])]
+        self.distill_temperature = 1.0
+        if config.has_option(network_name, 'distill_temperature'):
+            self.distill_temperature = float(config[network_name]['distill_temperature'])
+        self.distill_alpha = 1.0
+        if config.has_option(network_name, 'distill_alpha'):
+            self.distill_alpha = float(config[network_name]['distill_alpha'])
+
         self.max_epochs = int(config[network_name]['max_epochs'])
 
+        # Early stopping and adaptive validation (off unless set in the cfg);
+        # the warm-up defaults to that of best model selection
+        self.validation_schedule_options = ARGUS_validation_schedule.config_options(
+            config, network_name, 100)
+
         self.cache_rate_train = 1
         self.num_workers_train = 6
         self.batch_size_train = 12
@@ -96,35 +160,75 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
         self.num_workers_val = 4
         self.batch_size_val = 2
 
+        # The deterministic val set is stacked into one on-device tensor
+        # once per fold and validated in large batches (no DataLoader)
+        self.precollate_validation = True
+        if config.has_option(network_name, 'precollate_validation'):
+            self.precollate_validation = config[network_name]['precollate_validation'] == "True"
+        self.batch_size_val_precollated = 32
+        self.val_precollated = None
+
         self.cache_rate_test = 0
         self.num_workers_test = 1
         self.batch_size_test = 1
 
+        # Loader settings can be tuned per machine (see ARGUS_train_benchmark.py)
+        for name in ["num_workers_train", "batch_size_train",
+                     "num_workers_val", "batch_size_val", "batch_size_val_precollated",
+                     "num_workers_test", "batch_size_test"]:
+            if config.has_option(network_name, name):
+                setattr(self, name, int(config[network_name][name]))
+
+        # Windows cropped from each loaded training video; a batch of
+        # batch_size_train samples then comes from fewer videos
+        self.num_samples_train = 1
+        if config.has_option(network_name, 'num_samples_train'):
+            self.num_samples_train = int(config[network_name]['num_samples_train'])
+        self.balance_classes_train = False
+        if config.has_option(network_name, 'balance_classes_train'):
+            self.balance_classes_train = config[network_name]['balance_classes_train'] == "True"
+
         self.all_train_images = []
         self.all_train_labels = []
 
+        # Per-member augmentation of co-trained runs (setup_training_vfold)
+        self.member_augmentation = None
+
         self.train_transforms = Compose(
             [
-                LoadImaged(keys=["image", "label"]),
+                LoadImaged(keys=["image", "label"], reader=ARGUS_ChunkedVideoReader()),
                 AsChannelFirstd(keys=["image","label"]),
                 Resized(
                     spatial_size=[self.size_y,self.size_x],
                     mode=['bilinear','nearest-exact'],
                     keys=["image", "label"],
                 ),
+                # Pick the window (and its label slice) before rotating, so
+                # only num_slices frames are rotated.  Rotation is per-frame,
+                # so samples have the same distribution as rotating the whole
+                # video and then cropping (seeded runs draw different ones).
+                ARGUS_RandSpatialCropSlicesd(
+                    num_slices=[self.num_slices, 1],
+                    axis=0,
+                    reduce_to_statistics=[False, False],
+                    num_samples=self.num_samples_train,
+                    balance_classes=self.balance_classes_train,
+                    keys=["image", "label"],
+                ),
                 RandRotated(prob=0.2,
                     range_z=0.15,
                     keep_size=True,
                     keys=['image', 'label'],
                 ),
                 ARGUS_RandSpatialCropSlicesd(
-                    num_slices=[self.num_slices, 1],
+                    num_slices=self.num_slices,
+                    center_slice=self.num_slices//2,
                     axis=0,
-                    reduce_to_statistics=[self.reduce_to_statistics, False],
+                    reduce_to_statistics=self.reduce_to_statistics,
                     extended=self.reduce_to_statistics,
                     include_center_slice=self.reduce_to_statistics,
                     include_gradient=self.reduce_to_statistics,
-                    keys=["image", "label"],
+                    keys=["image"],
                 ),
                 RandFlipd(prob=0.5, spatial_axis=0, keys=["image", "label"]),
                 RandZoomd(prob=0.5, 
@@ -140,7 +244,7 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
 
         self.val_transforms = Compose(
             [
-                LoadImaged(keys=["image", "label"]),
+                LoadImaged(keys=["image", "label"], reader=ARGUS_ChunkedVideoReader()),
                 AsChannelFirstd(keys=["image","label"]),
                 Resized(
                     spatial_size=[self.size_x,self.size_y],
@@ -163,7 +267,7 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
 
         self.test_transforms = Compose(
             [
-                LoadImaged(keys=["image", "label"]),
+                LoadImaged(keys=["image", "label"], reader=ARGUS_ChunkedVideoReader()),
                 AsChannelFirstd(keys=["image","label"]),
                 Resized(
                     spatial_size=[self.size_x,self.size_y],
@@ -185,7 +289,34 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
         )
 
     def init_model(self, model_num):
+        if self.task_names != None:
+            self.model[model_num] = ARGUS_MultiTaskUNet(
+                spatial_dims=self.net_in_dims,
+                in_channels=self.net_in_channels,
+                out_channels=self.num_classes,
+                channels=self.net_layer_channels,
+                strides=self.net_layer_strides,
+                num_tasks=len(self.task_names),
+                num_res_units=self.net_num_residual_units,
+                norm=Norm.BATCH,
+                ).to(self.device)
+            return
+        layer_channels = self.net_layer_channels
+        if len(self.distill_teacher_files) > 0:
+            layer_channels = self.student_layer_channels
         self.model[model_num] = UNet(
+            spatial_dims=self.net_in_dims,
+            in_channels=self.net_in_channels,
+            out_channels=self.num_classes,
+            channels=layer_channels,
+            strides=self.net_layer_strides,
+            num_res_units=self.net_num_residual_units,
+            norm=Norm.BATCH,
+            ).to(self.device)
+
+    def teacher_model(self):
+        """ A new model of the (full width) ensemble architecture """
+        return UNet(
             spatial_dims=self.net_in_dims,
             in_channels=self.net_in_channels,
             out_channels=self.num_classes,
@@ -195,7 +326,36 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
             norm=Norm.BATCH,
             ).to(self.device)
 
-    def setup_vfold_files(self):
+    def vfold_settings(self):
+        """ The settings the fold split depends on, from the current
+        attributes (the select scripts change them after construction) """
+        return dict(
+            image_dirname=self.image_dirname,
+            image_filesuffix=self.image_filesuffix,
+            label_dirname=self.label_dirname,
+            label_filesuffix=self.label_filesuffix,
+            pos_prefix=list(self.pos_prefix),
+            neg_prefix=list(self.neg_prefix),
+            task_names=self.task_names,
+            train_data_portion=self.train_data_portion,
+            validation_data_portion=self.validation_data_portion,
+            test_data_portion=self.test_data_portion,
+            num_folds=self.num_folds,
+            randomize_folds=self.randomize_folds,
+        )
+
+    def setup_vfold_files(self, use_manifest=True):
+        """ Assign the files to folds, or load the assignment from
+        fold_manifest.  use_manifest=False recomputes it without reading or
+        writing the manifest (refolding).  Raises
+        ARGUS_fold_manifest_mismatch if the manifest was made with other
+        settings. """
+        self.fold_settings = self.vfold_settings()
+        if (use_manifest and self.fold_manifest != None
+                and os.path.exists(self.fold_manifest)):
+            ARGUS_load_fold_manifest(self, self.fold_manifest)
+            return
+
         self.all_train_images = []
         for dirname in self.image_dirname:
             self.all_train_images = self.all_train_images + sorted(glob(os.path.join(dirname, self.image_filesuffix)))
@@ -277,6 +437,24 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
         for i in range(self.num_folds):
             print(f"VFold-Prefix[{i}] = {fold_prefix[i]}")
 
+        # Each file's prefix is parsed once, matched exactly at the start
+        # of its basename
+        prefix_index = ARGUS_prefix_index(self.pos_prefix + self.neg_prefix)
+        image_prefixes = [prefix_index.prefix(im) for im in self.all_train_images]
+        label_prefixes = [prefix_index.prefix(se) for se in self.all_train_labels]
+
+        def split_files(split_prefixes):
+            split_prefixes = set(split_prefixes)
+            return [
+                {"image": img, "label": seg}
+                for img, seg in zip(
+                    [im for im, pref in zip(self.all_train_images, image_prefixes)
+                     if pref in split_prefixes],
+                    [se for se, pref in zip(self.all_train_labels, label_prefixes)
+                     if pref in split_prefixes],
+                )
+            ]
+
         self.train_files = []
         self.val_files = []
         self.test_files = []
@@ -329,104 +507,109 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
                     for f in range(i + num_tr + num_va, i + num_tr + num_va + num_te):
                         te_folds.append(fold_prefix[f % self.num_folds])
                     te_folds = list(np.concatenate(te_folds).flat)
-            self.train_files.append(
-                [
-                    {"image": img, "label": seg}
-                    for img, seg in zip(
-                        [
-                            im
-                            for im in self.all_train_images
-                            if any(pref in im for pref in tr_folds)
-                        ],
-                        [
-                            se
-                            for se in self.all_train_labels
-                            if any(pref in se for pref in tr_folds)
-                        ],
-                    )
-                ]
-            )
+            self.train_files.append(split_files(tr_folds))
             if len(va_folds) > 0:
-                self.val_files.append(
-                    [
-                        {"image": img, "label": seg}
-                        for img, seg in zip(
-                            [
-                                im
-                                for im in self.all_train_images
-                                if any(pref in im for pref in va_folds)
-                            ],
-                            [
-                                se
-                                for se in self.all_train_labels
-                                if any(pref in se for pref in va_folds)
-                            ],
-                        )
-                    ]
-                )
+                self.val_files.append(split_files(va_folds))
             if len(te_folds) > 0:
-                self.test_files.append(
-                    [
-                        {"image": img, "label": seg}
-                        for img, seg in zip(
-                            [
-                                im
-                                for im in self.all_train_images
-                                if any(pref in im for pref in te_folds)
-                            ],
-                            [
-                                se
-                                for se in self.all_train_labels
-                                if any(pref in se for pref in te_folds)
-                            ],
-                        )
-                    ]
-                )
+                self.test_files.append(split_files(te_folds))
+            if self.task_names != None:
+                # The task of a file is the index of its image directory
+                task_dirnames = [os.path.abspath(d) for d in self.image_dirname]
+                for files in [self.train_files[-1]] + self.val_files[-1:] + self.test_files[-1:]:
+                    for file in files:
+                        file["task"] = task_dirnames.index(
+                            os.path.dirname(os.path.abspath(file["image"])))
             #print( "**** VFold =", i )
             #print( "   TRAIN", self.train_files[i])
             #print( "   VAL", self.val_files[i])
             #print( "   TEST", self.test_files[i])
 
-    def setup_training_vfold(self, vfold_num, run_num):
+        if use_manifest and self.fold_manifest != None:
+            if not ARGUS_write_fold_manifest(self, self.fold_manifest):
+                # Another job wrote it first; use its split
+                ARGUS_load_fold_manifest(self, self.fold_manifest)
+
+    def setup_training_vfold(self, vfold_num, run_num=0, num_members=1,
+                             keep_augmentation=False):
+        """ num_members > 1 sets up a loader shared by that many
+        co-trained models (see train_vfold_ensemble).  keep_augmentation
+        reuses the members' augmentation transforms, and so continues
+        their random streams, when only the fold files changed (refolding
+        and resuming). """
         self.vfold_num = vfold_num
 
-        if self.use_persistent_cache:
-            persistent_cache = pathlib.Path(
-                ".",
-                "data_cache",
-                self.network_name+"_f"+str(vfold_num)+"_r"+str(run_num)
+        self.train_loader_transforms = self.train_transforms
+        if num_members > 1:
+            self.train_loader_transforms, member_transforms = ARGUS_split_member_transforms(
+                self.train_transforms)
+            if (not keep_augmentation
+                    or self.member_augmentation == None
+                    or len(self.member_augmentation.transforms) != num_members):
+                self.member_augmentation = ARGUS_member_augmentation(
+                    member_transforms, num_members, seed=ARGUS_distributed_rank())
+        else:
+            self.member_augmentation = None
+
+        if self.feature_store_dir != None:
+            train_ds = ARGUS_FeatureStoreDataset(
+                data=self.train_files[self.vfold_num],
+                store_dir=self.feature_store_dir,
+                transform=self.train_loader_transforms,
             )
-            persistent_cache.mkdir(parents=True, exist_ok=True)
-            train_ds = PersistentDataset(
+        elif self.use_persistent_cache:
+            train_ds = ARGUS_SharedPersistentDataset(
                 data=self.train_files[self.vfold_num],
-                transform=self.train_transforms,
-                cache_dir=persistent_cache,
+                transform=self.train_loader_transforms,
+                cache_dir=self.persistent_cache_dir,
             )
+            ARGUS_print_cache_report("Train", train_ds.cache_report())
         else:
             train_ds = CacheDataset(
                 data=self.train_files[self.vfold_num],
-                transform=self.train_transforms,
+                transform=self.train_loader_transforms,
                 cache_rate=self.cache_rate_train,
                 num_workers=self.num_workers_train,
             )
 
 
+        # Each item of the train chain yields num_samples_train samples
+        batch_size = self.batch_size_train
+        if self.feature_store_dir == None:
+            batch_size = max(1, batch_size // self.num_samples_train)
+        # With several ranks (ARGUS_distributed.py) each loads its shard of
+        # the epoch, and batch_size_train is split over the ranks
+        self.train_sampler = None
+        world_size = ARGUS_distributed_world_size()
+        if world_size > 1:
+            self.train_sampler = DistributedSampler(train_ds, shuffle=True)
+            batch_size = max(1, batch_size // world_size)
         self.train_loader = DataLoader(
             train_ds,
-            batch_size=self.batch_size_train,
-            shuffle=True,
+            batch_size=batch_size,
+            shuffle=self.train_sampler == None,
+            sampler=self.train_sampler,
             num_workers=self.num_workers_train,
             collate_fn=list_data_collate,
             pin_memory=True,
         )
 
-        if len(self.val_files) > self.vfold_num and len(self.val_files[self.vfold_num]) > 0:
-            if self.use_persistent_cache:
-                val_ds = PersistentDataset(
+        # Only rank 0 validates
+        if (ARGUS_is_main_rank()
+                and len(self.val_files) > self.vfold_num
+                and len(self.val_files[self.vfold_num]) > 0):
+            if self.feature_store_dir != None:
+                val_ds = ARGUS_FeatureStoreDataset(
+                    data=self.val_files[self.vfold_num],
+                    store_dir=self.feature_store_dir,
+                    transform=self.val_transforms,
+                )
+            elif self.use_persistent_cache:
+                val_ds = ARGUS_SharedPersistentDataset(
                     data=self.val_files[self.vfold_num],
                     transform=self.val_transforms,
-                    cache_dir=persistent_cache,
+                    cache_dir=self.persistent_cache_dir,
                 )
+                ARGUS_print_cache_report("Val", val_ds.cache_report())
             else:
                 val_ds = CacheDataset(
                     data=self.val_files[self.vfold_num],
@@ -434,30 +617,37 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
                     cache_rate=self.cache_rate_val,
                     num_workers=self.num_workers_val
                 )
-            self.val_loader = DataLoader(
-                val_ds,
-                batch_size=self.batch_size_val,
-                num_workers=self.num_workers_val,
-                collate_fn=list_data_collate,
-                pin_memory=True,
-            )
+            self.val_precollated = None
+            if self.precollate_validation:
+                self.val_precollated = ARGUS_precollated_validation(val_ds, self.device)
+                print(f"Val: {len(self.val_precollated)} items precollated"
+                      f" ({self.val_precollated.nbytes()/2**20:.1f} MB)")
+            else:
+                self.val_loader = DataLoader(
+                    val_ds,
+                    batch_size=self.batch_size_val,
+                    num_workers=self.num_workers_val,
+                    collate_fn=list_data_collate,
+                    pin_memory=True,
+                )
 
-    def setup_testing_vfold(self, vfold_num, run_num):
+    def setup_testing_vfold(self, vfold_num, run_num=0):
         self.vfold_num = vfold_num
 
         if len(self.test_files) > self.vfold_num and len(self.test_files[self.vfold_num]) > 0:
-            if self.use_persistent_cache:
-                persistent_cache = pathlib.Path(
-                    ".",
-                    "data_cache",
-                    self.network_name+"_f"+str(vfold_num)+"_r"+str(run_num)
-                    )
-                persistent_cache.mkdir(parents=True, exist_ok=True)
-                test_ds = PersistentDataset(
+            if self.feature_store_dir != None:
+                test_ds = ARGUS_FeatureStoreDataset(
+                    data=self.test_files[self.vfold_num],
+                    store_dir=self.feature_store_dir,
+                    transform=self.test_transforms,
+                )
+            elif self.use_persistent_cache:
+                test_ds = ARGUS_SharedPersistentDataset(
                     data=self.test_files[self.vfold_num],
                     transform=self.test_transforms,
-                    cache_dir=persistent_cache,
+                    cache_dir=self.persistent_cache_dir,
                 )
+                ARGUS_print_cache_report("Test", test_ds.cache_report())
             else:
                 test_ds = CacheDataset(
                     data=self.test_files[self.vfold_num],
@@ -473,121 +663,265 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
                 pin_memory=True,
             )
 
-    def train_vfold(self, run_id=0):
-        model_filename_base = os.path.join(
-            ".",
-            self.results_dirname,
-            self.results_filename_base + "_run" + str(run_id)
-        )
-        if not os.path.exists(model_filename_base):
-            os.makedirs(model_filename_base)
-
-        optimizer = torch.optim.Adam(self.model[run_id].parameters(), 1e-4)
+    def train_vfold(self, run_id=0, resume=False):
+        """ Train model run_id on the current fold.
+
+        Every checkpoint_interval epochs a full checkpoint (model,
+        optimizer, epoch, random states, loss/metric history and best
+        metric) is written.  With resume=True, training continues from
+        that checkpoint if it exists.
+        """
+        self.train_vfold_ensemble([run_id], resume)
+
+    def vfold_files(self):
+        """ [train, val, test] files of the current fold, as saved in
+        checkpoints.  setup_vfold_files adds no val or test list for a
+        fold whose split is empty; [] stands for it here. """
+        files = [self.train_files[self.vfold_num]]
+        for split in [self.val_files, self.test_files]:
+            files.append(split[self.vfold_num] if len(split) > self.vfold_num else [])
+        return files
+
+    def set_vfold_files(self, files):
+        """ Restore the current fold's files from vfold_files() """
+        self.train_files[self.vfold_num] = files[0]
+        for split, split_files in [(self.val_files, files[1]), (self.test_files, files[2])]:
+            while len(split) <= self.vfold_num:
+                split.append([])
+            split[self.vfold_num] = split_files
+
+    def member_transforms(self, member):
+        """ The random transforms applied for a co-trained member, whose
+        states its checkpoints save """
+        if self.member_augmentation == None:
+            return self.train_transforms
+        return self.member_augmentation.transforms[member]
+
+    def train_vfold_ensemble(self, run_ids=None, resume=False):
+        """ Co-train the models run_ids (default all num_models) on the
+        current fold from one data stream.
+
+        Each batch of the train loader is decoded, windowed and reduced to
+        statistics once and then trained on by every model, each with its
+        own optimizer, validation schedule, best model and checkpoint (the
+        files train_vfold writes for that run).  The transforms after the
+        window crop are applied per model (see ARGUS_cotraining.py), so the
+        models still see different flips and zooms.  Call init_model for
+        each run_id and setup_training_vfold(vfold, num_members=len(run_ids))
+        first.  The models share the fold split.
+        """
+        if run_ids == None:
+            run_ids = list(range(self.num_models))
+        if len(run_ids) > 1 and self.member_augmentation == None:
+            print("ERROR: Call setup_training_vfold with num_members =", len(run_ids))
+            return
+
+        teachers = None
+        if len(self.distill_teacher_files) > 0:
+            teachers = ARGUS_teacher_ensemble(
+                self.distill_teacher_files, self.teacher_model, self.device)
+            distill_loss = ARGUS_distillation_loss(
+                self.distill_temperature, self.distill_alpha)
         loss_function = DiceLoss(to_onehot_y=True, softmax=True)
-        dice_metric = DiceMetric(include_background=False, reduction="mean")
-
-        post_pred = Compose(
-            [EnsureType(), AsDiscrete(argmax=True, to_onehot=self.num_classes)]
-        )
-        post_label = Compose(
-            [EnsureType(), AsDiscrete(to_onehot=self.num_classes)]
-        )
-
-        best_metric = -1
-        best_metric_epoch = -1
-        epoch_loss_values = []
-        metric_values = []
 
-        for epoch in range(self.max_epochs):
+        members = []
+        for m, run_id in enumerate(run_ids):
+            members.append(ARGUS_ensemble_member(self, run_id, self.member_transforms(m)))
+
+        if resume:
+            for member in members:
+                files = member.resume(self.device, self.max_epochs)
+                if files != None and files != self.vfold_files():
+                    # Folds were re-randomized (refold_interval) during the run
+                    self.set_vfold_files(files)
+                    self.setup_training_vfold(self.vfold_num, num_members=len(members),
+                                              keep_augmentation=True)
+        for m, member in enumerate(members):
+            member.check_augmentation(self.member_transforms(m))
+        start_epoch = min(member.start_epoch for member in members)
+        ARGUS_distributed_seed_transforms(self.train_loader_transforms, start_epoch)
+        for m, member in enumerate(members):
+            ARGUS_distributed_seed_transforms(member.transforms, start_epoch + m + 1)
+
+        # All-reduces the gradients when running as several ranks
+        for member in members:
+            member.train_model = ARGUS_distributed_model(
+                member.model,
+                find_unused_parameters=self.task_names != None)
+        is_main_rank = ARGUS_is_main_rank()
+
+        for epoch in range(start_epoch, self.max_epochs):
+            active = [m for m, member in enumerate(members) if member.is_training(epoch)]
+            if len(active) == 0:
+                break
+            for m in active:
+                members[m].schedule.start_epoch()
+                members[m].train_model.train()
             print("-" * 10)
             print(f"{self.vfold_num}: epoch {epoch + 1}/{self.max_epochs}",flush=True)
-            self.model[run_id].train()
-            epoch_loss = 0
+            if self.train_sampler != None:
+                self.train_sampler.set_epoch(epoch)
+            epoch_loss = [0] * len(members)
             epoch_size = 0
             for step,batch_data in enumerate(self.train_loader):
-                inputs = batch_data["image"].to(self.device)
-                labels = batch_data["label"].to(self.device)
-                optimizer.zero_grad()
-                outputs = self.model[run_id](inputs)
-                loss = loss_function(outputs, labels)
-                loss.backward()
-                optimizer.step()
-                epoch_loss += loss.item()
+                for m in active:
+                    member = members[m]
+                    member_data = batch_data
+                    if self.member_augmentation != None:
+                        member_data = self.member_augmentation(batch_data, m)
+                    inputs = member_data["image"].to(self.device)
+                    labels = member_data["label"].to(self.device)
+                    member.optimizer.zero_grad()
+                    if self.task_names != None:
+                        outputs = member.train_model(inputs, member_data["task"].to(self.device))
+                    else:
+                        outputs = member.train_model(inputs)
+                    loss = loss_function(outputs, labels)
+                    if teachers != None:
+                        loss = distill_loss(
+                            outputs,
+                            teachers(inputs, self.distill_temperature),
+                            loss)
+                    loss.backward()
+                    member.optimizer.step()
+                    epoch_loss[m] += loss.item()
+                    print(
+                        f"{step} /"
+                        f" {len(self.train_loader)},"
+                        f" run {member.run_id} train_loss: {loss.item():.4f}", flush=True
+                    )
                 epoch_size = step
+
+            for m in active:
+                member = members[m]
+                member_loss = ARGUS_distributed_mean(epoch_loss[m] / epoch_size)
+                member.epoch_loss_values.append(member_loss)
                 print(
-                    f"{step} /"
-                    f" {len(self.train_files[self.vfold_num])//self.train_loader.batch_size},"
-                    f" train_loss: {loss.item():.4f}", flush=True
+                    f"{self.vfold_num} run {member.run_id} epoch {epoch+1}"
+                    f" average loss: {member_loss:.4f}",
+                    flush=True,
                 )
-            epoch_loss /= epoch_size
-            epoch_loss_values.append(epoch_loss)
-            print(
-                f"{self.vfold_num} epoch {epoch+1}" f" average loss: {epoch_loss:.4f}",
-                flush=True,
-            )
-
-            if self.validation_interval > 0 and (epoch + 1) % self.validation_interval == 0:
-                self.model[run_id].eval()
-                with torch.no_grad():
-                    for val_data in self.val_loader:
-                        val_inputs, val_labels = (val_data["image"], val_data["label"])
-                        val_inputs = val_inputs.to(self.device)
-                        val_labels = val_labels.to(self.device)
-                        roi_size = (self.size_x, self.size_y)
-                        val_outputs = sliding_window_inference(
-                            val_inputs, roi_size, self.batch_size_val, self.model[run_id]
-                        )
-                        # val_outputs = self.model[run_id](val_inputs)
-                        val_outputs = [
-                            post_pred(i) for i in decollate_batch(val_outputs)
-                        ]
-                        val_labels = [
-                            post_label(i) for i in decollate_batch(val_labels)
-                        ]
-                        # compute metric for current iteration
-                        dice_metric(y_pred=val_outputs, y=val_labels)
-
-                    # aggregate the final mean dice result
-                    metric = dice_metric.aggregate().item()
-                    # reset the status for next validation round
-                    dice_metric.reset()
 
+                if is_main_rank and member.schedule.should_validate(epoch):
+                    metric = self.validation_metric(member.model)
                     metric_window = 5
-                    metric_values.append(metric)
-                    if epoch>100 and len(metric_values)>metric_window+1:
-                        mean_metric = np.mean(metric_values[-metric_window:])
-                        if mean_metric > best_metric:
-                            best_metric = mean_metric
-                            best_metric_epoch = epoch + 1
+                    member.metric_values.append(metric)
+                    mean_metric = None
+                    if len(member.metric_values)>metric_window+1:
+                        mean_metric = np.mean(member.metric_values[-metric_window:])
+                    if epoch>100 and mean_metric != None:
+                        if mean_metric > member.best_metric:
+                            member.best_metric = mean_metric
+                            member.best_metric_epoch = epoch + 1
                             torch.save(
-                                self.model[run_id].state_dict(),
-                                os.path.join(model_filename_base,
-                                             "best_model_" + str(self.vfold_num) + ".pth"),
+                                member.model.state_dict(),
+                                member.filename("best_model_", self.vfold_num),
                             )
-                            print("saved new best metric model")
+                            print(f"run {member.run_id}: saved new best metric model")
                     print(
-                        f"Current epoch: {epoch + 1}"
+                        f"Run {member.run_id} current epoch: {epoch + 1}"
                         f" current mean dice: {metric:.4f}"
                     )
                     print(
-                        f"Best mean dice: {best_metric:.4f}"
-                        f" at epoch: {best_metric_epoch}"
+                        f"Run {member.run_id} best mean dice: {member.best_metric:.4f}"
+                        f" at epoch: {member.best_metric_epoch}"
                     )
+                    member.stop = member.schedule.update(epoch, mean_metric)
                     torch.save(
-                        self.model[run_id].state_dict(),
-                        os.path.join(model_filename_base,  "last_model_" + str(self.vfold_num) + ".pth"),
+                        member.model.state_dict(),
+                        member.filename("last_model_", self.vfold_num),
                     )
                     np.save(
-                        os.path.join(model_filename_base, "loss_" + str(self.vfold_num) + ".npy"),
-                        epoch_loss_values,
+                        member.filename("loss_", self.vfold_num, ".npy"),
+                        member.epoch_loss_values,
                     )
                     np.save(
-                        os.path.join(model_filename_base, "val_dice_" + str(self.vfold_num) + ".npy"),
-                        metric_values,
+                        member.filename("val_dice_", self.vfold_num, ".npy"),
+                        member.metric_values,
                     )
             if self.randomize_folds and self.refold_interval > 0 and (epoch + 1) % self.refold_interval == 0:
-                self.setup_vfold_files()
-                self.setup_training_vfold(self.vfold_num)
+                self.setup_vfold_files(use_manifest=False)
+                self.setup_training_vfold(self.vfold_num, num_members=len(members),
+                                          keep_augmentation=True)
+                for m, member in enumerate(members):
+                    member.check_augmentation(self.member_transforms(m))
+
+            for m in active:
+                member = members[m]
+                member.stop = ARGUS_distributed_broadcast_flag(member.stop)
+                member.schedule.end_epoch()
+                if (is_main_rank
+                        and self.checkpoint_interval > 0
+                        and ((epoch + 1) % self.checkpoint_interval == 0
+                             or epoch + 1 == self.max_epochs
+                             or member.stop)):
+                    member.save_checkpoint(epoch, self.vfold_files())
+
+        if not is_main_rank:
+            return
+        for member in members:
+            summary = member.schedule.summary()
+            if summary["stopped_epoch"] != None:
+                print(f"{self.vfold_num} run {member.run_id}: early stop at epoch {summary['stopped_epoch']},"
+                      f" {summary['epochs_saved']} of {summary['max_epochs']} epochs saved"
+                      f" ({summary['fraction_saved']*100:.0f}%,"
+                      f" ~{summary['seconds_saved_estimate']/3600:.2f} hours)")
+            print(f"{self.vfold_num} run {member.run_id}: {summary['validations']} validations"
+                  f" ({summary['validations_fixed_interval']} at a fixed interval)")
+            with open(member.filename("schedule_", self.vfold_num, ".json"), "w") as fp:
+                json.dump(summary, fp, indent=1)
+
+    def validation_metric(self, model):
+        """ Mean Dice of model on the current fold's validation set """
+        model.eval()
+        if self.val_precollated != None:
+            # Val images are size_x by size_y, so a direct forward
+            # equals the single-window sliding_window_inference
+            if self.task_names != None:
+                metric, task_metrics = self.val_precollated.dice(
+                    model,
+                    self.batch_size_val_precollated,
+                    self.num_classes,
+                    per_task=True)
+                for task_num, task_metric in enumerate(task_metrics):
+                    print(f"   {self.task_names[task_num]} dice: {task_metric:.4f}")
+                return metric
+            return self.val_precollated.dice(
+                model,
+                self.batch_size_val_precollated,
+                self.num_classes)
+
+        dice_metric = DiceMetric(include_background=False, reduction="mean")
+        post_pred = Compose(
+            [EnsureType(), AsDiscrete(argmax=True, to_onehot=self.num_classes)]
+        )
+        post_label = Compose(
+            [EnsureType(), AsDiscrete(to_onehot=self.num_classes)]
+        )
+        with torch.no_grad():
+            for val_data in self.val_loader:
+                val_inputs, val_labels = (val_data["image"], val_data["label"])
+                val_inputs = val_inputs.to(self.device)
+                val_labels = val_labels.to(self.device)
+                roi_size = (self.size_x, self.size_y)
+                if self.task_names != None:
+                    # Val images are a single window
+                    val_outputs = model(val_inputs, val_data["task"].to(self.device))
+                else:
+                    val_outputs = sliding_window_inference(
+                        val_inputs, roi_size, self.batch_size_val, model
+                    )
+                val_outputs = [
+                    post_pred(i) for i in decollate_batch(val_outputs)
+                ]
+                val_labels = [
+                    post_label(i) for i in decollate_batch(val_labels)
+                ]
+                # compute metric for current iteration
+                dice_metric(y_pred=val_outputs, y=val_labels)
+
+            # aggregate the final mean dice result
+            return dice_metric.aggregate().item()
 
     def test_vfold(self, model_type="best", run_id=0, model_vfold=-1):
         if model_vfold == -1:
@@ -629,12 +963,16 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
                     roi_size = (self.size_x, self.size_y)
                     test_inputs, test_labels = (test_data["image"], test_data["label"])
                     test_inputs = test_inputs.to(self.device)
-                    test_outputs = sliding_window_inference(
-                        test_inputs,
-                        roi_size,
-                        self.batch_size_test,
-                        self.model[run_id],
-                    ).cpu()
+                    if self.task_names != None:
+                        test_outputs = self.model[run_id](
+                            test_inputs, test_data["task"].to(self.device)).cpu()
+                    else:
+                        test_outputs = sliding_window_inference(
+                            test_inputs,
+                            roi_size,
+                            self.batch_size_test,
+                            self.model[run_id],
+                        ).cpu()
                     # val_outputs = self.model[run_id](val_inputs)
                     tmp_outputs = [
                         post_pred(i) for i in decollate_batch(test_outputs)
@@ -644,20 +982,13 @@ class ARGUS_segmentation_train(ARGUS_segmentation_inference):
                     ]
                     # compute metric for current iteration
                     dice_metric(y_pred=tmp_outputs, y=tmp_labels)
-                    if batch_num == 0:
-                        test_images_total = test_data["image"]
-                        test_labels_total = test_data["label"]
-                        test_outputs_total = test_outputs
-                    else:
-                        test_images_total = np.concatenate(
-                            (test_images_total, test_data["image"]), axis=0
-                        )
-                        test_labels_total = np.concatenate(
-                            (test_labels_total, test_data["label"]), axis=0
-                        )
-                        test_outputs_total = np.concatenate(
-                            (test_outputs_total, test_outputs), axis=0
-                        )
+                    # Collected per batch and concatenated once below
+                    test_images_total.append(np.asarray(test_data["image"]))
+                    test_labels_total.append(np.asarray(test_data["label"]))
+                    test_outputs_total.append(np.asarray(test_outputs.cpu()))
+                test_images_total = np.concatenate(test_images_total, axis=0)
+                test_labels_total = np.concatenate(test_labels_total, axis=0)
+                test_outputs_total = np.concatenate(test_outputs_total, axis=0)
                 metric = dice_metric.aggregate().item()
                 dice_metric.reset()
                 metric_total += metric
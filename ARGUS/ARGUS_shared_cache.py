@@ -0,0 +1,222 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+
+from pathlib import Path
+
+import torch
+
+from monai.data import PersistentDataset
+from monai.transforms import Compose, Randomizable, Transform
+
+# Digests of file contents, keyed by (path, size, mtime), shared by all
+# datasets of this process.  Those not yet saved to an index file are
+# also kept in _unsaved_digests until ARGUS_save_content_digests.
+_content_digests = dict()
+_unsaved_digests = dict()
+_content_digests_lock = threading.Lock()
+
+def _read_content_index(index_file):
+    try:
+        with open(index_file) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return dict()
+
+def ARGUS_content_digest(filename, index_file=None):
+    """ sha1 of the contents of filename.
+
+    Digests are memoized per (path, size, mtime).  If index_file is given
+    the digests already saved there are used, so other processes need not
+    re-read files that are unchanged; new digests are saved there by
+    ARGUS_save_content_digests.
+    """
+    stat = os.stat(filename)
+    key = f"{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}"
+    with _content_digests_lock:
+        digest = _content_digests.get(key)
+        if digest == None and index_file != None and os.path.exists(index_file):
+            _content_digests.update(_read_content_index(index_file))
+            digest = _content_digests.get(key)
+    if digest != None:
+        return digest
+
+    sha = hashlib.sha1()
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 22), b""):
+            sha.update(block)
+    digest = sha.hexdigest()
+
+    with _content_digests_lock:
+        _content_digests[key] = digest
+        _unsaved_digests[key] = digest
+    return digest
+
+def ARGUS_save_content_digests(index_file):
+    """ Add the digests computed since the last save to index_file.
+
+    The index is re-read and merged, so processes building datasets
+    concurrently keep each other's digests (if two save at the same time,
+    the digests of one are recomputed by the next process that needs
+    them).  Called once per dataset, after all its digests are known.
+    """
+    with _content_digests_lock:
+        if len(_unsaved_digests) == 0:
+            return
+        index = _read_content_index(index_file) if os.path.exists(index_file) else dict()
+        index.update(_unsaved_digests)
+        _atomic_write(index_file, json.dumps(index).encode("utf-8"))
+        _content_digests.update(index)
+        _unsaved_digests.clear()
+
+def _atomic_write(filename, data):
+    """ Write bytes so that readers see either the old or the new file """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_name = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_name, filename)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
+
+def ARGUS_deterministic_prefix(transform):
+    """ The transforms that run before the first random one """
+    transforms = transform.transforms if isinstance(transform, Compose) else [transform]
+    prefix = []
+    for t in transforms:
+        if isinstance(t, Randomizable) or not isinstance(t, Transform):
+            break
+        prefix.append(t)
+    return prefix
+
+def _describe(obj, depth=0):
+    """ Text description of an object's settings that is stable across processes """
+    if isinstance(obj, (int, float, str, bool, bytes, type(None))):
+        return repr(obj)
+    if isinstance(obj, (list, tuple)):
+        return "[" + ",".join(_describe(x, depth) for x in obj) + "]"
+    if isinstance(obj, (set, frozenset)):
+        return "{" + ",".join(sorted(_describe(x, depth) for x in obj)) + "}"
+    if isinstance(obj, dict):
+        return "{" + ",".join(sorted(
+            f"{_describe(k, depth)}:{_describe(v, depth)}" for k, v in obj.items())) + "}"
+    name = f"{type(obj).__module__}.{type(obj).__qualname__}"
+    if depth >= 4 or not hasattr(obj, "__dict__") or callable(obj) and not isinstance(obj, Transform):
+        return name
+    return name + _describe(vars(obj), depth+1)
+
+def ARGUS_transform_digest(transforms):
+    """ sha1 identifying a list of deterministic transforms and their settings """
+    return hashlib.sha1(_describe(list(transforms)).encode("utf-8")).hexdigest()
+
+class ARGUS_SharedPersistentDataset(PersistentDataset):
+    """ PersistentDataset whose cache is shared by all folds, runs and splits.
+
+    MONAI's PersistentDataset keys cache entries by the data dictionary
+    (file names), so the trainers kept a cache directory per fold and run
+    and recomputed the same LoadImaged/AsChannelFirstd/Resized output in
+    each.  Here entries are keyed by the contents of the files in the data
+    dictionary plus the deterministic transform prefix, so one directory
+    serves every fold, run and split (and is invalidated when a file or
+    a prefix transform setting changes).
+
+    Entries are written to a temporary file and renamed into place, so
+    concurrent training processes never read partial entries; if two
+    processes compute the same entry, the last rename wins and both
+    results are identical.  Unreadable entries are recomputed.
+
+    hits and misses count lookups made by this process (DataLoader
+    workers count their own); cache_report() summarizes the directory.
+    """
+
+    index_filename = "content_index.json"
+
+    def __init__(self, data, transform, cache_dir):
+        cache_dir = Path(cache_dir)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        super().__init__(data=data, transform=transform, cache_dir=cache_dir)
+        self.prefix_digest = ARGUS_transform_digest(
+            ARGUS_deterministic_prefix(transform))
+        self.hits = 0
+        self.misses = 0
+
+        # Digest every file now and save the new digests in one write
+        for item in self.data:
+            self.cache_key(item)
+        ARGUS_save_content_digests(self.index_file())
+
+    def index_file(self):
+        return os.path.join(self.cache_dir, self.index_filename)
+
+    def cache_key(self, item):
+        sha = hashlib.sha1(self.prefix_digest.encode("utf-8"))
+        for key in sorted(item.keys()):
+            value = item[key]
+            sha.update(str(key).encode("utf-8"))
+            if isinstance(value, (str, Path)) and os.path.isfile(value):
+                sha.update(ARGUS_content_digest(value, self.index_file()).encode("utf-8"))
+            else:
+                sha.update(repr(value).encode("utf-8"))
+        return sha.hexdigest()
+
+    def cache_filename(self, item):
+        return self.cache_dir / f"{self.cache_key(item)}.pt"
+
+    def _cachecheck(self, item_transformed):
+        hashfile = self.cache_filename(item_transformed)
+        if hashfile.is_file():
+            try:
+                item = torch.load(hashfile)
+                self.hits += 1
+                return item
+            except Exception:
+                # Corrupt or incompatible entry: recompute and replace it
+                pass
+
+        self.misses += 1
+        item = self._pre_transform(item_transformed)
+        fd, tmp_name = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                torch.save(item, fp)
+            os.replace(tmp_name, hashfile)
+        except BaseException:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+            raise
+        return item
+
+    def cache_report(self):
+        """ Entries of this dataset already in the cache, and the cache size """
+        cached = sum(self.cache_filename(item).is_file() for item in self.data)
+        report = ARGUS_shared_cache_report(self.cache_dir)
+        report["dataset_items"] = len(self.data)
+        report["dataset_cached"] = cached
+        report["dataset_hit_rate"] = cached / max(1, len(self.data))
+        report["hits"] = self.hits
+        report["misses"] = self.misses
+        return report
+
+def ARGUS_shared_cache_report(cache_dir):
+    """ Number of entries and bytes in a shared cache directory """
+    entries = 0
+    size = 0
+    for filename in Path(cache_dir).glob("*.pt"):
+        try:
+            size += filename.stat().st_size
+            entries += 1
+        except OSError:
+            # Replaced by another process while scanning
+            pass
+    return dict(cache_dir=str(cache_dir), entries=entries, bytes=size)
+
+def ARGUS_print_cache_report(name, report):
+    print(f"   {name} cache: {report['dataset_cached']}/{report['dataset_items']}"
+          f" items cached ({report['dataset_hit_rate']*100:.0f}% hit rate),"
+          f" {report['entries']} entries, {report['bytes']/2**30:.2f} GB"
+          f" in {report['cache_dir']}")
@@ -15,9 +15,9 @@ class ARGUS_taskid_inference(ARGUS_classification_inference):
         elif source=="Clarius":
             self.preprocess_taskid = ARGUS_preprocess_clarius(new_size=[self.size_x, self.size_y])
         
-    def preprocess(self, vid, lbl=None, slice_num=None, crop_data=True, scale_data=True, rotate_data=True):
+    def preprocess(self, vid, lbl=None, slice_num=None, crop_data=True, scale_data=True, rotate_data=True, preprocess_cache=None):
         if crop_data:
-            self.preprocessed_taskid_video = self.preprocess_taskid.process( vid )
+            self.preprocessed_taskid_video = self.source_preprocess(self.preprocess_taskid, vid, preprocess_cache)
         else:
             self.preprocessed_taskid_video = vid
         super().preprocess(self.preprocessed_taskid_video, lbl, slice_num, scale_data, rotate_data)
\ No newline at end of file
@@ -0,0 +1,143 @@
+import os
+import json
+import configparser
+
+import itk
+import torch
+
+from ARGUS_pipeline import ARGUS_set_stage_threads, ARGUS_set_pipeline_threads
+
+class ARGUS_thread_budget():
+    """ How the cores are divided among ITK, torch and the PyAV decoder.
+
+    num_threads is the total budget of a predict() pipeline (None = all
+    cores).  Stages run with all of it, except:
+        decode: decode_threads, also used as PyAV's thread_count
+            (None = PyAV's own choice and the full budget).
+        taskid_preprocess, speculative_preprocess, taskid: these run
+            concurrently, so each gets concurrent_fraction of the budget.
+        any stage named in stage_threads: that many threads.
+    Before each stage the pipeline sets torch's intra-op thread count to
+    the stage's share; ITK's default thread count is process-global, so
+    it is set once per run to the total (set_pipeline_threads).  ITK's
+    global maximum is raised, never lowered, to the largest total used.
+
+    interop_threads is torch's inter-op pool size.  Torch allows setting
+    it only once per process, before any inter-op work, so apply() should
+    be called when the process starts (ARGUS_app_ai does).
+
+    The budget is read from the [threads] section of ARGUS_threads.cfg
+    (0 = default) and can be overridden per call by the app, CLI and
+    server; ARGUS_benchmark.py --tune-threads searches for the fastest
+    allocation on a given number of cores and writes that file.
+    """
+
+    concurrent_stages = ["taskid_preprocess", "speculative_preprocess", "taskid"]
+
+    def __init__(self,
+                 num_threads=None,
+                 decode_threads=None,
+                 interop_threads=None,
+                 concurrent_fraction=0.5,
+                 stage_threads=None):
+        self.num_threads = num_threads
+        self.decode_threads = decode_threads
+        self.interop_threads = interop_threads
+        self.concurrent_fraction = concurrent_fraction
+        self.stage_threads = dict() if stage_threads == None else dict(stage_threads)
+
+    def total_threads(self):
+        if self.num_threads == None:
+            return os.cpu_count() or 1
+        return max(1, self.num_threads)
+
+    def threads(self, stage):
+        """ Thread budget of a pipeline stage (None = all threads) """
+        total = self.total_threads()
+        if stage in self.stage_threads:
+            return max(1, min(self.stage_threads[stage], total))
+        if stage == "decode" and self.decode_threads != None:
+            return max(1, min(self.decode_threads, total))
+        if stage in self.concurrent_stages:
+            return max(1, int(total * self.concurrent_fraction))
+        return None
+
+    def with_num_threads(self, num_threads):
+        """ A copy of this budget with another total (itself if None) """
+        if num_threads == None:
+            return self
+        state = self.state()
+        state["num_threads"] = num_threads
+        return ARGUS_thread_budget(**state)
+
+    def apply(self):
+        """ Set the process-wide thread counts of torch and ITK """
+        total = self.total_threads()
+        if self.interop_threads != None:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError as e:
+                print(f"WARNING: Could not set torch inter-op threads: {e}")
+        self.set_pipeline_threads(total)
+        ARGUS_set_stage_threads(total)
+
+    @staticmethod
+    def set_pipeline_threads(num_threads):
+        """ Set ITK's default thread count, first raising its global
+        maximum if that would cap num_threads """
+        if itk.MultiThreaderBase.GetGlobalMaximumNumberOfThreads() < num_threads:
+            itk.MultiThreaderBase.SetGlobalMaximumNumberOfThreads(num_threads)
+        ARGUS_set_pipeline_threads(num_threads)
+
+    def state(self):
+        return dict(
+            num_threads=self.num_threads,
+            decode_threads=self.decode_threads,
+            interop_threads=self.interop_threads,
+            concurrent_fraction=self.concurrent_fraction,
+            stage_threads=dict(self.stage_threads),
+        )
+
+    def __repr__(self):
+        return "ARGUS_thread_budget(" + ", ".join(
+            f"{k}={v}" for k, v in self.state().items()) + ")"
+
+    @staticmethod
+    def from_config(filename, section="threads"):
+        """ The budget of filename's section; defaults if the file or
+        section does not exist.  Counts of 0 mean the default. """
+        config = configparser.ConfigParser()
+        config.read(filename)
+        if not config.has_section(section):
+            return ARGUS_thread_budget()
+
+        def count(option):
+            if not config.has_option(section, option):
+                return None
+            value = int(config[section][option])
+            return None if value <= 0 else value
+
+        concurrent_fraction = 0.5
+        if config.has_option(section, 'concurrent_fraction'):
+            concurrent_fraction = float(config[section]['concurrent_fraction'])
+        stage_threads = dict()
+        if config.has_option(section, 'stage_threads'):
+            stage_threads = json.loads(config[section]['stage_threads'])
+        return ARGUS_thread_budget(
+            num_threads=count('num_threads'),
+            decode_threads=count('decode_threads'),
+            interop_threads=count('interop_threads'),
+            concurrent_fraction=concurrent_fraction,
+            stage_threads=stage_threads)
+
+    def to_config(self, filename, section="threads"):
+        config = configparser.ConfigParser()
+        config[section] = dict(
+            num_threads=str(self.num_threads or 0),
+            decode_threads=str(self.decode_threads or 0),
+            interop_threads=str(self.interop_threads or 0),
+            concurrent_fraction=str(self.concurrent_fraction),
+            stage_threads=json.dumps(self.stage_threads),
+        )
+        with open(filename, "w") as fp:
+            config.write(fp)
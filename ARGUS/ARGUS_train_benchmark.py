@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+""" Throughput benchmark of the training data pipeline.
+
+Runs the exact train transform chain of a cfg (ARGUS_segmentation_train or
+ARGUS_classification_train, chosen from the cfg) on synthetic MHA videos
+and reports:
+    - time and samples/s of each transform in the chain,
+    - DataLoader samples/s for each worker count and cache mode
+      (Dataset, PersistentDataset, CacheDataset), and memory per worker,
+    - training step samples/s of the network for each batch size,
+and recommends num_workers_train and batch_size_train for this machine.
+Those can be set in the cfg (they override the defaults of the trainers).
+
+Usage:
+    python ARGUS_train_benchmark.py ARGUS_ptx_ar.cfg --network vfold
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import configparser
+import tempfile
+
+from time import perf_counter
+
+import numpy as np
+
+import itk
+
+import torch
+
+from monai.data import PersistentDataset, CacheDataset, DataLoader, Dataset, list_data_collate
+from monai.losses import DiceLoss
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from ARGUS_segmentation_train import ARGUS_segmentation_train
+from ARGUS_classification_train import ARGUS_classification_train
+
+def ARGUS_synthetic_training_files(data_dir, num_files, size, num_classes, classification, seed=0):
+    """ Write synthetic (t, y, x) image and label MHA videos, return train_files """
+    rng = np.random.default_rng(seed)
+    frames, size_y, size_x = size
+    yy, xx = np.mgrid[0:size_y, 0:size_x]
+    files = []
+    for i in range(num_files):
+        img = np.clip(rng.rayleigh(40, size=size), 0, 255).astype(np.float32)
+        lbl = np.zeros(size, dtype=np.short)
+        for c in range(1, num_classes):
+            center_y = rng.uniform(0.2, 0.8) * size_y
+            center_x = rng.uniform(0.2, 0.8) * size_x
+            radius = rng.uniform(0.05, 0.15) * min(size_y, size_x)
+            lbl[:, (yy-center_y)**2 + (xx-center_x)**2 < radius**2] = c
+        img[lbl > 0] *= 0.3
+
+        img_name = os.path.join(data_dir, f"synthetic_{i:03d}.mha")
+        itk.imwrite(itk.GetImageFromArray(img), img_name, compression=False)
+        if classification:
+            files.append({"image": img_name, "label": i % num_classes})
+        else:
+            lbl_name = os.path.join(data_dir, f"synthetic_{i:03d}.overlay.mha")
+            itk.imwrite(itk.GetImageFromArray(lbl), lbl_name, compression=True)
+            files.append({"image": img_name, "label": lbl_name})
+    return files
+
+def memory_per_worker():
+    """ Mean RSS of this process's child processes (DataLoader workers) """
+    if psutil == None:
+        return None
+    children = psutil.Process().children(recursive=True)
+    if len(children) == 0:
+        return None
+    rss = []
+    for child in children:
+        try:
+            rss.append(child.memory_info().rss)
+        except psutil.NoSuchProcess:
+            pass
+    return float(np.mean(rss)) if len(rss) > 0 else None
+
+def benchmark_transforms(transforms, files, num_samples):
+    """ Seconds per sample and samples/s of each transform in the chain """
+    elapsed = [0] * len(transforms.transforms)
+    for i in range(num_samples):
+        data = dict(files[i % len(files)])
+        for t,transform in enumerate(transforms.transforms):
+            start = perf_counter()
+            data = transform(data)
+            elapsed[t] += perf_counter() - start
+    results = []
+    for transform,total in zip(transforms.transforms, elapsed):
+        results.append(dict(
+            transform=type(transform).__name__,
+            seconds_per_sample=total / num_samples,
+            samples_per_second=num_samples / total if total > 0 else None,
+        ))
+    return results
+
+def benchmark_loader(dataset, batch_size, num_workers, num_batches):
+    """ Samples/s of a DataLoader over num_batches after the first batch """
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=num_workers,
+        collate_fn=list_data_collate,
+        pin_memory=torch.cuda.is_available(),
+    )
+    first_batch = None
+    samples = 0
+    worker_memory = None
+    start = perf_counter()
+    batch_count = 0
+    while batch_count <= num_batches:
+        for batch_data in loader:
+            if first_batch == None:
+                first_batch = perf_counter() - start
+                start = perf_counter()
+            else:
+                samples += batch_data["image"].shape[0]
+            batch_count += 1
+            if batch_count == num_batches // 2 + 1 and num_workers > 0:
+                worker_memory = memory_per_worker()
+            if batch_count > num_batches:
+                break
+    elapsed = perf_counter() - start
+    return dict(
+        num_workers=num_workers,
+        first_batch_seconds=first_batch,
+        samples_per_second=samples / elapsed if elapsed > 0 else None,
+        memory_per_worker=worker_memory,
+    )
+
+def benchmark_model(trainer, sample, batch_sizes, num_steps, classification):
+    """ Training step samples/s of the network for each batch size """
+    trainer.init_model(0)
+    model = trainer.model[0]
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), 1e-4)
+    if classification:
+        loss_function = torch.nn.CrossEntropyLoss()
+    else:
+        loss_function = DiceLoss(to_onehot_y=True, softmax=True)
+
+    results = []
+    for batch_size in batch_sizes:
+        inputs = torch.stack([sample["image"]] * batch_size).to(trainer.device)
+        if classification:
+            labels = torch.zeros(batch_size, dtype=torch.long).to(trainer.device)
+        else:
+            labels = torch.stack([sample["label"]] * batch_size).to(trainer.device)
+        try:
+            for step in range(num_steps + 1):
+                if step == 1:
+                    if torch.cuda.is_available():
+                        torch.cuda.synchronize()
+                    start = perf_counter()
+                optimizer.zero_grad()
+                loss = loss_function(model(inputs), labels)
+                loss.backward()
+                optimizer.step()
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            elapsed = perf_counter() - start
+        except RuntimeError as e:
+            # Typically out of memory: larger batches will not fit either
+            print(f"   Batch size {batch_size} failed: {e}")
+            break
+        results.append(dict(
+            batch_size=batch_size,
+            samples_per_second=batch_size * num_steps / elapsed,
+        ))
+    return results
+
+def recommend(model_results, loader_results, cpu_count):
+    """ Smallest batch size within 5% of the best network throughput, and
+    the fewest workers whose loader keeps up with it """
+    if len(model_results) == 0:
+        return None
+    best = max(x["samples_per_second"] for x in model_results)
+    model_choice = [x for x in model_results if x["samples_per_second"] >= 0.95*best][0]
+    needed = model_choice["samples_per_second"]
+
+    available = psutil.virtual_memory().available if psutil != None else None
+    candidates = []
+    for x in loader_results:
+        if x["samples_per_second"] == None:
+            continue
+        if (available != None and x["memory_per_worker"] != None and
+                x["num_workers"] * x["memory_per_worker"] > 0.8 * available):
+            continue
+        candidates.append(x)
+    if len(candidates) == 0:
+        return None
+
+    keeps_up = [x for x in candidates if x["samples_per_second"] >= needed]
+    if len(keeps_up) > 0:
+        loader_choice = min(keeps_up, key=lambda x: (x["num_workers"], -x["samples_per_second"]))
+        bound = "GPU/network-bound"
+    else:
+        loader_choice = max(candidates, key=lambda x: x["samples_per_second"])
+        bound = "loader-bound"
+    return dict(
+        batch_size_train=model_choice["batch_size"],
+        num_workers_train=min(loader_choice["num_workers"], cpu_count),
+        cache_mode=loader_choice["cache_mode"],
+        network_samples_per_second=needed,
+        loader_samples_per_second=loader_choice["samples_per_second"],
+        bound=bound,
+    )
+
+def prepare_argparser():
+    parser = argparse.ArgumentParser(description="ARGUS training data-pipeline benchmark")
+    parser.add_argument("config_file_name")
+    parser.add_argument("--network", default="vfold")
+    parser.add_argument("--device", type=int, default=0)
+    parser.add_argument("--files", type=int, default=24)
+    parser.add_argument("--size", type=int, nargs=3, default=None,
+                        help="Synthetic video size t y x (default 3*num_slices, 2*size_y, 2*size_x)")
+    parser.add_argument("--samples", type=int, default=20,
+                        help="Samples timed per transform")
+    parser.add_argument("--batches", type=int, default=10,
+                        help="Batches timed per loader setting")
+    parser.add_argument("--workers", type=int, nargs="+", default=None)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8, 12, 16, 24, 32])
+    parser.add_argument("--cache-modes", nargs="+", default=["none", "persistent", "cache"],
+                        choices=["none", "persistent", "cache"])
+    parser.add_argument("--steps", type=int, default=5,
+                        help="Training steps timed per batch size")
+    parser.add_argument("--data-dir", default=None)
+    parser.add_argument("--output", default="ARGUS_train_benchmark_results.json")
+    return parser
+
+def main(args):
+    config = configparser.ConfigParser()
+    config.read(args.config_file_name)
+    classification = config.has_option(args.network, "class_fileprefix")
+    device_num = args.device if torch.cuda.is_available() else None
+    if classification:
+        trainer = ARGUS_classification_train(args.config_file_name, args.network, device_num)
+    else:
+        trainer = ARGUS_segmentation_train(args.config_file_name, args.network, device_num)
+
+    size = args.size
+    if size == None:
+        size = [3*trainer.num_slices, 2*trainer.size_y, 2*trainer.size_x]
+
+    data_dir = args.data_dir
+    if data_dir == None:
+        data_dir = tempfile.mkdtemp(prefix="ARGUS_train_benchmark_")
+    os.makedirs(data_dir, exist_ok=True)
+    print(f"Writing {args.files} synthetic videos of size {size} to {data_dir}")
+    files = ARGUS_synthetic_training_files(
+        data_dir, args.files, size, trainer.num_classes, classification)
+
+    cpu_count = os.cpu_count()
+    workers = args.workers
+    if workers == None:
+        workers = sorted(set([0, 1, 2, 4, 6, 8, 12, 16, cpu_count]))
+        workers = [w for w in workers if w <= cpu_count]
+
+    results = dict(
+        config_file_name=args.config_file_name,
+        network=args.network,
+        trainer=type(trainer).__name__,
+        cpu_count=cpu_count,
+        device=str(trainer.device),
+        size=size,
+        files=args.files,
+    )
+
+    print("Timing transforms")
+    results["transforms"] = benchmark_transforms(
+        trainer.train_transforms, files, args.samples)
+    for x in results["transforms"]:
+        print(f"   {x['transform']:<32} {x['seconds_per_sample']*1000:9.2f} ms"
+              f" {x['samples_per_second'] or 0:9.1f} samples/s")
+
+    print("Timing network training steps")
+    sample = trainer.train_transforms(dict(files[0]))
+    results["network"] = benchmark_model(
+        trainer, sample, args.batch_sizes, args.steps, classification)
+    for x in results["network"]:
+        print(f"   batch {x['batch_size']:>3}: {x['samples_per_second']:9.1f} samples/s")
+
+    print("Timing data loaders")
+    batch_size = trainer.batch_size_train
+    results["loader"] = []
+    for cache_mode in args.cache_modes:
+        start = perf_counter()
+        if cache_mode == "none":
+            dataset = Dataset(data=files, transform=trainer.train_transforms)
+        elif cache_mode == "persistent":
+            cache_dir = os.path.join(data_dir, "persistent_cache")
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            os.makedirs(cache_dir)
+            dataset = PersistentDataset(
+                data=files,
+                transform=trainer.train_transforms,
+                cache_dir=cache_dir)
+            # Fill the cache once, so the loaders below see a warm cache
+            for i in range(len(dataset)):
+                dataset[i]
+        else:
+            dataset = CacheDataset(
+                data=files,
+                transform=trainer.train_transforms,
+                cache_rate=1,
+                num_workers=max(1, cpu_count // 2))
+        setup_time = perf_counter() - start
+        for num_workers in workers:
+            x = benchmark_loader(dataset, batch_size, num_workers, args.batches)
+            x["cache_mode"] = cache_mode
+            x["setup_seconds"] = setup_time
+            results["loader"].append(x)
+            memory = x["memory_per_worker"]
+            memory = "" if memory == None else f"{memory/2**20:8.0f} MB/worker"
+            print(f"   {cache_mode:<10} workers {num_workers:>3}:"
+                  f" {x['samples_per_second'] or 0:9.1f} samples/s {memory}")
+
+    results["recommendation"] = recommend(results["network"], results["loader"], cpu_count)
+    rec = results["recommendation"]
+    if rec != None:
+        print("")
+        print(f"Recommendation ({rec['bound']}, {rec['cache_mode']} cache):")
+        print(f"   num_workers_train = {rec['num_workers_train']}")
+        print(f"   batch_size_train = {rec['batch_size_train']}")
+
+    with open(args.output, "w") as fp:
+        json.dump(results, fp, indent=1)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(prepare_argparser().parse_args()))
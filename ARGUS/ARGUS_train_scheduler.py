@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+""" Scheduler for vfold x run training grids.
+
+Replaces the hand-edited run<N>_dev<M>.py scripts.  Every (fold, run) of a
+cfg is a job; jobs run in their own (spawned) process on a slot, which is
+a CUDA device or, on CPU-only machines, a group of cores.  Each job gets a
+thread budget (torch, ITK, OpenMP) and, on Linux, is pinned to its cores.
+
+Progress is kept in a JSON job ledger (status, attempts, slot, times, exit
+code, log file).  Failed jobs are restarted up to --max-retries times, and
+re-running the scheduler with the same ledger skips finished jobs, so an
+interrupted grid resumes; unfinished jobs continue from their last
+checkpoint (train_vfold resume=True) unless --rerun is given.  Each job's output goes to <log-dir>/<job>.log.
+
+With --cotrain, a job is a fold and trains all --runs together from one
+data loader (train_vfold_ensemble), so the data pipeline of the fold runs
+once instead of once per run; the runs then share the split of the first
+run.
+
+The folds of a run must see the same split of the data, so each job seeds
+python's random module with (--fold-seed, run) before setup_vfold_files;
+this also keeps randomize_folds consistent across processes.
+
+Usage:
+    python ARGUS_train_scheduler.py ../Pretrain/ARGUS_pretrain_half_ar.cfg --runs 0 1 2 --devices 0 1 2
+    python ARGUS_train_scheduler.py ARGUS_ptx_ar.cfg --trainer ARGUS_ptx_ar_train:ARGUS_ptx_ar_train \\
+        --path ../PTX --pretrained "./Pretrained_Models/pretrain_half_vfold_run{run}/best_model_2.pth"
+    python ARGUS_train_scheduler.py ARGUS_taskid.cfg --cpu --threads-per-job 4
+    python ARGUS_train_scheduler.py ARGUS_ptx_ar.cfg --runs 0 1 2 --cotrain
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import importlib
+import configparser
+import multiprocessing
+
+from time import time, sleep
+
+def _write_ledger(filename, ledger):
+    with open(filename + ".tmp", "w") as fp:
+        json.dump(ledger, fp, indent=1)
+    os.replace(filename + ".tmp", filename)
+
+def job_name(fold, run):
+    if isinstance(run, list):
+        return f"f{fold}_r" + "-".join(str(r) for r in run)
+    return f"f{fold}_r{run}"
+
+def cpu_slots(threads_per_job, num_cpus=None):
+    """ Disjoint core groups of threads_per_job cores """
+    if num_cpus == None:
+        if hasattr(os, "sched_getaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count()))
+    else:
+        cores = list(range(num_cpus))
+    num_groups = max(1, len(cores) // threads_per_job)
+    return [dict(name=f"cpu{i}",
+                 device_num=None,
+                 cores=cores[i*threads_per_job:(i+1)*threads_per_job] or cores)
+            for i in range(num_groups)]
+
+def device_slots(devices, jobs_per_device=1):
+    return [dict(name=f"cuda{d}.{j}", device_num=d, cores=None)
+            for d in devices for j in range(jobs_per_device)]
+
+def _load_trainer_class(trainer, config_file_name, network_name):
+    """ "module:Class", or the segmentation/classification trainer the cfg uses """
+    if trainer != None:
+        module_name, class_name = trainer.split(":")
+        return getattr(importlib.import_module(module_name), class_name)
+    config = configparser.ConfigParser()
+    config.read(config_file_name)
+    if config.has_option(network_name, "class_fileprefix"):
+        from ARGUS_classification_train import ARGUS_classification_train
+        return ARGUS_classification_train
+    from ARGUS_segmentation_train import ARGUS_segmentation_train
+    return ARGUS_segmentation_train
+
+def run_job(job, log_filename):
+    """ Train one (fold, run), or co-train the runs of a fold when job["run"]
+    is a list.  Runs in a spawned process. """
+    log = open(log_filename, "a", buffering=1)
+    os.dup2(log.fileno(), sys.stdout.fileno())
+    os.dup2(log.fileno(), sys.stderr.fileno())
+
+    # Thread budget must be in the environment before torch/itk load
+    threads = str(job["threads"])
+    for name in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                 "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"]:
+        os.environ[name] = threads
+    if job["cores"] != None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, job["cores"])
+    for path in job["paths"]:
+        sys.path.insert(0, path)
+    os.chdir(job["working_dir"])
+
+    import torch
+    import itk
+    torch.set_num_threads(job["threads"])
+    itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(job["threads"])
+
+    print(f"Job {job_name(job['fold'], job['run'])} on {job['slot']}"
+          f" with {job['threads']} threads", flush=True)
+
+    trainer_class = _load_trainer_class(job["trainer"], job["config_file_name"], job["network_name"])
+    nnet = trainer_class(job["config_file_name"], job["network_name"], device_num=job["device_num"])
+    if job["loader_workers"] != None:
+        for name in ["num_workers_train", "num_workers_val", "num_workers_test"]:
+            setattr(nnet, name, job["loader_workers"])
+
+    runs = job["run"] if isinstance(job["run"], list) else [job["run"]]
+    random.seed(f"{job['fold_seed']}_{runs[0]}")
+    nnet.setup_vfold_files()
+    for run in runs:
+        nnet.init_model(run)
+        if job["pretrained"] != None:
+            nnet.load_model(run, job["pretrained"].format(run=run, fold=job["fold"]))
+    if isinstance(job["run"], list):
+        nnet.setup_training_vfold(job["fold"], runs[0], num_members=len(runs))
+        nnet.train_vfold_ensemble(runs, resume=job["resume"])
+    else:
+        nnet.setup_training_vfold(job["fold"], job["run"])
+        nnet.train_vfold(job["run"], resume=job["resume"])
+
+class ARGUS_train_scheduler():
+    """ Runs the (fold, run) jobs of a cfg on a set of slots.
+
+    slots are dicts with name, device_num (None for CPU) and cores (None
+    for no pinning); see device_slots() and cpu_slots().
+    """
+
+    def __init__(self,
+                 config_file_name,
+                 network_name="vfold",
+                 slots=None,
+                 runs=[0],
+                 folds=None,
+                 threads_per_job=None,
+                 trainer=None,
+                 paths=[],
+                 pretrained=None,
+                 loader_workers=None,
+                 ledger_filename=None,
+                 log_dir="train_logs",
+                 max_retries=2,
+                 fold_seed=0,
+                 cotrain=False,
+                 poll_interval=5):
+        self.config_file_name = os.path.abspath(config_file_name)
+        self.network_name = network_name
+        self.slots = slots if slots != None else cpu_slots(threads_per_job or 4)
+        self.runs = list(runs)
+        self.trainer = trainer
+        self.paths = [os.path.abspath(p) for p in paths] + [os.path.dirname(os.path.abspath(__file__))]
+        self.pretrained = pretrained
+        self.loader_workers = loader_workers
+        self.log_dir = os.path.abspath(log_dir)
+        self.max_retries = max_retries
+        self.fold_seed = fold_seed
+        self.cotrain = cotrain
+        self.poll_interval = poll_interval
+        self.resume = True
+
+        if threads_per_job == None:
+            threads_per_job = max(1, os.cpu_count() // len(self.slots))
+        self.threads_per_job = threads_per_job
+
+        if folds == None:
+            config = configparser.ConfigParser()
+            config.read(self.config_file_name)
+            num_folds = int(config[network_name]["num_folds"])
+            if num_folds < 4:
+                num_folds = 1
+            folds = range(num_folds)
+        self.folds = list(folds)
+
+        if ledger_filename == None:
+            ledger_filename = os.path.join(self.log_dir, "ledger.json")
+        self.ledger_filename = os.path.abspath(ledger_filename)
+
+    def load_ledger(self, rerun=False):
+        """ Jobs of this grid, keeping finished ones from an existing ledger """
+        ledger = dict(config=self.config_file_name, network=self.network_name, jobs=dict())
+        if os.path.exists(self.ledger_filename):
+            with open(self.ledger_filename) as fp:
+                ledger = json.load(fp)
+        jobs = ledger["jobs"]
+        # A co-training job trains all runs of a fold
+        job_runs = [list(self.runs)] if self.cotrain else self.runs
+        for run in job_runs:
+            for fold in self.folds:
+                name = job_name(fold, run)
+                job = jobs.get(name)
+                if job == None or rerun or job["status"] != "done":
+                    # Interrupted jobs keep their attempts, failed ones start over
+                    attempts = 0
+                    if job != None and not rerun and job["status"] in ["pending", "running"]:
+                        attempts = job["attempts"]
+                    jobs[name] = dict(fold=fold, run=run, status="pending",
+                                      attempts=attempts, history=[] if job == None else job.get("history", []))
+        return ledger
+
+    def _job_spec(self, job, slot):
+        return dict(
+            fold=job["fold"],
+            run=job["run"],
+            slot=slot["name"],
+            device_num=slot["device_num"],
+            cores=slot["cores"],
+            threads=self.threads_per_job,
+            trainer=self.trainer,
+            paths=self.paths,
+            pretrained=self.pretrained,
+            loader_workers=self.loader_workers,
+            config_file_name=self.config_file_name,
+            network_name=self.network_name,
+            working_dir=os.getcwd(),
+            fold_seed=self.fold_seed,
+            resume=self.resume,
+        )
+
+    def run(self, rerun=False):
+        """ Run all jobs; returns True if every job finished """
+        os.makedirs(self.log_dir, exist_ok=True)
+        # Restarted and interrupted jobs continue from their checkpoints
+        self.resume = not rerun
+        ledger = self.load_ledger(rerun)
+        jobs = ledger["jobs"]
+        _write_ledger(self.ledger_filename, ledger)
+
+        context = multiprocessing.get_context("spawn")
+        free_slots = list(self.slots)
+        running = dict()
+        start = time()
+
+        def pending():
+            return [name for name, job in sorted(jobs.items(), key=lambda x: (x[1]["run"], x[1]["fold"]))
+                    if job["status"] == "pending"]
+
+        while pending() or running:
+            for name in pending():
+                if not free_slots:
+                    break
+                slot = free_slots.pop(0)
+                job = jobs[name]
+                log_filename = os.path.join(self.log_dir, name + ".log")
+                process = context.Process(
+                    target=run_job,
+                    args=(self._job_spec(job, slot), log_filename),
+                    name=name)
+                process.start()
+                job.update(status="running", slot=slot["name"], start=time(),
+                           log=log_filename, attempts=job["attempts"]+1)
+                running[name] = (process, slot)
+                print(f"Started {name} on {slot['name']} (attempt {job['attempts']})", flush=True)
+                _write_ledger(self.ledger_filename, ledger)
+
+            sleep(self.poll_interval)
+
+            for name, (process, slot) in list(running.items()):
+                if process.is_alive():
+                    continue
+                process.join()
+                job = jobs[name]
+                job["end"] = time()
+                job["elapsed"] = job["end"] - job["start"]
+                job["exit_code"] = process.exitcode
+                job["history"].append(dict(slot=slot["name"], exit_code=process.exitcode,
+                                           elapsed=job["elapsed"]))
+                if process.exitcode == 0:
+                    job["status"] = "done"
+                elif job["attempts"] <= self.max_retries:
+                    job["status"] = "pending"
+                    print(f"Job {name} failed (exit code {process.exitcode}), restarting.", flush=True)
+                else:
+                    job["status"] = "failed"
+                    print(f"Job {name} failed (exit code {process.exitcode}), see {job['log']}", flush=True)
+                del running[name]
+                free_slots.append(slot)
+                _write_ledger(self.ledger_filename, ledger)
+                self.print_progress(jobs, start)
+
+        return all(job["status"] == "done" for job in jobs.values())
+
+    def print_progress(self, jobs, start):
+        counts = dict()
+        for job in jobs.values():
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        summary = ", ".join(f"{counts[s]} {s}" for s in sorted(counts))
+        print(f"[{(time()-start)/60:.1f} min] {summary}", flush=True)
+
+def prepare_argparser():
+    parser = argparse.ArgumentParser(description="Schedule ARGUS vfold x run training jobs")
+    parser.add_argument("config_file_name")
+    parser.add_argument("--network", default="vfold")
+    parser.add_argument("--runs", type=int, nargs="+", default=[0])
+    parser.add_argument("--folds", type=int, nargs="+", default=None,
+                        help="Defaults to all folds of the cfg")
+    parser.add_argument("--devices", type=int, nargs="+", default=None,
+                        help="CUDA devices; defaults to all visible devices")
+    parser.add_argument("--jobs-per-device", type=int, default=1)
+    parser.add_argument("--cpu", action="store_true", help="Run on CPU core groups only")
+    parser.add_argument("--threads-per-job", type=int, default=None)
+    parser.add_argument("--loader-workers", type=int, default=None,
+                        help="Override the DataLoader workers of each job")
+    parser.add_argument("--trainer", default=None,
+                        help="module:Class of the trainer, e.g. ARGUS_ptx_ar_train:ARGUS_ptx_ar_train")
+    parser.add_argument("--path", nargs="+", default=[],
+                        help="Directories added to sys.path of the jobs")
+    parser.add_argument("--pretrained", default=None,
+                        help="Model to start from; {run} and {fold} are replaced")
+    parser.add_argument("--ledger", default=None)
+    parser.add_argument("--log-dir", default="train_logs")
+    parser.add_argument("--max-retries", type=int, default=2)
+    parser.add_argument("--fold-seed", type=int, default=0)
+    parser.add_argument("--rerun", action="store_true", help="Also rerun finished jobs")
+    parser.add_argument("--cotrain", action="store_true",
+                        help="Train the runs of a fold together from one data loader")
+    return parser
+
+def main(args):
+    if args.cpu:
+        slots = cpu_slots(args.threads_per_job or 4)
+    else:
+        devices = args.devices
+        if devices == None:
+            import torch
+            devices = list(range(torch.cuda.device_count()))
+        if len(devices) == 0:
+            print("No CUDA devices found, running on CPU core groups.")
+            slots = cpu_slots(args.threads_per_job or 4)
+        else:
+            slots = device_slots(devices, args.jobs_per_device)
+
+    scheduler = ARGUS_train_scheduler(
+        args.config_file_name,
+        args.network,
+        slots=slots,
+        runs=args.runs,
+        folds=args.folds,
+        threads_per_job=args.threads_per_job,
+        trainer=args.trainer,
+        paths=args.path,
+        pretrained=args.pretrained,
+        loader_workers=args.loader_workers,
+        ledger_filename=args.ledger,
+        log_dir=args.log_dir,
+        max_retries=args.max_retries,
+        fold_seed=args.fold_seed,
+        cotrain=args.cotrain)
+    num_jobs = len(scheduler.folds) * (1 if args.cotrain else len(scheduler.runs))
+    print(f"{num_jobs} jobs on {len(slots)} slots,"
+          f" {scheduler.threads_per_job} threads per job")
+    return 0 if scheduler.run(args.rerun) else 1
+
+if __name__ == "__main__":
+    sys.exit(main(prepare_argparser().parse_args()))
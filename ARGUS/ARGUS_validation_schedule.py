@@ -0,0 +1,152 @@
+from time import perf_counter
+
+class ARGUS_validation_schedule():
+    """ When to validate and when to stop a train_vfold run.
+
+    Validation runs every validation_interval epochs.  With adaptive=True
+    the interval shrinks to min_interval after the moving-average metric
+    improves, and doubles (up to max_interval) after each validation
+    without improvement, so plateaus are validated less often.
+
+    Early stopping (patience > 0) ends training when the moving-average
+    metric has not improved by more than min_delta for patience epochs,
+    after warmup epochs.  The moving average is the trainers' existing
+    metric_window mean.
+
+    cfg options (all optional):
+        early_stopping_patience = 0      (epochs, 0 disables)
+        early_stopping_min_delta = 0.0
+        early_stopping_warmup = <trainer's best model warm-up>
+        adaptive_validation = False
+        validation_min_interval = validation_interval//2
+        validation_max_interval = 4*validation_interval
+    """
+
+    def __init__(self,
+                 max_epochs,
+                 validation_interval,
+                 patience=0,
+                 min_delta=0.0,
+                 warmup=0,
+                 adaptive=False,
+                 min_interval=None,
+                 max_interval=None):
+        self.max_epochs = max_epochs
+        self.validation_interval = validation_interval
+        self.patience = patience
+        self.min_delta = min_delta
+        self.warmup = warmup
+        self.adaptive = adaptive
+        self.min_interval = (min_interval if min_interval != None
+                             else max(1, validation_interval//2))
+        self.max_interval = (max_interval if max_interval != None
+                             else 4*validation_interval)
+
+        self.interval = validation_interval
+        self.next_validation = validation_interval
+        self.best_metric = None
+        self.best_epoch = 0
+        self.num_validations = 0
+        self.stopped_epoch = None
+
+        self._epoch_start = None
+        self.epoch_seconds = []
+
+    @staticmethod
+    def config_options(config, network_name, warmup):
+        """ Keyword arguments of the schedule given in a cfg section """
+        def option(name, kind, default):
+            if config.has_option(network_name, name):
+                value = config[network_name][name]
+                if kind == bool:
+                    return value == "True"
+                return kind(value)
+            return default
+
+        return dict(
+            patience=option("early_stopping_patience", int, 0),
+            min_delta=option("early_stopping_min_delta", float, 0.0),
+            warmup=option("early_stopping_warmup", int, warmup),
+            adaptive=option("adaptive_validation", bool, False),
+            min_interval=option("validation_min_interval", int, None),
+            max_interval=option("validation_max_interval", int, None))
+
+    def start_epoch(self):
+        self._epoch_start = perf_counter()
+
+    def end_epoch(self):
+        if self._epoch_start != None:
+            self.epoch_seconds.append(perf_counter() - self._epoch_start)
+            self._epoch_start = None
+
+    def should_validate(self, epoch):
+        """ epoch is zero-based, as in the train_vfold loop """
+        if self.validation_interval <= 0:
+            return False
+        if not self.adaptive:
+            return (epoch + 1) % self.validation_interval == 0
+        return epoch + 1 >= self.next_validation
+
+    def update(self, epoch, mean_metric):
+        """ Record a validation; mean_metric is None until the moving
+        average is available.  Returns True if training should stop. """
+        self.num_validations += 1
+        improved = False
+        if mean_metric != None:
+            if self.best_metric == None or mean_metric > self.best_metric + self.min_delta:
+                self.best_metric = float(mean_metric)
+                self.best_epoch = epoch + 1
+                improved = True
+
+        if self.adaptive:
+            if improved:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * 2, self.max_interval)
+            self.next_validation = epoch + 1 + self.interval
+
+        if (self.patience > 0
+                and epoch + 1 > self.warmup
+                and mean_metric != None
+                and epoch + 1 - self.best_epoch >= self.patience):
+            self.stopped_epoch = epoch + 1
+            return True
+        return False
+
+    def summary(self):
+        """ Epochs run and, if stopped early, the epochs and time saved """
+        epochs_run = len(self.epoch_seconds)
+        if self.stopped_epoch != None:
+            epochs_run = self.stopped_epoch
+        mean_seconds = (sum(self.epoch_seconds) / len(self.epoch_seconds)
+                        if self.epoch_seconds else 0)
+        epochs_saved = self.max_epochs - epochs_run
+        return dict(
+            max_epochs=self.max_epochs,
+            epochs_run=epochs_run,
+            stopped_epoch=self.stopped_epoch,
+            epochs_saved=epochs_saved,
+            fraction_saved=epochs_saved / self.max_epochs if self.max_epochs > 0 else 0,
+            seconds_saved_estimate=epochs_saved * mean_seconds,
+            mean_epoch_seconds=mean_seconds,
+            validations=self.num_validations,
+            validations_fixed_interval=(self.max_epochs // self.validation_interval
+                                        if self.validation_interval > 0 else 0),
+            best_moving_average=self.best_metric,
+            best_moving_average_epoch=self.best_epoch,
+        )
+
+    def state(self):
+        return dict(
+            interval=self.interval,
+            next_validation=self.next_validation,
+            best_metric=self.best_metric,
+            best_epoch=self.best_epoch,
+            num_validations=self.num_validations,
+            stopped_epoch=self.stopped_epoch,
+            epoch_seconds=self.epoch_seconds,
+        )
+
+    def set_state(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
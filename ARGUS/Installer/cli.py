@@ -33,6 +33,9 @@ def prepare_argparser():
                         help='Specify task: PTX, PNB, ONSD, ETT.'
                              ' This will override the automatic task'
                              ' determination AI.')
+    parser.add_argument('-n', '--threads', type=int,
+                        help='Number of CPU threads to use for each video.'
+                             ' Default: the server\'s ARGUS_threads.cfg.')
     parser.add_argument('-D', '--Debug', action='store_true',
                         help='Enable debugging.')
     return parser
@@ -117,7 +120,7 @@ def write_result(video_file, result, debug=False):
     print(f'      Confidence Measure 0: {decision_confidence_0}')
     print(f'      Confidence Measure 1: {decision_confidence_1}')
 
-def cli_send_video(video_file, sock, task=None, source=None, device_num=None, debug=False):
+def cli_send_video(video_file, sock, task=None, source=None, device_num=None, num_threads=None, debug=False):
     if not path.exists(video_file):
         print(f'File {video_file} does not exist')
         return None
@@ -126,6 +129,7 @@ def cli_send_video(video_file, sock, task=None, source=None, device_num=None, de
     start_info = dict(video_file=path.abspath(video_file),
                       task=task,
                       source=source,
+                      threads=num_threads,
                       debug=debug)
 
     if debug:
@@ -213,6 +217,7 @@ def main(args):
                                     task=task,
                                     source=source,
                                     device_num=device_num,
+                                    num_threads=args.threads,
                                     debug=debug)
             if result:
                 write_result(args.file, result, debug=debug)
@@ -247,6 +252,7 @@ def main(args):
                                         task=task,
                                         source=source,
                                         device_num=device_num,
+                                        num_threads=args.threads,
                                         debug=debug)
                 if result:
                     write_result(vidfile, result, debug=debug)
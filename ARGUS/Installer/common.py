@@ -71,6 +71,15 @@ class Stats:
             )
             del self._running_timers[name]
     
+    def time_add(self, name, elapsed):
+        """Record a timer that was measured elsewhere, ending now"""
+        end = time.time() - self._global_start
+        self.timers[name] = dict(
+            start=end - elapsed,
+            end=end,
+            elapsed=elapsed
+        )
+
     @contextmanager
     def time(self, name):
         self.time_start(name)
@@ -70,12 +70,14 @@ class ArgusWorker:
         device_num = data.get('device_num', None)
         if device_num != None and device_num.isdigit():
             device_num = int(device_num)
+        # Total threads of this prediction; None = the ARGUS_threads.cfg budget
+        num_threads = data.get('threads', None)
 
         try:
             if not path.exists(video_file):
                 raise Exception(f'File {video_file} is not accessible!')
 
-            inf_result = self.app_ai.predict(video_file, stats=stats, task=task, source=source, device_num=device_num)
+            inf_result = self.app_ai.predict(video_file, stats=stats, task=task, source=source, device_num=device_num, num_threads=num_threads)
         except Exception as e:
             self.log.exception(e)
             error_msg = Message(Message.Type.ERROR, json.dumps(str(e)).encode('ascii'))
@@ -97,6 +99,7 @@ class ArgusWorker:
                 task_confidence_ETT=inf_result['task_confidence_ETT'],
                 decision_confidence_0=inf_result['decision_confidence_0'],
                 decision_confidence_1=inf_result['decision_confidence_1'],
+                timeline=inf_result['timeline'],
             )
             result_msg = Message(Message.Type.RESULT, json.dumps(result).encode('ascii'))
             self.sock.send(result_msg)
@@ -13,7 +13,8 @@ nnet.train_data_portion = 1.0
 nnet.validation_data_portion = 1.0
 nnet.test_data_portion = 1.0
 
-nnet.setup_vfold_files()
+# A one-fold split of all the data, not the training manifest
+nnet.setup_vfold_files(use_manifest=False)
 
 
 for r in range(nnet.num_models):
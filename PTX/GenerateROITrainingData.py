@@ -1,105 +1,225 @@
 import os
 import glob
+import time
+import argparse
+import multiprocessing
 
 import numpy as np
 
-import monai
-from monai.data import ITKWriter
-from monai.transforms import LoadImage
-
 import itk
-from itk import TubeTK as tube
 
 import site
 site.addsitedir("../ARGUS")
 
 from ARGUS_IO import *
+from ARGUS_chunked_video import ARGUS_chunked_video
 from ARGUS_ptx_ar_train import ARGUS_ptx_ar_train
 from ARGUS_ptx_roi_inference import ARGUS_ptx_roi_inference
 
+# ROI training windows for the PTX ROI network.
+#
+# Every 10th slice of each video is preprocessed for the AR network; the
+# AR ensemble is run on all of a video's windows in batches, and the ROI
+# around the ideal (annotated) and the predicted pleura is cut from each.
+# Each video becomes one shard, Data_PTX/roi_shards/<video>.npz, holding
+# the ideal and pred windows of every slice (row i of ideal_* and pred_*
+# is the same slice, slices[i]) and the origin and direction of each ROI
+# image (preprocessing permutes its axes, so the direction is not the
+# identity).  Shards are written atomically and existing shards are
+# skipped, so an interrupted run resumes where it stopped.  --export-mha
+# expands the shards into the roi_images/roi_labels MHA files read by
+# ARGUS_ptx_roi.cfg.
+
 device_num = 0
 best_models = [8, 3, 6]
 
-image_files = sorted(glob.glob("./Data_PTX/images/*.mha"))
-label_files = sorted(glob.glob("./Data_PTX/labels/*.mha"))
+shard_dirname = "./Data_PTX/roi_shards"
+img_dir_basename = "./Data_PTX/roi_images"
+lbl_dir_basename = "./Data_PTX/roi_labels"
 
-ar_nnet = ARGUS_ptx_ar_train(
-        "../ARGUS/ARGUS_ptx_ar.cfg",
-        "vfold",
-        device_num=device_num
-        )
+ar_nnet = None
+roi_nnet = None
 
-for r in range(len(best_models)):
-    model_name = os.path.join(
-            "./Results_Best",
-            "ptx_vfold_run"+str(r),
-            "best_model_"+str(best_models[r])+".pth"
+def video_files():
+    # Chunked copies (ARGUS_chunked_video.py convert ...) are read one window
+    # at a time instead of decompressing whole clips
+    use_chunked = os.path.isdir("./Data_PTX/images_arv")
+    if use_chunked:
+        image_files = sorted(glob.glob("./Data_PTX/images_arv/*.arv"))
+        label_files = sorted(glob.glob("./Data_PTX/labels_arv/*.arv"))
+    else:
+        image_files = sorted(glob.glob("./Data_PTX/images/*.mha"))
+        label_files = sorted(glob.glob("./Data_PTX/labels/*.mha"))
+    return use_chunked, image_files, label_files
+
+def shard_filename(image_file):
+    img_base = os.path.splitext(os.path.basename(image_file))[0]
+    return os.path.join(shard_dirname, img_base + ".npz")
+
+def init_worker():
+    """ Load the AR ensemble and ROI generator once per process """
+    global ar_nnet, roi_nnet
+    ar_nnet = ARGUS_ptx_ar_train(
+            "../ARGUS/ARGUS_ptx_ar.cfg",
+            "vfold",
+            device_num=device_num
             )
-    ar_nnet.load_model( r, model_name )
+    for r in range(len(best_models)):
+        model_name = os.path.join(
+                "./Results_Best",
+                "ptx_vfold_run"+str(r),
+                "best_model_"+str(best_models[r])+".pth"
+                )
+        ar_nnet.load_model( r, model_name )
 
-roi_nnet = ARGUS_ptx_roi_inference(
-        os.path.join( "..", "ARGUS", "ARGUS_ptx_roi.cfg"),
-        "vfold",
-        device_num=device_num
-        )
+    roi_nnet = ARGUS_ptx_roi_inference(
+            os.path.join( "..", "ARGUS", "ARGUS_ptx_roi.cfg"),
+            "vfold",
+            device_num=device_num
+            )
+
+def roi_window(ar_in_image, ar_in_array, label_array):
+    roi_nnet.generate_roi(ar_in_image, ar_in_array, label_array)
+    roi_image = roi_nnet.input_image
+    return (itk.GetArrayFromImage(roi_image).astype(np.float32),
+            np.array(roi_image.GetOrigin()),
+            itk.array_from_matrix(roi_image.GetDirection()),
+            roi_nnet.input_array.astype(np.float32),
+            roi_nnet.label_array.astype(np.short))
+
+def generate_shard(image_file, label_file, use_chunked, batch_size):
+    """ Write the ROI windows of one video; returns the number of windows """
+    if use_chunked:
+        vid = ARGUS_chunked_video(image_file)
+        lbl_vid = ARGUS_chunked_video(label_file)
+        num_frames = vid.num_frames
+    else:
+        img = itk.imread(image_file)
+        lbl = itk.imread(label_file, itk.SS)
+        num_frames = img.shape[0]
 
-for file_num in range(len(image_files)):
-    img = itk.imread(image_files[file_num])
-    lbl = itk.imread(label_files[file_num], itk.SS)
-    for slice_num in range(17,img.shape[0]-19,10):
+    slices = list(range(17,num_frames-19,10))
+    ar_in_images = []
+    ar_in_arrays = []
+    ar_ideal_label_arrays = []
+    ar_input_tensors = []
+    for slice_num in slices:
+        window_slice_num = slice_num
+        if use_chunked:
+            # The frames ar_nnet.preprocess crops around slice_num
+            min_slice = max(0, slice_num-ar_nnet.num_slices//2-1)
+            max_slice = slice_num+ar_nnet.num_slices//2+2
+            img = vid.image(min_slice, max_slice)
+            lbl = lbl_vid.image(min_slice, max_slice, itk.SS)
+            window_slice_num = slice_num - min_slice
         ar_nnet.preprocess(
             img,
             lbl_img=lbl,
-            slice_num=slice_num, 
-            crop_data=False, 
+            slice_num=window_slice_num,
+            crop_data=False,
             scale_data=False,
             rotate_data=True
         )
-        ar_in_image = ar_nnet.input_image
-        ar_in_array = ar_nnet.input_array
-        ar_ideal_label_array = ar_nnet.label_array
-        roi_nnet.generate_roi(
-            ar_in_image,
-            ar_in_array,
-            ar_ideal_label_array
-        )
-        roi_ideal_image = roi_nnet.input_image.astype(np.float32)
-        roi_ideal_array = roi_nnet.input_array.astype(np.float32)
-        roi_ideal_label_array = roi_nnet.label_array.astype(np.short)
-        
-        img_base = os.path.splitext(os.path.basename(image_files[file_num]))[0]
-        lbl_base = os.path.splitext(os.path.basename(label_files[file_num]))[0]
-        img_dir_basename = "./Data_PTX/roi_images"
-        lbl_dir_basename = "./Data_PTX/roi_labels"
-        
-        new_img_basename = img_base+"_"+str(slice_num)+"_ideal_img.mha"
-        new_arr_basename = img_base+"_"+str(slice_num)+"_ideal_arr.mha"
-        new_lbl_basename = lbl_base+"_"+str(slice_num)+"_ideal_lbl.mha"
-        
-        itk.imwrite(roi_ideal_image,
-                    os.path.join(img_dir_basename, new_img_basename))
-        itk.imwrite(itk.GetImageFromArray(roi_ideal_array),
-                    os.path.join(img_dir_basename, new_arr_basename))
-        itk.imwrite(itk.GetImageFromArray(roi_ideal_label_array),
-                    os.path.join(lbl_dir_basename, new_lbl_basename))
-
-        ar_pred_label_array = ar_nnet.inference()
-        roi_nnet.generate_roi(
-            ar_in_image,
-            ar_in_array,
-            ar_pred_label_array
-        )
-        roi_pred_image = roi_nnet.input_image.astype(np.float32)
-        roi_pred_array = roi_nnet.input_array.astype(np.float32)
-        roi_pred_label_array = roi_nnet.label_array.astype(np.short)
-        
-        new_img_basename = img_base+"_"+str(slice_num)+"_pred_img.mha"
-        new_arr_basename = img_base+"_"+str(slice_num)+"_pred_arr.mha"
-        new_lbl_basename = lbl_base+"_"+str(slice_num)+"_pred_lbl.mha"
-        
-        itk.imwrite(roi_pred_image,
-                    os.path.join(img_dir_basename, new_img_basename))
-        itk.imwrite(itk.GetImageFromArray(roi_pred_array),
-                    os.path.join(img_dir_basename, new_arr_basename))
-        itk.imwrite(itk.GetImageFromArray(roi_pred_label_array),
-                    os.path.join(lbl_dir_basename, new_lbl_basename))
+        ar_in_images.append(ar_nnet.input_image)
+        ar_in_arrays.append(ar_nnet.input_array)
+        ar_ideal_label_arrays.append(ar_nnet.label_array)
+        ar_input_tensors.append(ar_nnet.input_tensor)
+    if use_chunked:
+        vid.close()
+        lbl_vid.close()
+
+    ar_pred_label_arrays = ar_nnet.batch_inference(ar_input_tensors, batch_size)
+
+    shard = {}
+    for kind, label_arrays in [("ideal", ar_ideal_label_arrays),
+                               ("pred", ar_pred_label_arrays)]:
+        windows = [roi_window(ar_in_images[i], ar_in_arrays[i], label_arrays[i])
+                   for i in range(len(slices))]
+        for field_num, field in enumerate(["img", "origin", "direction", "arr", "lbl"]):
+            shard[kind + "_" + field] = (np.stack([w[field_num] for w in windows])
+                                         if windows else np.zeros(0))
+
+    spacing = np.array(roi_nnet.input_image.GetSpacing()) if slices else np.ones(3)
+    tmp_name = shard_filename(image_file) + ".tmp.npz"
+    np.savez(tmp_name,
+             slices=np.array(slices),
+             spacing=spacing,
+             image_file=os.path.basename(image_file),
+             label_file=os.path.basename(label_file),
+             **shard)
+    os.replace(tmp_name, shard_filename(image_file))
+    return len(slices)
+
+def generate_shard_job(args):
+    start = time.perf_counter()
+    num_windows = generate_shard(*args)
+    return args[0], num_windows, time.perf_counter() - start
+
+def export_mha(shard_file):
+    """ Expand a shard into the per-slice MHA files of the original layout """
+    shard = np.load(shard_file)
+    if len(shard["slices"]) > 0 and "ideal_direction" not in shard.files:
+        print(f"ERROR: {shard_file} has no image directions;"
+              f" regenerate it with --rebuild.")
+        return
+    img_base = os.path.splitext(str(shard["image_file"]))[0]
+    lbl_base = os.path.splitext(str(shard["label_file"]))[0]
+    spacing = [float(s) for s in shard["spacing"]]
+    for i, slice_num in enumerate(shard["slices"]):
+        for kind in ["ideal", "pred"]:
+            roi_image = itk.GetImageFromArray(shard[kind + "_img"][i])
+            roi_image.SetSpacing(spacing)
+            roi_image.SetOrigin([float(o) for o in shard[kind + "_origin"][i]])
+            roi_image.SetDirection(itk.matrix_from_array(
+                np.ascontiguousarray(shard[kind + "_direction"][i], dtype=np.float64)))
+            prefix = "_"+str(slice_num)+"_"+kind
+            itk.imwrite(roi_image,
+                        os.path.join(img_dir_basename, img_base+prefix+"_img.mha"))
+            itk.imwrite(itk.GetImageFromArray(shard[kind + "_arr"][i]),
+                        os.path.join(img_dir_basename, img_base+prefix+"_arr.mha"))
+            itk.imwrite(itk.GetImageFromArray(shard[kind + "_lbl"][i]),
+                        os.path.join(lbl_dir_basename, lbl_base+prefix+"_lbl.mha"))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generate PTX ROI training windows, one shard per video")
+    parser.add_argument("--workers", type=int, default=2,
+                        help="processes, each with its own copy of the networks")
+    parser.add_argument("--batch-size", type=int, default=16,
+                        help="AR windows per ensemble forward")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="regenerate shards that already exist")
+    parser.add_argument("--export-mha", action="store_true",
+                        help="write the roi_images/roi_labels MHA files from the shards")
+    args = parser.parse_args()
+
+    os.makedirs(shard_dirname, exist_ok=True)
+
+    use_chunked, image_files, label_files = video_files()
+    jobs = [(image_files[i], label_files[i], use_chunked, args.batch_size)
+            for i in range(len(image_files))
+            if args.rebuild or not os.path.exists(shard_filename(image_files[i]))]
+    print(f"{len(image_files)-len(jobs)} of {len(image_files)} videos already done")
+
+    start = time.perf_counter()
+    total_windows = 0
+    if len(jobs) > 0:
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(max(1, args.workers), initializer=init_worker) as pool:
+            for image_file, num_windows, seconds in pool.imap_unordered(
+                    generate_shard_job, jobs):
+                total_windows += num_windows
+                elapsed = time.perf_counter() - start
+                print(f"{os.path.basename(image_file)}: {num_windows} windows"
+                      f" in {seconds:.1f}s; total {total_windows} windows,"
+                      f" {total_windows/elapsed:.2f} windows/s", flush=True)
+
+    if args.export_mha:
+        os.makedirs(img_dir_basename, exist_ok=True)
+        os.makedirs(lbl_dir_basename, exist_ok=True)
+        for image_file in image_files:
+            if os.path.exists(shard_filename(image_file)):
+                export_mha(shard_filename(image_file))
+
+if __name__ == "__main__":
+    main()
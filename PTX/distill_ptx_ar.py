@@ -0,0 +1,22 @@
+import site
+site.addsitedir("../ARGUS")
+
+from ARGUS_ptx_ar_train import ARGUS_ptx_ar_train
+from ARGUS_distillation import ARGUS_distillation_report
+
+# Trains a single (narrower) PTX AR student on the soft outputs of the
+# production ensemble, then reports its agreement and Dice against the
+# ensemble on each vfold's test split.
+
+run_num = 0
+device_num = 0
+
+nnet = ARGUS_ptx_ar_train("../ARGUS/ARGUS_ptx_ar.cfg", "distill", device_num=device_num)
+nnet.setup_vfold_files()
+
+for vfn in range(nnet.num_folds):
+    nnet.init_model(run_num)
+    nnet.setup_training_vfold(vfn, run_num)
+    nnet.train_vfold(run_num)
+
+ARGUS_distillation_report(nnet, run_id=run_num)
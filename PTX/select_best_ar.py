@@ -2,6 +2,7 @@ import site
 site.addsitedir("../ARGUS")
 
 from ARGUS_ptx_ar_train import ARGUS_ptx_ar_train
+from ARGUS_model_selection import ARGUS_model_selection
 
 nnet = ARGUS_ptx_ar_train("../ARGUS/ARGUS_ptx_ar.cfg", "vfold", device_num=1)
 nnet.image_dirname = ["Data_PTX/images"]
@@ -14,10 +15,10 @@ nnet.train_data_portion = 1.0
 nnet.validation_data_portion = 1.0
 nnet.test_data_portion = 1.0
 
-nnet.setup_vfold_files()
+# A one-fold split of all the data, not the training manifest
+nnet.setup_vfold_files(use_manifest=False)
 
-for r in range(nnet.num_models):
-    print("*** Run", r)
-    nnet.setup_testing_vfold(vfold_num=0,run_num=r)
-    for vf in range(num_folds):
-        test_output = nnet.view_testing_results_vfold(model_type="best", run_ids=[r], model_vfold=vf, summary_only=True)
+# Loads the test set once and scores every run x vfold best model on it
+selection = ARGUS_model_selection(nnet, vfold_num=0, model_type="best")
+selection.evaluate(runs=range(nnet.num_models), model_vfolds=range(num_folds))
+selection.write_table("ptx_ar_selection")
@@ -0,0 +1,70 @@
+import site
+site.addsitedir("../ARGUS")
+
+import os
+import time
+
+import torch
+
+from monai.data import Dataset
+
+from ARGUS_segmentation_train import ARGUS_segmentation_train
+from ARGUS_precollated_validation import ARGUS_precollated_validation
+
+# Per-task Dice of a multi-task AR model against the production
+# ensembles (the best model lists of ARGUS_app_ptx/pnb/onsd), on the test
+# set of one multi-task fold.  Both are scored on the argmax of the network
+# outputs, before the apps' probability post-processing.
+
+device_num = 0
+vfold_num = 0
+batch_size = 16
+multitask_model = os.path.join(
+    "Results_multitask", "multitask_vfold_run0", "best_model_"+str(vfold_num)+".pth")
+production_best_models = {"ptx": [8, 3, 6], "pnb": [8, 0, 7], "onsd": [5, 8, 5]}
+
+def num_parameters(models):
+    return sum(p.numel() for m in models for p in m.parameters())
+
+def timed_dice(eval_set, model):
+    start = time.perf_counter()
+    result = eval_set.dice(model, batch_size, nnet.num_classes, per_task=True)
+    return result, time.perf_counter() - start
+
+nnet = ARGUS_segmentation_train("ARGUS_multitask_ar.cfg", "vfold", device_num=device_num)
+nnet.setup_vfold_files()
+nnet.init_model(0)
+nnet.model[0].load_state_dict(torch.load(multitask_model, map_location=nnet.device))
+nnet.model[0].eval()
+
+eval_set = ARGUS_precollated_validation(
+    Dataset(data=nnet.test_files[vfold_num], transform=nnet.test_transforms),
+    nnet.device)
+
+(mt_dice, mt_task_dice), mt_seconds = timed_dice(eval_set, nnet.model[0])
+
+ensemble_parameters = 0
+print(f"{'task':6} {'multitask':>10} {'ensemble':>10}")
+for task_num, task_name in enumerate(nnet.task_names):
+    task_nnet = ARGUS_segmentation_train(
+        os.path.join("..", "ARGUS", "ARGUS_"+task_name+"_ar.cfg"), "vfold", device_num=device_num)
+    models = []
+    for r, best_model in enumerate(production_best_models[task_name]):
+        task_nnet.init_model(r)
+        task_nnet.model[r].load_state_dict(torch.load(
+            os.path.join("..", "ARGUS", "Models", task_name+"_vfold_run"+str(r),
+                         "best_model_"+str(best_model)+".pth"),
+            map_location=task_nnet.device))
+        task_nnet.model[r].eval()
+        models.append(task_nnet.model[r])
+    ensemble_parameters += num_parameters(models)
+
+    def ensemble(x, tasks=None):
+        return torch.stack([torch.softmax(m(x), dim=1) for m in models]).mean(dim=0)
+
+    (ens_dice, ens_task_dice), ens_seconds = timed_dice(eval_set, ensemble)
+    print(f"{task_name:6} {mt_task_dice[task_num]:10.4f} {ens_task_dice[task_num]:10.4f}")
+
+print(f"Parameters: multitask {num_parameters([nnet.model[0]])},"
+      f" ensembles {ensemble_parameters}")
+print(f"Multitask forward over {len(eval_set)} windows: {mt_seconds:.2f} seconds")
@@ -0,0 +1,25 @@
+import site
+site.addsitedir("../ARGUS")
+
+import torch
+
+from ARGUS_segmentation_train import ARGUS_segmentation_train
+
+run_num = 0
+device_num = 0
+
+# The shared "half" AR model initializes the encoder and every decoder
+pretrained_model = "Results_half/pretrain_half_vfold_run0/best_model_0.pth"
+
+nnet = ARGUS_segmentation_train("ARGUS_multitask_ar.cfg",
+        "vfold",
+        device_num=device_num)
+
+nnet.setup_vfold_files()
+
+for vfn in range(nnet.num_folds):
+    nnet.init_model(run_num)
+    nnet.model[run_num].load_unet_state_dict(
+        torch.load(pretrained_model, map_location=nnet.device))
+    nnet.setup_training_vfold(vfn, run_num)
+    nnet.train_vfold(run_num)